@@ -0,0 +1,63 @@
+"""Binary envelope for gateway traffic.
+
+A binary WebSocket frame carries [service id, sequence number, payload] in MessagePack
+or CBOR. The payload is opaque bytes (usually the service's JSON message) and is
+forwarded to the backend without being decoded. Which encoding a connection uses is
+negotiated in the authentication message; connections that don't ask keep using JSON
+text frames.
+"""
+from typing import List, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Sequence number marking a batch, whose payload is a list of envelope frames
+BATCH_SEQ = -1
+
+ENCODERS = {}
+if msgpack is not None:
+    ENCODERS["msgpack"] = (lambda obj: msgpack.packb(obj, use_bin_type=True),
+                           lambda data: msgpack.unpackb(data, raw=False))
+if cbor2 is not None:
+    ENCODERS["cbor"] = (cbor2.dumps, cbor2.loads)
+
+
+def negotiate(requested) -> Optional[str]:
+    """Pick the first requested encoding this gateway supports, None means JSON text"""
+    if isinstance(requested, str):
+        requested = [requested]
+    for encoding in requested or []:
+        if encoding in ENCODERS:
+            return encoding
+    return None
+
+
+def pack(encoding: str, service, seq: int, payload) -> bytes:
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return ENCODERS[encoding][0]([service, seq, payload])
+
+
+def unpack(encoding: str, frame: bytes) -> Tuple[object, int, bytes]:
+    """Return (service id or name, sequence number, payload bytes)"""
+    service, seq, payload = ENCODERS[encoding][1](frame)
+    return service, seq, payload
+
+
+def pack_batch(encoding: str, service, frames: List[bytes]) -> bytes:
+    return ENCODERS[encoding][0]([service, BATCH_SEQ, frames])
+
+
+def unbatch(encoding: str, frame: bytes) -> List[Tuple[object, int, bytes]]:
+    """Unpack a frame that may be a batch into its (service, seq, payload) messages"""
+    service, seq, payload = unpack(encoding, frame)
+    if seq != BATCH_SEQ:
+        return [(service, seq, payload)]
+    return [unpack(encoding, f) for f in payload]
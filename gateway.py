@@ -1,13 +1,25 @@
 import asyncio
+import collections
 import websockets
 import json
 import logging
+import random
+import re
+import secrets
+import socket
+import struct
+import tempfile
+import time
 import uuid
 import os
-from typing import Dict, Optional, Set
+import sys
+from typing import Callable, Dict, Optional, Set
 from dataclasses import dataclass
 from enum import Enum
 from dotenv import load_dotenv
+import envelope
+from gateway_metrics import GatewayMetrics, serve_metrics
+from shm_ring import ShmRing
 
 # Load environment variables
 load_dotenv()
@@ -16,19 +28,296 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Apps put "service" first so routing can read it without parsing the payload
+SERVICE_PREFIX = re.compile(r'\s*\{\s*"service"\s*:\s*"([^"\\]*)"')
+# Only every Nth routed message is logged, and only at DEBUG
+LOG_SAMPLE_EVERY = 100
+# Messages for the gateway itself (subscriptions) use this service name
+GATEWAY_SERVICE = "gateway"
+# Backend messages waiting for one client, per service
+OUTBOUND_QUEUE_SIZE = 256
+# Backend health checks and reconnects
+BACKEND_PING_INTERVAL = 5.0
+BACKEND_PING_TIMEOUT = 5.0
+RECONNECT_BACKOFF_MIN = 0.05
+RECONNECT_BACKOFF_MAX = 5.0
+# Messages held per service while its backend is reconnecting
+PENDING_QUEUE_SIZE = 64
+# A disconnected app can resume its session (subscriptions, queued messages, video
+# session) for this long with the resume token from auth_success
+RESUME_GRACE_S = float(os.getenv("GATEWAY_RESUME_GRACE_S", "10"))
+# Local services register themselves on this Unix socket, in a directory only this user can enter
+REGISTRY_SOCKET = os.getenv("GATEWAY_REGISTRY_SOCKET") or os.path.join(
+    os.getenv("XDG_RUNTIME_DIR") or os.path.join(tempfile.gettempdir(), f"robot_gateway-{os.getuid()}"),
+    "robot_gateway.sock")
+# Users besides the gateway's own (and root) whose programs may register services
+REGISTRY_UIDS = {int(uid) for uid in os.getenv("GATEWAY_REGISTRY_UIDS", "").split(",") if uid}
+# tcp: WebSocket on host:port. unix: WebSocket on a Unix socket path.
+# shm: stream records from a shared-memory ring, commands over `path` if given.
+# local: a service running on the gateway's own event loop (LocalConnection).
+TRANSPORTS = {"tcp", "unix", "shm", "local"}
+SHM_POLL_INTERVAL = 0.001
+SHM_READ_BATCH = 256
+# A batch is flushed after its service's batch_ms or once it reaches this size
+BATCH_MAX_BYTES = 16384
+# Local HTTP port for /metrics (Prometheus) and /metrics.json, 0 disables it
+METRICS_HOST = os.getenv("GATEWAY_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("GATEWAY_METRICS_PORT", "9108"))
+# Run gstreamer/stream.py's WebRTCServer inside the gateway instead of on port 8765
+INPROCESS_VIDEO = os.getenv("GATEWAY_INPROCESS_VIDEO") == "1"
+# A leading top-level "type", like SERVICE_PREFIX. Anything else is parsed
+TYPE_PREFIX = re.compile(r'\s*\{\s*"type"\s*:\s*"([^"\\]*)"')
+# Request services echo this field so each reply goes back to the app that asked
+REQUEST_ID_FIELD = "gateway_request_id"
+REQUEST_ID = re.compile(r'"gateway_request_id"\s*:\s*(\d+)')
+# Requests waiting for a reply per service, the oldest is forgotten past this
+PENDING_REQUESTS = 1024
+MODES = {"shared", "session", "request"}
+QUEUE_POLICIES = {"drop_oldest", "latest", "reliable"}
+
+def extract_service(message) -> Optional[str]:
+    """Return the service a message is addressed to, parsing the JSON only as a fallback"""
+    if isinstance(message, bytes):
+        message = message.decode("utf-8", errors="replace")
+    match = SERVICE_PREFIX.match(message)
+    if match:
+        return match.group(1)
+    try:
+        data = json.loads(message)
+    except json.JSONDecodeError:
+        return None
+    return data.get("service") if isinstance(data, dict) else None
+
+def tag_request(message, request_id: int):
+    """Add REQUEST_ID_FIELD to a JSON object message without parsing it, None if it isn't one"""
+    if isinstance(message, bytes):
+        message = message.decode("utf-8", errors="replace")
+    start = message.find("{")
+    if start < 0 or message[:start].strip():
+        return None
+    body = message[start + 1:].lstrip()
+    separator = "" if body.startswith("}") else ", "
+    return f'{{"{REQUEST_ID_FIELD}": {request_id}{separator}{body}'
+
+def is_close_notice(message: str) -> bool:
+    """Whether a signaling frame is the server's {"type": "connection_closed"}.
+
+    Apps can send anything through the relay, a frame that isn't a JSON object is
+    just not a close notice.
+    """
+    try:
+        return json.loads(message).get("type") == "connection_closed"
+    except (ValueError, AttributeError):
+        return False
+
+def message_type(message) -> Optional[str]:
+    """Return the "type" of a backend message, used to coalesce latest-value queues"""
+    if isinstance(message, bytes):
+        message = message.decode("utf-8", errors="replace")
+    match = TYPE_PREFIX.match(message)
+    if match:
+        return match.group(1)
+    # A "type" further in may belong to a nested object, only the top-level one counts
+    try:
+        data = json.loads(message)
+    except json.JSONDecodeError:
+        return None
+    message_type = data.get("type") if isinstance(data, dict) else None
+    return message_type if isinstance(message_type, str) else None
+
+def json_inlinable(frame) -> bool:
+    """Whether a frame can go into a JSON batch as is: text holding one JSON value"""
+    if not isinstance(frame, str):
+        return False
+    try:
+        json.loads(frame)
+    except ValueError:
+        return False
+    return True
+
+class OutboundQueue:
+    """Bounded queue of frames for one client and one service.
+
+    drop_oldest: a full queue discards its oldest frame.
+    latest: one frame per message type, a newer frame replaces the queued one.
+    reliable: nothing is dropped, the backend reader waits for space instead.
+    """
+
+    def __init__(self, policy: str, maxsize: int = OUTBOUND_QUEUE_SIZE):
+        self.policy = policy
+        self.maxsize = maxsize
+        self.frames = collections.OrderedDict() if policy == "latest" else collections.deque()
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        self.closed = False
+        self.writer: Optional[asyncio.Task] = None
+        # Frames a writer had taken when its client went away, sent first on resume
+        self.unsent: list = []
+        self.dropped = 0
+        self.sent = 0
+        self.batches = 0
+        self.untyped = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def offer(self, frame, key=None) -> bool:
+        """Queue a frame without waiting, False if a reliable queue is full"""
+        if self.closed:
+            self.dropped += 1
+            return True
+        if self.policy == "latest":
+            if key is None:
+                # Untyped messages can't be coalesced, give each its own slot
+                self.untyped += 1
+                key = ("untyped", self.untyped)
+            if key in self.frames:
+                del self.frames[key]
+                self.dropped += 1
+            elif len(self.frames) >= self.maxsize:
+                self.frames.popitem(last=False)
+                self.dropped += 1
+            self.frames[key] = frame
+        elif len(self.frames) >= self.maxsize:
+            if self.policy == "reliable":
+                return False
+            self.frames.popleft()
+            self.dropped += 1
+            self.frames.append(frame)
+        else:
+            self.frames.append(frame)
+        self.ready.set()
+        return True
+
+    async def put(self, frame, key=None):
+        """Queue a frame, waiting for space in a full reliable queue"""
+        while not self.offer(frame, key):
+            self.space.clear()
+            await self.space.wait()
+
+    async def get(self):
+        while not self.frames:
+            self.ready.clear()
+            await self.ready.wait()
+        return self.get_nowait()
+
+    def get_nowait(self):
+        """Next frame, None if the queue is empty"""
+        if not self.frames:
+            return None
+        if self.policy == "latest":
+            frame = self.frames.popitem(last=False)[1]
+        else:
+            frame = self.frames.popleft()
+        self.space.set()
+        return frame
+
+    def close(self):
+        """Drop everything queued and release a backend reader waiting for space"""
+        self.closed = True
+        self.dropped += len(self.frames)
+        self.frames.clear()
+        self.space.set()
+
+    def stats(self) -> dict:
+        return {"policy": self.policy, "depth": len(self.frames), "dropped": self.dropped, "sent": self.sent,
+                "batches": self.batches}
+
 class ConnectionType(Enum):
     WEBSOCKET = "websocket"
     SIGNALING = "signaling"
 
+class LocalConnection:
+    """Pooled backend connection of a service running on the gateway's own event loop.
+
+    The gateway sends to it and reads from it like a backend WebSocket. Messages are
+    handed straight to `handler`, and the service replies through `peer`, which it
+    uses in place of its client WebSocket. No socket or framing in between.
+    """
+
+    def __init__(self, handler: Callable):
+        self.handler = handler
+        self.replies: asyncio.Queue = asyncio.Queue()
+        self.closed = False
+        self.peer = LocalPeer(self)
+
+    async def send(self, message):
+        if self.closed:
+            raise websockets.exceptions.ConnectionClosed(None, None)
+        try:
+            result = self.handler(message)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            # A failing handler is the service's problem, like an error inside a remote backend
+            logger.error(f"Local service handler failed: {e}")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.replies.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            self.replies.put_nowait(None)
+
+
+class LocalPeer:
+    """The service's end of a LocalConnection"""
+
+    def __init__(self, connection: LocalConnection):
+        self.connection = connection
+
+    async def send(self, message):
+        if self.connection.closed:
+            raise websockets.exceptions.ConnectionClosed(None, None)
+        self.connection.replies.put_nowait(message)
+
+
 @dataclass
 class BackendService:
     host: str
     port: int
     name: str
+    # "shared": replies fan out to every subscriber. "session": the backend serves one
+    # client at a time (the last one that messaged it) and gets a Hangup when it leaves.
+    # "request": each reply goes only to the client whose request it echoes the
+    # REQUEST_ID_FIELD of, and sending doesn't subscribe.
+    mode: str = "shared"
+    # OutboundQueue policy for this service's messages to each client
+    queue_policy: str = "drop_oldest"
+    queue_size: int = OUTBOUND_QUEUE_SIZE
+    transport: str = "tcp"
+    # Unix socket path (unix, shm commands) and shared-memory ring name (shm)
+    path: Optional[str] = None
+    shm_name: Optional[str] = None
+    # Window for coalescing messages to clients that opted into batching, 0 sends each
+    # message on its own (commands, SDP)
+    batch_ms: float = 0
+    batch_bytes: int = BATCH_MAX_BYTES
+    # local transport only
+    connection: Optional[LocalConnection] = None
     
     @property
     def address(self):
-        return f"{self.host}:{self.port}"
+        if self.transport == "tcp":
+            return f"{self.host}:{self.port}"
+        if self.transport == "local":
+            return f"local:{self.name}"
+        if self.transport == "shm" and not self.path:
+            return f"shm:{self.shm_name}"
+        return self.path
+
+    @property
+    def accepts_messages(self) -> bool:
+        """shm services without a command socket only stream to the gateway"""
+        return self.transport != "shm" or bool(self.path)
 
 class GatewayProxy:
     def __init__(self, signaling_server_url: str, websocket_port: int = 8080):
@@ -36,48 +325,110 @@ class GatewayProxy:
         self.signaling_server_url = signaling_server_url
         # Backend services that can be port forwarded to
         self.backend_services: Dict[str, BackendService] = {
-            "video": BackendService("localhost", 8765, "video"),
+            # SDP and ICE must not be dropped
+            "video": BackendService("localhost", 8765, "video", mode="session", queue_policy="reliable"),
+            # Pollers each get their own frames, a viewer only needs the newest one
+            "snapshot": BackendService("localhost", 8767, "snapshot", mode="request"),
         }
         
         # Active connections
         self.active_connections: Dict[str, dict] = {}
         self.authenticated_tokens: Set[str] = {os.getenv('AUTH_TOKEN')}
+        # One pooled connection per backend service, shared by all clients
+        self.backend_pool: Dict[str, object] = {}
+        # Service -> task keeping its pooled connection up
+        self.backend_tasks: Dict[str, asyncio.Task] = {}
+        # Messages routed while a backend was down, sent once it reconnects
+        self.pending_messages: Dict[str, collections.deque] = {}
+        self.backend_metrics: Dict[str, dict] = {}
+        # Service -> task reading its shared-memory ring
+        self.shm_tasks: Dict[str, asyncio.Task] = {}
+        # Tasks nobody waits for, referenced here until they finish
+        self.background_tasks: Set[asyncio.Task] = set()
+        # Topic (service name) -> subscribed connection ids
+        self.subscriptions: Dict[str, Set[str]] = {}
+        # Session services -> connection id currently owning the backend session
+        self.session_owners: Dict[str, str] = {}
+        # Request services -> request id -> connection id waiting for the reply
+        self.pending_requests: Dict[str, collections.OrderedDict] = {}
+        self.request_ids = 0
+        self.fanout_seq: Dict[str, int] = {}
+        # Drops of queues whose client already left
+        self.retired_drops = 0
         # Connection state
         self.websocket_server = None
+        self.routed_messages = 0
+        self.backend_messages = 0
+        self.metrics = GatewayMetrics()
+        # Sessions of apps that went away, kept for RESUME_GRACE_S
+        self.detached_connections: Dict[str, dict] = {}
+        self.resume_tokens: Dict[str, str] = {}
+        # Services registered over REGISTRY_SOCKET. Only these can be replaced from there
+        self.registry_services: Dict[str, BackendService] = {}
+        # Binary envelope clients address services by these ids
+        self.service_ids: Dict[str, int] = {}
+        self.service_names: Dict[int, str] = {}
+
+    def _service_id(self, service_name: str) -> int:
+        """Stable small id of a service, assigned on first use"""
+        service_id = self.service_ids.get(service_name)
+        if service_id is None:
+            service_id = self.service_ids[service_name] = len(self.service_ids)
+            self.service_names[service_id] = service_name
+        return service_id
         
     async def start(self):
         """Start the gateway proxy with dual connection support"""
         logger.info("Starting Gateway Proxy...")
+        # Connect to backends before the first command needs them
+        self.start_backends()
         
-        # Start both connection methods concurrently
-        await asyncio.gather(
+        services = [
             self._start_websocket_server(),
+            self._start_registry(),
             self._connect_to_signaling_server(),
-            return_exceptions=True
-        )
+        ]
+        if METRICS_PORT:
+            services.append(serve_metrics(self, METRICS_HOST, METRICS_PORT))
+        # Start both connection methods concurrently
+        await asyncio.gather(*services, return_exceptions=True)
     
     async def _connect_to_signaling_server(self):
         """Connect to the signaling server"""
+        connection_id = "signaling_server"
+        attempt = 0
+        lost_at = None
         while True:
             try:
                 logger.info(f"Connecting to signaling server at {self.signaling_server_url}")
                 
                 async with websockets.connect(self.signaling_server_url) as websocket:
                     self.signaling_connection = websocket
-                    connection_id = "signaling_server"
                     initial_message = json.dumps({"role": "robot", "robot_id": os.getenv('ROBOT_ID')})
                     await websocket.send(initial_message)
                     logger.info("Connected to signaling server")
-                    await self._handle_connection(websocket, connection_id, ConnectionType.SIGNALING)
+                    attempt = 0
+                    if lost_at is not None:
+                        self.metrics.signaling_recover.observe(time.perf_counter() - lost_at)
+                        lost_at = None
+                    try:
+                        await self._handle_connection(websocket, connection_id, ConnectionType.SIGNALING)
+                    finally:
+                        # The app behind the relay may resume once we are back
+                        self._cleanup_connection(connection_id)
                     
             except websockets.exceptions.ConnectionClosed:
                 logger.warning("Signaling server connection closed")
             except Exception as e:
                 logger.error(f"Error connecting to signaling server: {e}")
+            if lost_at is None:
+                lost_at = time.perf_counter()
             
-            # Reconnect after delay
-            logger.info("Attempting to reconnect to signaling server in 5 seconds...")
-            await asyncio.sleep(5)
+            # Jittered exponential backoff, the first retry comes within tens of ms
+            delay = random.uniform(0, min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF_MIN * 2 ** attempt))
+            attempt += 1
+            logger.info(f"Attempting to reconnect to signaling server in {delay:.2f} seconds...")
+            await asyncio.sleep(delay)
     
     async def _start_websocket_server(self):
         """Start WebSocket server for direct LAN connections"""
@@ -107,8 +458,8 @@ class GatewayProxy:
         # Keep the server running
         await self.websocket_server.wait_closed()
 
-    async def _authenticate_connection(self, websocket, connection_id: str, connection_type: ConnectionType) -> bool:
-        """Authenticate incoming connection"""
+    async def _authenticate_connection(self, websocket, connection_id: str, connection_type: ConnectionType) -> Optional[dict]:
+        """Authenticate incoming connection, returns the negotiated session options or None"""
         try:
             # Wait for authentication message
             if connection_type == ConnectionType.SIGNALING:
@@ -125,169 +476,848 @@ class GatewayProxy:
                     "message": "Authentication successful"
                 }))
                 logger.error("Invalid authentication format")
+                self.metrics.auth_failures += 1
 
-                return False
+                return None
             
+            # A valid resume token stands in for the auth token
+            resumed = self._take_detached_session(auth_data.get("resume"))
             token = auth_data.get("token")
-            if not token or token not in self.authenticated_tokens:
+            if resumed is None and (not token or token not in self.authenticated_tokens):
                 logger.error("Invalid authentication token")
+                self.metrics.auth_failures += 1
                 websocket.send(json.dumps({
                     "type": "error",
                     "message": "Invalid authentication token"
                 }))
 
-                return False
-            
-            # Send authentication success
-            await websocket.send(json.dumps({
+                return None
+
+            if resumed is not None:
+                # Queued frames are already encoded for the session's options
+                encoding, batch = resumed["encoding"], resumed["batch"]
+            else:
+                # Clients asking for a binary envelope get the first encoding we support
+                encoding = envelope.negotiate(auth_data.get("encoding"))
+                # Clients that can split batch frames opt in, services decide whether to batch
+                batch = bool(auth_data.get("batch", False))
+            resume_token = secrets.token_urlsafe(16)
+            reply = {
                 "type": "auth_success",
-                "message": "Authentication successful"
-            }))
-            
-            return True
+                "message": "Authentication successful",
+                "resume_token": resume_token,
+                "resume_grace_s": RESUME_GRACE_S
+            }
+            if resumed is not None:
+                reply["resumed"] = True
+            if encoding:
+                reply["encoding"] = encoding
+                reply["services"] = {name: self._service_id(name) for name in self.backend_services}
+            if batch:
+                reply["batch"] = True
+
+            # Send authentication success
+            try:
+                await websocket.send(json.dumps(reply))
+            except websockets.exceptions.ConnectionClosed:
+                if resumed is not None:
+                    # Still resumable from the next connection until it expires
+                    self._return_detached_session(resumed)
+                raise
+
+            return {"encoding": encoding, "batch": batch, "resume_token": resume_token, "resumed": resumed}
             
         except asyncio.TimeoutError:
             logger.error("Authentication timeout")
-            return False
+            self.metrics.auth_failures += 1
+            return None
         except Exception as e:
             logger.error(f"Authentication error for {connection_id}: {e}")
-            return False
+            self.metrics.auth_failures += 1
+            return None
 
     async def _handle_connection(self, websocket, connection_id: str, connection_type: ConnectionType):
         """Handle incoming connection (WebSocket or Signaling)"""
-        # Authenticate the connection
-        if not await self._authenticate_connection(websocket, connection_id, connection_type):
-            logger.warning(f"Authentication failed for connection {connection_id}")
-            # if connection_type == ConnectionType.WEBSOCKET:
-            #     await websocket.close(code=1008, reason="Authentication failed")
+        # The signaling server carries one app after another over the same socket, each authenticates
+        while True:
+            # Authenticate the connection
+            session = await self._authenticate_connection(websocket, connection_id, connection_type)
+            if session is None:
+                logger.warning(f"Authentication failed for connection {connection_id}")
+                # if connection_type == ConnectionType.WEBSOCKET:
+                #     await websocket.close(code=1008, reason="Authentication failed")
+                return
+            
+            logger.info(f"Connection {connection_id} authenticated successfully")
+            self._attach_session(websocket, connection_id, connection_type, session)
+            if not await self._relay_client_messages(websocket, connection_id, connection_type):
+                return
+            logger.info(f"Connection {connection_id} closed, reported by signaling server")
+            self._cleanup_connection(connection_id)
+
+    def _attach_session(self, websocket, connection_id: str, connection_type: ConnectionType, session: dict):
+        """Store a freshly authenticated connection, or move a resumed session onto it"""
+        # A new app on the signaling socket replaces the one that left, it doesn't inherit its topics
+        stale = self.detached_connections.get(connection_id)
+        if stale is not None and stale is not session["resumed"]:
+            self._expire_session(connection_id)
+
+        resumed = session["resumed"]
+        if resumed is None:
+            # Store connection info
+            self.active_connections[connection_id] = {
+                "websocket": websocket,
+                "type": connection_type,
+                "authenticated": True,
+                "topics": set(),
+                "encoding": session["encoding"],
+                "batch": session["batch"],
+                "queues": {},
+                "resume_token": session["resume_token"]
+            }
             return
-        
-        logger.info(f"Connection {connection_id} authenticated successfully")
-        
-        # Store connection info
-        self.active_connections[connection_id] = {
-            "websocket": websocket,
-            "type": connection_type,
-            "authenticated": True,
-            "backend_connection": None
-        }
-        
-        # Handle messages
+
+        old_id = resumed.pop("connection_id")
+        resumed["expiry"].cancel()
+        self.metrics.session_recover.observe(time.perf_counter() - resumed.pop("detached_at"))
+        del resumed["expiry"]
+        resumed["detached"] = False
+        resumed["websocket"] = websocket
+        resumed["type"] = connection_type
+        resumed["resume_token"] = session["resume_token"]
+        if old_id != connection_id:
+            for topic in resumed["topics"]:
+                subscribers = self.subscriptions.setdefault(topic, set())
+                subscribers.discard(old_id)
+                subscribers.add(connection_id)
+            for service_name, owner in self.session_owners.items():
+                if owner == old_id:
+                    self.session_owners[service_name] = connection_id
+        self.active_connections[connection_id] = resumed
+        for service_name, queue in list(resumed["queues"].items()):
+            backend_service = self.backend_services.get(service_name)
+            if backend_service is None:
+                queue.close()
+                del resumed["queues"][service_name]
+                continue
+            self._start_writer(connection_id, resumed, queue, backend_service)
+        logger.info(f"Resumed session of {old_id} on {connection_id}")
+
+    async def _relay_client_messages(self, websocket, connection_id: str, connection_type: ConnectionType) -> bool:
+        """Route a connection's messages until it closes, True if the signaling server reports the app left"""
         try:
             async for message in websocket:
-                data = json.loads(message)
-                logger.info(f"Received message: {data}")
-                if(data.get("type") == "connection_closed"):
-                    logger.info(f"Connection {connection_id} closed, reported by signaling server")
-                    self.active_connections[connection_id] = {
-                        "websocket": websocket,
-                        "type": connection_type,
-                        "authenticated": False,
-                        "backend_connection": None
-                    }
-                    await self._handle_connection(websocket, connection_id, ConnectionType.SIGNALING)
-                    return
+                # Only the signaling server reports closed apps, don't parse anything else for it
+                if connection_type == ConnectionType.SIGNALING and isinstance(message, str) \
+                        and "connection_closed" in message and is_close_notice(message):
+                    return True
                 await self._handle_message(connection_id, message)
         except websockets.exceptions.ConnectionClosed:
             logger.info(f"Connection {connection_id} closed")
         except Exception as e:
             logger.error(f"Error handling connection {connection_id}: {e}")
-    
+        return False
+
     async def _handle_message(self, connection_id: str, message: str):
         """Handle incoming message from authenticated connection"""
-        logger.info(f"Received message: {message}")
+        received_at = time.perf_counter()
         connection_info = self.active_connections.get(connection_id)
         if not connection_info:
             logger.error(f"No connection info found for {connection_id}")
             return
-        
-        websocket = connection_info["websocket"]
-        
+
+        encoding = connection_info.get("encoding")
+        if encoding and isinstance(message, bytes):
+            # Binary envelope: only the payload goes to the backend
+            try:
+                service, _, message = envelope.unpack(encoding, message)
+            except Exception as e:
+                logger.error(f"Invalid {encoding} envelope from {connection_id}: {e}")
+                return
+            service_name = self.service_names.get(service) if isinstance(service, int) else service
+        else:
+            service_name = extract_service(message)
+        if service_name is None:
+            logger.error(f"Message without service from {connection_id}")
+            return
+        if service_name == GATEWAY_SERVICE:
+            await self._handle_gateway_message(connection_id, message)
+            return
+
+        self.routed_messages += 1
+        if self.routed_messages % LOG_SAMPLE_EVERY == 0 and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Routed {self.routed_messages} messages, sample for {service_name}: {message[:200]!r}")
+
+        if not await self._handle_service_routing(connection_id, service_name, message):
+            return
+        counters = self.metrics.service(service_name)
+        counters.messages_to_backend += 1
+        counters.bytes_to_backend += len(message)
+        counters.route_latency.observe(time.perf_counter() - received_at)
+
+    async def _handle_gateway_message(self, connection_id: str, message):
+        """Handle {"service": "gateway", "type": "subscribe" | "unsubscribe", "topics": [...]}"""
         try:
             data = json.loads(message)
         except json.JSONDecodeError:
-            await self._send_error(websocket, "Invalid message format")
+            logger.error(f"Invalid gateway message from {connection_id}")
             return
-        
-        message_type = data.get("type")
-    
-        await self._handle_service_routing(connection_id, data)
+        topics = data.get("topics", [])
+        if data.get("type") == "subscribe":
+            for topic in topics:
+                self._subscribe(connection_id, topic)
+            # Viewers may only listen, make sure the backend is connected so they start receiving
+            for topic in topics:
+                if topic in self.backend_services:
+                    self._start_backend(self.backend_services[topic])
+        elif data.get("type") == "unsubscribe":
+            for topic in topics:
+                self._unsubscribe(connection_id, topic)
+        else:
+            logger.error(f"Unknown gateway message type: {data.get('type')}")
 
-    async def _handle_service_routing(self, connection_id: str, data: dict):
-        """Route message to specific backend service"""
-        service_name = data.get("service")
-        
-        if service_name not in self.backend_services:
-            connection_info = self.active_connections[connection_id]
-            logger.error(f"Unknown service: {service_name}")
+    def _subscribe(self, connection_id: str, topic: str):
+        connection_info = self.active_connections.get(connection_id)
+        if connection_info is None or topic in connection_info["topics"]:
             return
-        
-        backend_service = self.backend_services[service_name]
-        
-        try:
-            # Connect to backend service if not already connected
-            await self._ensure_backend_connection(connection_id, backend_service)
-            
-            # Forward message to backend
+        connection_info["topics"].add(topic)
+        self.subscriptions.setdefault(topic, set()).add(connection_id)
+
+    def _unsubscribe(self, connection_id: str, topic: str):
+        connection_info = self.active_connections.get(connection_id)
+        if connection_info is not None:
+            connection_info["topics"].discard(topic)
+        subscribers = self.subscriptions.get(topic)
+        if subscribers is not None:
+            subscribers.discard(connection_id)
+
+    async def _handle_service_routing(self, connection_id: str, service_name: str, message) -> bool:
+        """Route message to specific backend service, the frame is forwarded untouched.
+
+        Returns False if the service is unknown or the message can't go to it, so
+        metrics only ever see registered services.
+        """
+        backend_service = self.backend_services.get(service_name)
+        if backend_service is None:
+            logger.error(f"Unknown service: {service_name}")
+            return False
+
+        if backend_service.mode == "request":
+            message = self._track_request(connection_id, service_name, message)
+            if message is None:
+                logger.error(f"Request to {service_name} from {connection_id} is not a JSON object")
+                return False
+        else:
+            # Sending to a service subscribes to its replies
             connection_info = self.active_connections[connection_id]
-            backend_ws = connection_info["backend_connection"]
-            
-            if backend_ws:
-                await backend_ws.send(json.dumps(data))
-                logger.info(f"Forwarded message from {connection_id} to {service_name}")
-            
+            if service_name not in connection_info["topics"]:
+                self._subscribe(connection_id, service_name)
+        if backend_service.mode == "session" and self.session_owners.get(service_name) != connection_id:
+            previous = self.session_owners.get(service_name)
+            if previous is not None:
+                logger.info(f"{connection_id} takes over {service_name} session from {previous}")
+            self.session_owners[service_name] = connection_id
+
+        backend_ws = self.backend_pool.get(service_name)
+        if backend_ws is None:
+            if not backend_service.accepts_messages:
+                logger.error(f"Service {service_name} only streams, dropping message")
+                return False
+            self._hold_message(backend_service, message)
+            return True
+        try:
+            await backend_ws.send(message)
+        except websockets.exceptions.ConnectionClosed:
+            # The connection task notices too and reconnects, the message goes out after
+            self._hold_message(backend_service, message)
         except Exception as e:
             logger.error(f"Error routing to service {service_name}: {e}")
-    
-    async def _ensure_backend_connection(self, connection_id: str, backend_service: BackendService):
-        """Ensure connection to backend service exists"""
-        connection_info = self.active_connections[connection_id]
-        
-        if connection_info["backend_connection"] is None:
+        return True
+
+    def _track_request(self, connection_id: str, service_name: str, message):
+        """Tag a request with a new id and remember who sent it, None if it can't be tagged"""
+        self.request_ids += 1
+        tagged = tag_request(message, self.request_ids)
+        if tagged is None:
+            return None
+        pending = self.pending_requests.setdefault(service_name, collections.OrderedDict())
+        if len(pending) >= PENDING_REQUESTS:
+            pending.popitem(last=False)
+        pending[self.request_ids] = connection_id
+        return tagged
+
+    def _request_owner(self, service_name: str, message) -> Optional[str]:
+        """Connection waiting for a reply, found by the request id it echoes"""
+        text = message.decode("utf-8", errors="replace") if isinstance(message, bytes) else message
+        match = REQUEST_ID.search(text)
+        if match is None:
+            return None
+        return self.pending_requests.get(service_name, {}).pop(int(match.group(1)), None)
+
+    def run_in_background(self, coro) -> asyncio.Task:
+        """Start a task nobody awaits, keeping a reference so it isn't collected while running"""
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    def start_backends(self):
+        """Open a pooled connection to every registered backend"""
+        for backend_service in self.backend_services.values():
+            self._start_backend(backend_service)
+
+    def _start_backend(self, backend_service: BackendService):
+        name = backend_service.name
+        if backend_service.transport == "shm":
+            task = self.shm_tasks.get(name)
+            if task is None or task.done():
+                self.shm_tasks[name] = asyncio.create_task(self._read_shm_ring(backend_service))
+        if not backend_service.accepts_messages or self._local_closed(backend_service):
+            return
+        task = self.backend_tasks.get(name)
+        if task is None or task.done():
+            self.backend_tasks[name] = asyncio.create_task(self._maintain_backend(backend_service))
+
+    async def _start_registry(self):
+        """Serve service registrations on REGISTRY_SOCKET"""
+        os.makedirs(os.path.dirname(REGISTRY_SOCKET), mode=0o700, exist_ok=True)
+        if os.path.exists(REGISTRY_SOCKET):
+            os.unlink(REGISTRY_SOCKET)
+        server = await websockets.unix_serve(self._handle_registration, REGISTRY_SOCKET,
+                                             process_request=self._check_registry_peer)
+        os.chmod(REGISTRY_SOCKET, 0o600)
+        logger.info(f"Service registry listening on {REGISTRY_SOCKET}")
+        await server.wait_closed()
+
+    @staticmethod
+    def _check_registry_peer(connection, request):
+        """Turn away registry clients running as another user, unless listed in GATEWAY_REGISTRY_UIDS"""
+        sock = connection.transport.get_extra_info("socket")
+        _, uid, _ = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+        if uid in (os.getuid(), 0) or uid in REGISTRY_UIDS:
+            return None
+        logger.error(f"Refused service registration from uid {uid}")
+        return connection.respond(403, "Not allowed to register services\n")
+
+    async def _handle_registration(self, websocket):
+        """Register services for as long as the registering program keeps this connection open.
+
+        {"type": "register", "service": "joint_states", "transport": "shm", "shm_name": "joint_states"}
+        {"type": "register", "service": "arm", "transport": "unix", "path": "/tmp/arm.sock", "queue_policy": "reliable"}
+        """
+        # Name -> service this connection registered
+        registered: Dict[str, BackendService] = {}
+        try:
+            async for message in websocket:
+                try:
+                    data = json.loads(message)
+                    if data.get("type") == "unregister":
+                        if data["service"] not in registered:
+                            raise ValueError(f"{data['service']} was not registered on this connection")
+                        self._unregister_from_registry(registered.pop(data["service"]))
+                        await websocket.send(json.dumps({"type": "unregistered", "service": data["service"]}))
+                        continue
+                    if data.get("type") != "register":
+                        raise ValueError(f"unknown registry message type {data.get('type')}")
+                    backend_service = BackendService(
+                        host=data.get("host", "localhost"),
+                        port=data.get("port", 0),
+                        name=data["service"],
+                        mode=data.get("mode", "shared"),
+                        queue_policy=data.get("queue_policy", "drop_oldest"),
+                        queue_size=data.get("queue_size", OUTBOUND_QUEUE_SIZE),
+                        transport=data.get("transport", "tcp"),
+                        path=data.get("path"),
+                        shm_name=data.get("shm_name"),
+                        batch_ms=data.get("batch_ms", 0),
+                        batch_bytes=data.get("batch_bytes", BATCH_MAX_BYTES),
+                    )
+                    current = self.backend_services.get(backend_service.name)
+                    if current is not None and self.registry_services.get(backend_service.name) is not current:
+                        raise ValueError(f"{backend_service.name} is configured on the gateway and can't be replaced")
+                    self.register_service(backend_service)
+                    self.registry_services[backend_service.name] = backend_service
+                except (json.JSONDecodeError, KeyError, ValueError) as e:
+                    await websocket.send(json.dumps({"type": "error", "message": f"Invalid registration: {e}"}))
+                    continue
+                registered[backend_service.name] = backend_service
+                await websocket.send(json.dumps({"type": "registered", "service": backend_service.name,
+                                                 "id": self._service_id(backend_service.name)}))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            for backend_service in registered.values():
+                self._unregister_from_registry(backend_service)
+
+    def _unregister_from_registry(self, backend_service: BackendService):
+        """Remove a registry service, unless another registration has replaced it since"""
+        name = backend_service.name
+        if self.registry_services.get(name) is backend_service:
+            del self.registry_services[name]
+        if self.backend_services.get(name) is backend_service:
+            self.unregister_service(name)
+
+    def register_service(self, backend_service: BackendService):
+        """Add or replace a backend and connect to it"""
+        if backend_service.transport not in TRANSPORTS:
+            raise ValueError(f"unknown transport {backend_service.transport}")
+        if backend_service.mode not in MODES:
+            raise ValueError(f"unknown mode {backend_service.mode}")
+        if backend_service.queue_policy not in QUEUE_POLICIES:
+            raise ValueError(f"unknown queue policy {backend_service.queue_policy}")
+        if backend_service.transport == "unix" and not backend_service.path:
+            raise ValueError("unix transport needs a path")
+        if backend_service.transport == "shm" and not backend_service.shm_name:
+            raise ValueError("shm transport needs a shm_name")
+        if backend_service.transport == "local" and backend_service.connection is None:
+            raise ValueError("local transport needs a connection")
+        if backend_service.name in self.backend_services:
+            self.unregister_service(backend_service.name)
+        self.backend_services[backend_service.name] = backend_service
+        self._service_id(backend_service.name)
+        logger.info(f"Registered service {backend_service.name} ({backend_service.transport} {backend_service.address})")
+        self._start_backend(backend_service)
+
+    def unregister_service(self, service_name: str):
+        """Remove a backend, closing its connection and dropping held messages"""
+        if self.backend_services.pop(service_name, None) is None:
+            return
+        for tasks in (self.backend_tasks, self.shm_tasks):
+            task = tasks.pop(service_name, None)
+            if task is not None:
+                task.cancel()
+        backend_ws = self.backend_pool.pop(service_name, None)
+        if backend_ws is not None:
+            self.run_in_background(backend_ws.close())
+        self.pending_messages.pop(service_name, None)
+        self.session_owners.pop(service_name, None)
+        self.pending_requests.pop(service_name, None)
+        logger.info(f"Unregistered service {service_name}")
+
+    async def _read_shm_ring(self, backend_service: BackendService):
+        """Poll a service's shared-memory ring and fan its records out like backend messages"""
+        name = backend_service.name
+        ring = None
+        try:
+            while ring is None:
+                try:
+                    ring = ShmRing.attach(backend_service.shm_name)
+                except FileNotFoundError:
+                    await asyncio.sleep(RECONNECT_BACKOFF_MAX)
+            logger.info(f"Reading shared-memory ring {backend_service.shm_name} for {name}")
+            while True:
+                records = ring.read(SHM_READ_BATCH)
+                if not records:
+                    await asyncio.sleep(SHM_POLL_INTERVAL)
+                    continue
+                for record in records:
+                    self.backend_messages += 1
+                    # Apps get text frames, the same as from a WebSocket backend
+                    await self._fan_out(name, record.decode("utf-8", errors="replace"))
+        finally:
+            if ring is not None:
+                ring.close()
+
+    def _hold_message(self, backend_service: BackendService, message):
+        """Keep a message until the backend is back, dropping the oldest past PENDING_QUEUE_SIZE"""
+        # Backends are normally connected at start, this covers gateways that skipped start()
+        self._start_backend(backend_service)
+        pending = self.pending_messages.setdefault(backend_service.name, collections.deque())
+        metrics = self._backend_metrics(backend_service.name)
+        if len(pending) >= PENDING_QUEUE_SIZE:
+            pending.popleft()
+            metrics["pending_dropped"] += 1
+        pending.append(message)
+
+    def _backend_metrics(self, service_name: str) -> dict:
+        metrics = self.backend_metrics.get(service_name)
+        if metrics is None:
+            metrics = self.backend_metrics[service_name] = {
+                "connected": False,
+                "connects": 0,
+                "connect_failures": 0,
+                "connect_ms_last": None,
+                "connect_ms_max": None,
+                "reconnects": 0,
+                "reconnect_ms_last": None,
+                "reconnect_ms_max": None,
+                "pending_dropped": 0,
+            }
+        return metrics
+
+    async def _maintain_backend(self, backend_service: BackendService):
+        """Keep the pooled connection of one backend up, reconnecting with jittered backoff"""
+        name = backend_service.name
+        metrics = self._backend_metrics(name)
+        attempt = 0
+        lost_at = None
+        while True:
+            if self._local_closed(backend_service):
+                # Closed for good, nothing to reconnect to
+                logger.info(f"Local service {name} was closed, no longer connecting to it")
+                self.pending_messages.pop(name, None)
+                return
+            started = time.perf_counter()
             try:
-                backend_url = f"ws://{backend_service.address}"
-                backend_ws = await websockets.connect(backend_url)
-                connection_info["backend_connection"] = backend_ws
-                
-                logger.info(f"Connected to backend service {backend_service.name} at {backend_service.address}")
-                
-                # Start listening for backend messages
-                asyncio.create_task(self._handle_backend_messages(connection_id, backend_ws))
-                
+                # websockets pings the backend and closes the connection if it stops answering
+                backend_ws = await self._connect_backend(backend_service)
             except Exception as e:
-                logger.error(f"Failed to connect to backend {backend_service.name}: {e}")
-                raise
-    
-    async def _handle_backend_messages(self, connection_id: str, backend_ws):
-        """Handle messages from backend service"""
+                metrics["connect_failures"] += 1
+                if attempt == 0:
+                    logger.error(f"Failed to connect to backend {name}: {e}")
+                # Full jitter keeps retries from lining up with the backend's restart
+                delay = random.uniform(0, min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF_MIN * 2 ** attempt))
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+
+            connect_ms = (time.perf_counter() - started) * 1000
+            metrics["connects"] += 1
+            metrics["connect_ms_last"] = connect_ms
+            metrics["connect_ms_max"] = max(metrics["connect_ms_max"] or 0, connect_ms)
+            if lost_at is not None:
+                reconnect_ms = (time.perf_counter() - lost_at) * 1000
+                metrics["reconnects"] += 1
+                metrics["reconnect_ms_last"] = reconnect_ms
+                metrics["reconnect_ms_max"] = max(metrics["reconnect_ms_max"] or 0, reconnect_ms)
+                logger.info(f"Reconnected to backend {name} after {reconnect_ms:.0f} ms")
+            else:
+                logger.info(f"Connected to backend service {name} at {backend_service.address} in {connect_ms:.1f} ms")
+            attempt = 0
+
+            try:
+                # Held messages go first, new ones keep being held until the pool has the connection
+                pending = self.pending_messages.get(name)
+                while pending:
+                    # Taken off first, _hold_message may drop the oldest while the send waits
+                    message = pending.popleft()
+                    try:
+                        await backend_ws.send(message)
+                    except BaseException:
+                        if len(pending) < PENDING_QUEUE_SIZE:
+                            pending.appendleft(message)
+                        else:
+                            metrics["pending_dropped"] += 1
+                        raise
+                self.backend_pool[name] = backend_ws
+                metrics["connected"] = True
+                await self._handle_backend_messages(backend_ws, name)
+            except websockets.exceptions.ConnectionClosed:
+                pass
+            finally:
+                if self.backend_pool.get(name) is backend_ws:
+                    del self.backend_pool[name]
+                metrics["connected"] = False
+            lost_at = time.perf_counter()
+            if not self._local_closed(backend_service):
+                logger.warning(f"Lost backend {name}, reconnecting")
+
+    @staticmethod
+    def _local_closed(backend_service: BackendService) -> bool:
+        return backend_service.transport == "local" and backend_service.connection.closed
+
+    async def _connect_backend(self, backend_service: BackendService):
+        if backend_service.transport == "local":
+            if backend_service.connection.closed:
+                raise ConnectionError(f"local service {backend_service.name} was closed")
+            return backend_service.connection
+        if backend_service.transport == "tcp":
+            return await websockets.connect(f"ws://{backend_service.address}", ping_interval=BACKEND_PING_INTERVAL,
+                                            ping_timeout=BACKEND_PING_TIMEOUT)
+        return await websockets.unix_connect(backend_service.path, ping_interval=BACKEND_PING_INTERVAL,
+                                             ping_timeout=BACKEND_PING_TIMEOUT)
+
+    def backend_stats(self) -> dict:
+        """Connection, reconnect latency and pending queue metrics per backend"""
+        stats = {}
+        for name, metrics in self.backend_metrics.items():
+            stats[name] = dict(metrics, pending=len(self.pending_messages.get(name, ())))
+        return stats
+
+    async def _handle_backend_messages(self, backend_ws, service_name: str):
+        """Fan out messages from a pooled backend connection to its subscribers"""
         try:
             async for message in backend_ws:
-                logger.info(f"Received message from backend: {message}")
-                connection_info = self.active_connections.get(connection_id)
-                if connection_info:
-                    client_ws = connection_info["websocket"]
-                    await client_ws.send(message)
-                else:
-                    # Client disconnected, close backend connection
-                    await backend_ws.close()
-                    break
+                self.backend_messages += 1
+                if self.backend_messages % LOG_SAMPLE_EVERY == 0 and logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Relayed {self.backend_messages} backend messages, sample: {message[:200]!r}")
+                await self._fan_out(service_name, message)
         except websockets.exceptions.ConnectionClosed:
-            logger.info(f"Backend connection closed for client {connection_id}")
+            logger.info(f"Backend connection to {service_name} closed")
         except Exception as e:
-            logger.error(f"Error handling backend messages for {connection_id}: {e}")
-    
+            logger.error(f"Error handling backend messages for {service_name}: {e}")
+
+    async def _fan_out(self, service_name: str, message):
+        """Queue one backend message for every subscriber, encoding it once per client encoding"""
+        backend_service = self.backend_services.get(service_name)
+        if backend_service is None:
+            return
+        started = time.perf_counter()
+        counters = self.metrics.service(service_name)
+        counters.messages_to_apps += 1
+        counters.bytes_to_apps += len(message)
+        if backend_service.mode == "session":
+            owner = self.session_owners.get(service_name)
+            recipients = [owner] if owner is not None else []
+        elif backend_service.mode == "request":
+            owner = self._request_owner(service_name, message)
+            recipients = [owner] if owner is not None else []
+        else:
+            recipients = list(self.subscriptions.get(service_name, ()))
+        if not recipients:
+            return
+        key = message_type(message) if backend_service.queue_policy == "latest" else None
+        seq = self.fanout_seq[service_name] = self.fanout_seq.get(service_name, 0) + 1
+        frames = {}
+        for connection_id in recipients:
+            # Apps that went away keep queueing until their session expires
+            connection_info = self.active_connections.get(connection_id) or self.detached_connections.get(connection_id)
+            if connection_info is None:
+                continue
+            encoding = connection_info["encoding"]
+            frame = frames.get(encoding)
+            if frame is None:
+                frame = frames[encoding] = envelope.pack(encoding, self._service_id(service_name), seq, message) \
+                    if encoding else message
+            queue = self._outbound_queue(connection_id, connection_info, backend_service)
+            if not queue.offer(frame, key):
+                # Reliable and full: hold the backend reader until this client catches up
+                await queue.put(frame, key)
+        counters.fanout_latency.observe(time.perf_counter() - started)
+
+    def _outbound_queue(self, connection_id: str, connection_info: dict, backend_service: BackendService) -> OutboundQueue:
+        queue = connection_info["queues"].get(backend_service.name)
+        if queue is None:
+            queue = OutboundQueue(backend_service.queue_policy, backend_service.queue_size)
+            connection_info["queues"][backend_service.name] = queue
+            if not connection_info.get("detached"):
+                self._start_writer(connection_id, connection_info, queue, backend_service)
+        return queue
+
+    def _start_writer(self, connection_id: str, connection_info: dict, queue: OutboundQueue,
+                      backend_service: BackendService):
+        if connection_info.get("batch") and backend_service.batch_ms > 0:
+            writer = self._drain_batches(connection_id, connection_info, queue, backend_service)
+        else:
+            writer = self._drain_queue(connection_id, connection_info["websocket"], queue)
+        queue.writer = asyncio.create_task(writer)
+
+    async def _drain_queue(self, connection_id: str, websocket, queue: OutboundQueue):
+        """Send queued frames to one client, a slow client only backs up its own queue"""
+        frames, queue.unsent = queue.unsent, []
+        try:
+            while True:
+                if not frames:
+                    frames = [await queue.get()]
+                await websocket.send(frames[0])
+                frames.pop(0)
+                queue.sent += 1
+        except websockets.exceptions.ConnectionClosed:
+            logger.info(f"Client {connection_id} closed while sending")
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # A dead writer would leave the queue filling up, and a reliable one stalling its backend
+            logger.error(f"Sending to client {connection_id} failed: {e!r}")
+            queue.dropped += len(frames)
+            frames = []
+            queue.close()
+        # Kept for a resumed session, dropped with the queue otherwise
+        queue.unsent = frames
+
+    async def _drain_batches(self, connection_id: str, connection_info: dict, queue: OutboundQueue,
+                             backend_service: BackendService):
+        """Like _drain_queue, but coalesce what arrives within batch_ms into one frame"""
+        websocket = connection_info["websocket"]
+        encoding = connection_info["encoding"]
+        service_id = self._service_id(backend_service.name)
+        window = backend_service.batch_ms / 1000
+        max_bytes = backend_service.batch_bytes
+        loop = asyncio.get_running_loop()
+        frames, queue.unsent = queue.unsent, []
+        try:
+            while True:
+                if not frames:
+                    frames = [await queue.get()]
+                size = self._take_frames(queue, frames, sum(len(f) for f in frames), max_bytes)
+                deadline = loop.time() + window
+                # Keep collecting until the window ends, or sooner once the batch is full
+                while size < max_bytes and loop.time() < deadline:
+                    queue.ready.clear()
+                    try:
+                        await asyncio.wait_for(queue.ready.wait(), deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        pass
+                    size = self._take_frames(queue, frames, size, max_bytes)
+                while frames:
+                    # Without the envelope only JSON text can be inlined, anything else goes alone
+                    count = len(frames) if encoding else self._json_run(frames)
+                    if count == 1:
+                        await websocket.send(frames[0])
+                    elif encoding:
+                        await websocket.send(envelope.pack_batch(encoding, service_id, frames[:count]))
+                    else:
+                        await websocket.send(self._json_batch(backend_service.name, frames[:count]))
+                    del frames[:count]
+                    queue.sent += count
+                    queue.batches += 1
+        except websockets.exceptions.ConnectionClosed:
+            logger.info(f"Client {connection_id} closed while sending")
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # A dead writer would leave the queue filling up, and a reliable one stalling its backend
+            logger.error(f"Sending to client {connection_id} failed: {e!r}")
+            queue.dropped += len(frames)
+            frames = []
+            queue.close()
+        queue.unsent = frames
+
+    @staticmethod
+    def _take_frames(queue: OutboundQueue, frames: list, size: int, max_bytes: int) -> int:
+        """Move queued frames into a batch until it reaches max_bytes, returns the batch size"""
+        while size < max_bytes:
+            frame = queue.get_nowait()
+            if frame is None:
+                break
+            frames.append(frame)
+            size += len(frame)
+        return size
+
+    @staticmethod
+    def _json_run(frames: list) -> int:
+        """How many frames from the start can share one JSON batch, at least one"""
+        count = 0
+        for frame in frames:
+            if not json_inlinable(frame):
+                break
+            count += 1
+        return max(count, 1)
+
+    @staticmethod
+    def _json_batch(service_name: str, frames: list) -> str:
+        """{"type": "batch", "service": ..., "messages": [...]} of JSON text frames, inlined as they are"""
+        messages = ",".join(frames)
+        return f'{{"type": "batch", "service": {json.dumps(service_name)}, "messages": [{messages}]}}'
+
+    def queue_stats(self) -> dict:
+        """Depth and drop counters of every outbound queue"""
+        queues = {}
+        dropped = self.retired_drops
+        # Detached sessions keep queueing until they are resumed or expire
+        for connection_id, connection_info in [*self.active_connections.items(), *self.detached_connections.items()]:
+            for service_name, queue in connection_info.get("queues", {}).items():
+                queues.setdefault(connection_id, {})[service_name] = queue.stats()
+                dropped += queue.dropped
+        return {"queues": queues, "dropped_total": dropped}
+
+    def _release_connection(self, connection_id: str, connection_info: dict):
+        """Drop a client's subscriptions and queues and hang up sessions it owns"""
+        for topic in list(connection_info.get("topics", ())):
+            self._unsubscribe(connection_id, topic)
+        for queue in connection_info.get("queues", {}).values():
+            queue.close()
+            if queue.writer is not None:
+                queue.writer.cancel()
+            self.retired_drops += queue.dropped + len(queue.unsent)
+        connection_info["queues"] = {}
+        for service_name, owner in list(self.session_owners.items()):
+            if owner != connection_id:
+                continue
+            del self.session_owners[service_name]
+            backend_ws = self.backend_pool.get(service_name)
+            if backend_ws is not None:
+                self.run_in_background(self._send_hangup(backend_ws, service_name, connection_id))
+
+    async def _send_hangup(self, backend_ws, service_name: str, connection_id: str):
+        try:
+            await backend_ws.send(json.dumps({"type": "Hangup"}))
+            logger.info(f"Hung up {service_name} session of {connection_id}")
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
     def _cleanup_connection(self, connection_id: str):
-        """Clean up connection resources"""
-        if connection_id in self.active_connections:
-            connection_info = self.active_connections[connection_id]
-            backend_connection = connection_info.get("backend_connection")
-            
-            if backend_connection:
-                asyncio.create_task(backend_connection.close())
-            
-            del self.active_connections[connection_id]
+        """Detach a closed connection, pooled backend connections stay open.
+
+        Subscriptions, queues and owned sessions are kept for RESUME_GRACE_S so the app
+        can resume after a restart or a Wi-Fi blip, then released.
+        """
+        connection_info = self.active_connections.pop(connection_id, None)
+        if connection_info is None:
+            return
+        if not RESUME_GRACE_S or not connection_info.get("resume_token"):
+            self._release_connection(connection_id, connection_info)
             logger.info(f"Cleaned up connection {connection_id}")
+            return
+        for queue in connection_info["queues"].values():
+            if queue.writer is not None:
+                queue.writer.cancel()
+                queue.writer = None
+        connection_info["detached"] = True
+        connection_info["detached_at"] = time.perf_counter()
+        connection_info["expiry"] = asyncio.get_running_loop().call_later(
+            RESUME_GRACE_S, self._expire_session, connection_id)
+        self.detached_connections[connection_id] = connection_info
+        self.resume_tokens[connection_info["resume_token"]] = connection_id
+        logger.info(f"Connection {connection_id} detached, resumable for {RESUME_GRACE_S:g} s")
+
+    def _take_detached_session(self, resume_token) -> Optional[dict]:
+        """Claim the detached session of a resume token, None if unknown or expired"""
+        connection_id = self.resume_tokens.pop(resume_token, None) if isinstance(resume_token, str) else None
+        if connection_id is None:
+            return None
+        connection_info = self.detached_connections.pop(connection_id)
+        connection_info["connection_id"] = connection_id
+        return connection_info
+
+    def _return_detached_session(self, connection_info: dict):
+        """Put back a session whose resume failed, for what is left of its grace window"""
+        connection_id = connection_info.pop("connection_id")
+        self.detached_connections[connection_id] = connection_info
+        self.resume_tokens[connection_info["resume_token"]] = connection_id
+        # The expiry may have fired while the session was taken, and found nothing to expire
+        connection_info["expiry"].cancel()
+        remaining = RESUME_GRACE_S - (time.perf_counter() - connection_info["detached_at"])
+        if remaining <= 0:
+            self._expire_session(connection_id)
+            return
+        connection_info["expiry"] = asyncio.get_running_loop().call_later(
+            remaining, self._expire_session, connection_id)
+
+    def _expire_session(self, connection_id: str):
+        connection_info = self.detached_connections.pop(connection_id, None)
+        if connection_info is None:
+            return
+        connection_info["expiry"].cancel()
+        self.resume_tokens.pop(connection_info["resume_token"], None)
+        self._release_connection(connection_id, connection_info)
+        self.metrics.sessions_expired += 1
+        logger.info(f"Session of {connection_id} expired")
     
+async def run_video_in_process(gateway: GatewayProxy):
+    """Serve video from stream.py's WebRTCServer on the gateway's loop.
+
+    SDP and ICE then skip the localhost WebSocket to port 8765. Pipeline setup runs on
+    this loop too, so other services wait while a Negotiate builds the pipeline.
+    """
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "gstreamer"))
+    import stream
+
+    loop = asyncio.get_running_loop()
+    server = stream.WebRTCServer(loop)
+    connection = LocalConnection(server.handle_client_message)
+    server.ws = connection.peer
+    gateway.register_service(BackendService("localhost", 0, "video", mode="session", queue_policy="reliable",
+                                            transport="local", connection=connection))
+    gateway.run_in_background(stream.glib_main_loop_iteration())
+    # Snapshots come from the same pipeline, the snapshot service still connects over localhost
+    await websockets.serve(server.snapshot_handler, "0.0.0.0", stream.SNAPSHOT_PORT)
+    server.profiler.listening()
+    if stream.WARM_START:
+        loop.run_in_executor(None, stream.preload_factories, stream.WARM_FACTORIES)
+    return server
+
+
 # Example usage
 async def main():
     # Create gateway proxy
@@ -295,6 +1325,8 @@ async def main():
         signaling_server_url="wss://6e2ea1cfc65c.ngrok-free.app",
         websocket_port=8080
     )
+    if INPROCESS_VIDEO:
+        await run_video_in_process(gateway)
     
     try:
         await gateway.start()
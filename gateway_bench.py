@@ -0,0 +1,613 @@
+#!/usr/bin/env python3
+"""Routing benchmark for gateway.py.
+
+Runs a gateway in a child process with its backend pointed at an in-process sink, then
+drives telemetry-like messages through a direct WebSocket client. Reports routed
+messages/s, gateway CPU per message (from /proc) and client -> backend latency.
+
+    python gateway_bench.py --messages 20000 --rate 500
+    git show <old commit>:gateway.py > /tmp/gateway_old.py
+    python gateway_bench.py --gateway /tmp/gateway_old.py     # before/after comparison
+
+--stream measures the other direction, a local service streaming to a subscribed app,
+over each backend transport:
+
+    python gateway_bench.py --stream --transport shm --rate 1000
+
+--negotiation times WebRTC offer/answer round trips against a stand-in video service,
+served on its own WebSocket (tcp, like stream.py) or inside the gateway (local):
+
+    python gateway_bench.py --negotiation --transport local
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+
+import websockets
+
+import envelope
+from shm_ring import ShmRing
+
+AUTH_TOKEN = "bench-token"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_cpu_seconds(pid):
+    """utime + stime of a process from /proc, in seconds"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q / 100 * len(values)), len(values) - 1)] if values else None
+
+
+def run_gateway(module_path, port, backends, registry=None, backend_options=None, setup=None):
+    """Child process: import a gateway.py and serve direct connections only"""
+    os.environ["AUTH_TOKEN"] = AUTH_TOKEN
+    if registry:
+        os.environ["GATEWAY_REGISTRY_SOCKET"] = registry
+    spec = importlib.util.spec_from_file_location("bench_gateway", module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # Logs go nowhere but are still formatted, like journald on the robot
+    logging.getLogger().handlers = [logging.NullHandler()]
+    gateway = module.GatewayProxy(signaling_server_url="ws://127.0.0.1:9", websocket_port=port)
+    for name, backend_port in backends.items():
+        gateway.backend_services[name] = module.BackendService("127.0.0.1", backend_port, name)
+        for option, value in (backend_options or {}).items():
+            setattr(gateway.backend_services[name], option, value)
+    asyncio.run(serve_gateway(gateway, (lambda: setup(gateway, module)) if setup else None))
+
+
+async def serve_gateway(gateway, setup=None):
+    if setup is not None:
+        setup()
+    # Older gateways connect to backends lazily
+    if hasattr(gateway, "start_backends"):
+        gateway.start_backends()
+    if hasattr(gateway, "_start_registry"):
+        await asyncio.gather(gateway._start_websocket_server(), gateway._start_registry())
+    else:
+        await gateway._start_websocket_server()
+
+
+class BackendSink:
+    """Stand-in backend service recording when each benchmark message arrives"""
+
+    def __init__(self, echo=False):
+        self.received = 0
+        self.latencies = []
+        self.done = asyncio.Event()
+        self.expected = 0
+        self.connections = 0
+        # Echo every message back so the gateway fans it out to subscribers
+        self.echo = echo
+
+    async def handler(self, ws):
+        self.connections += 1
+        try:
+            async for message in ws:
+                if self.echo:
+                    await ws.send(message)
+                now = time.perf_counter()
+                data = json.loads(message)
+                if "sent" in data:
+                    self.latencies.append(now - data["sent"])
+                self.received += 1
+                if self.received >= self.expected:
+                    self.done.set()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+async def connect_client(port, encoding=None, batch=False):
+    for _ in range(100):
+        try:
+            ws = await websockets.connect(f"ws://127.0.0.1:{port}")
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+    else:
+        raise RuntimeError("gateway did not start")
+    auth = {"token": AUTH_TOKEN}
+    if encoding:
+        auth["encoding"] = encoding
+    if batch:
+        auth["batch"] = True
+    await ws.send(json.dumps(auth))
+    reply = json.loads(await ws.recv())
+    if reply.get("type") != "auth_success":
+        raise RuntimeError(f"authentication failed: {reply}")
+    if encoding and reply.get("encoding") != encoding:
+        raise RuntimeError(f"gateway did not accept {encoding}: {reply}")
+    return ws, reply.get("services", {})
+
+
+class Viewer:
+    """Client that only subscribes to a topic and counts what the gateway fans out to it"""
+
+    def __init__(self, ws, expected, delay=0):
+        self.ws = ws
+        self.received = 0
+        self.expected = expected
+        self.done = asyncio.Event()
+        # Seconds spent on each message, like an app on a slow link
+        self.delay = delay
+
+    async def listen(self):
+        try:
+            async for _ in self.ws:
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                self.received += 1
+                if self.received >= self.expected:
+                    self.done.set()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+async def wait_quiet(viewers, idle=0.5):
+    """Wait until every viewer has everything or stopped receiving for `idle` seconds"""
+    last = None
+    while viewers and not all(v.done.is_set() for v in viewers):
+        counts = [v.received for v in viewers]
+        if counts == last:
+            return
+        last = counts
+        await asyncio.sleep(idle)
+
+
+async def bench(args):
+    sink = BackendSink(echo=args.viewers > 0 or args.slow_viewer_ms > 0)
+    sink.expected = args.messages
+    backend_port = free_port()
+    gateway_port = free_port()
+    async with websockets.serve(sink.handler, "127.0.0.1", backend_port):
+        proc = multiprocessing.Process(target=run_gateway, args=(args.gateway, gateway_port, {"telemetry": backend_port}),
+                                       daemon=True)
+        proc.start()
+        try:
+            ws, services = await connect_client(gateway_port, args.encoding)
+            padding = "x" * max(args.size - 100, 0)
+
+            def frame(body):
+                if args.encoding:
+                    return envelope.pack(args.encoding, services["telemetry"], body.get("seq", 0), json.dumps(body))
+                return json.dumps({"service": "telemetry", **body})
+
+            # Warm-up opens the backend connection outside the measurement
+            await ws.send(frame({"type": "warmup", "data": padding}))
+            while sink.received < 1:
+                await asyncio.sleep(0.01)
+            sink.received = 0
+            sink.latencies = []
+
+            viewers = []
+            for _ in range(args.viewers):
+                viewer_ws, _ = await connect_client(gateway_port)
+                await viewer_ws.send(json.dumps({"service": "gateway", "type": "subscribe", "topics": ["telemetry"]}))
+                viewers.append(Viewer(viewer_ws, args.messages))
+            slow_viewer = None
+            if args.slow_viewer_ms:
+                slow_ws, _ = await connect_client(gateway_port)
+                await slow_ws.send(json.dumps({"service": "gateway", "type": "subscribe", "topics": ["telemetry"]}))
+                slow_viewer = Viewer(slow_ws, args.messages, delay=args.slow_viewer_ms / 1000)
+            # Let the subscriptions land before measuring
+            await asyncio.sleep(0.1)
+            listeners = [asyncio.create_task(v.listen()) for v in viewers]
+            if slow_viewer:
+                listeners.append(asyncio.create_task(slow_viewer.listen()))
+            if viewers or slow_viewer:
+                # The sender is subscribed too, drain its copy of the fan-out
+                sender_copy = Viewer(ws, args.messages + 1)
+                listeners.append(asyncio.create_task(sender_copy.listen()))
+
+            cpu_start = process_cpu_seconds(proc.pid)
+            start = time.perf_counter()
+            interval = 1 / args.rate if args.rate else 0
+            wire_bytes = 0
+            for i in range(args.messages):
+                if interval:
+                    delay = start + i * interval - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                data = frame({"type": "battery", "seq": i, "sent": time.perf_counter(), "data": padding})
+                wire_bytes += len(data)
+                await ws.send(data)
+            await asyncio.wait_for(sink.done.wait(), timeout=max(60, args.messages / 100))
+            # Bounded gateway queues may drop for viewers that fall behind, wait until they go quiet
+            await wait_quiet(viewers)
+            elapsed = time.perf_counter() - start
+            cpu = process_cpu_seconds(proc.pid) - cpu_start
+            for viewer in viewers + ([slow_viewer] if slow_viewer else []):
+                await viewer.ws.close()
+            await ws.close()
+            for listener in listeners:
+                listener.cancel()
+        finally:
+            proc.terminate()
+            proc.join()
+
+    latencies_ms = [l * 1000 for l in sink.latencies]
+    return {
+        "gateway": os.path.abspath(args.gateway),
+        "messages": args.messages,
+        "message_bytes": args.size,
+        "encoding": args.encoding or "json",
+        "wire_bytes_per_message": wire_bytes / args.messages,
+        "offered_rate": args.rate or None,
+        "messages_per_s": args.messages / elapsed,
+        "gateway_cpu_us_per_message": cpu / args.messages * 1e6,
+        "gateway_cpu_percent": 100 * cpu / elapsed,
+        "latency_ms_p50": percentile(latencies_ms, 50),
+        "latency_ms_p99": percentile(latencies_ms, 99),
+        "viewers": args.viewers,
+        "viewer_messages_received": sum(v.received for v in viewers),
+        "viewer_messages_dropped": args.viewers * args.messages - sum(v.received for v in viewers),
+        "slow_viewer_received": slow_viewer.received if slow_viewer else None,
+        "backend_connections": sink.connections,
+    }
+
+
+class StreamSource:
+    """Stand-in local service streaming joint states to the gateway over one transport"""
+
+    def __init__(self, transport, workdir, batch_ms=0):
+        self.transport = transport
+        self.batch_ms = batch_ms
+        self.path = os.path.join(workdir, "stream.sock")
+        self.port = free_port()
+        self.shm_name = f"gateway_bench_{os.getpid()}"
+        self.connected = asyncio.Event()
+        self.ws = None
+        self.server = None
+        self.ring = None
+        self.registry_ws = None
+        self.full_retries = 0
+
+    async def handler(self, ws):
+        self.ws = ws
+        self.connected.set()
+        await ws.wait_closed()
+
+    async def start(self, registry):
+        if self.transport == "tcp":
+            self.server = await websockets.serve(self.handler, "127.0.0.1", self.port)
+            return
+        if self.transport == "unix":
+            self.server = await websockets.unix_serve(self.handler, self.path)
+            registration = {"type": "register", "service": "stream", "transport": "unix", "path": self.path}
+        else:
+            self.ring = ShmRing.create(self.shm_name)
+            registration = {"type": "register", "service": "stream", "transport": "shm", "shm_name": self.shm_name}
+        registration["batch_ms"] = self.batch_ms
+        for _ in range(100):
+            try:
+                self.registry_ws = await websockets.unix_connect(registry)
+                break
+            except OSError:
+                await asyncio.sleep(0.05)
+        else:
+            raise RuntimeError("gateway registry did not start")
+        await self.registry_ws.send(json.dumps(registration))
+        reply = json.loads(await self.registry_ws.recv())
+        if reply.get("type") != "registered":
+            raise RuntimeError(f"registration failed: {reply}")
+        if self.ring is not None:
+            self.connected.set()
+
+    async def send(self, message):
+        if self.ring is None:
+            await self.ws.send(message)
+            return
+        data = message.encode()
+        while not self.ring.write(data):
+            # Full ring: give the gateway a moment to catch up instead of dropping
+            self.full_retries += 1
+            await asyncio.sleep(0.0005)
+
+    async def stop(self):
+        if self.registry_ws is not None:
+            await self.registry_ws.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.ring is not None:
+            self.ring.close()
+
+
+class StreamViewer(Viewer):
+    """Viewer recording source -> app latency from the "sent" field"""
+
+    def __init__(self, ws, expected):
+        super().__init__(ws, expected)
+        self.latencies = []
+        self.frames = 0
+        self.frame_bytes = 0
+
+    async def listen(self):
+        try:
+            async for frame in self.ws:
+                now = time.perf_counter()
+                self.frames += 1
+                self.frame_bytes += len(frame)
+                data = json.loads(frame)
+                # Batches are split here, the way an app would
+                messages = data["messages"] if data.get("type") == "batch" else [data]
+                for message in messages:
+                    self.latencies.append(now - message["sent"])
+                    self.received += 1
+                if self.received >= self.expected:
+                    self.done.set()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+async def stream_bench(args):
+    workdir = tempfile.mkdtemp(prefix="gateway_bench_")
+    registry = os.path.join(workdir, "registry.sock")
+    source = StreamSource(args.transport, workdir, args.batch_ms)
+    gateway_port = free_port()
+    backends = {"stream": source.port} if args.transport == "tcp" else {}
+    proc = multiprocessing.Process(target=run_gateway, args=(args.gateway, gateway_port, backends, registry,
+                                                             {"batch_ms": args.batch_ms}),
+                                   daemon=True)
+    proc.start()
+    try:
+        await source.start(registry)
+        ws, _ = await connect_client(gateway_port, batch=args.batch_ms > 0)
+        await ws.send(json.dumps({"service": "gateway", "type": "subscribe", "topics": ["stream"]}))
+        await asyncio.wait_for(source.connected.wait(), timeout=10)
+        viewer = StreamViewer(ws, args.messages)
+        listener = asyncio.create_task(viewer.listen())
+        padding = "x" * max(args.size - 100, 0)
+        # Warm-up: wait until the path delivers before measuring
+        while viewer.received < 1:
+            await source.send(json.dumps({"type": "joint_states", "seq": -1, "sent": time.perf_counter()}))
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.1)
+        viewer.received = 0
+        viewer.latencies = []
+        viewer.frames = 0
+        viewer.frame_bytes = 0
+
+        cpu_start = process_cpu_seconds(proc.pid)
+        start = time.perf_counter()
+        interval = 1 / args.rate if args.rate else 0
+        for i in range(args.messages):
+            if interval:
+                delay = start + i * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await source.send(json.dumps({"type": "joint_states", "seq": i, "sent": time.perf_counter(),
+                                          "data": padding}))
+        await wait_quiet([viewer])
+        elapsed = time.perf_counter() - start
+        cpu = process_cpu_seconds(proc.pid) - cpu_start
+        listener.cancel()
+        await ws.close()
+    finally:
+        await source.stop()
+        proc.terminate()
+        proc.join()
+
+    latencies_ms = [l * 1000 for l in viewer.latencies]
+    return {
+        "gateway": os.path.abspath(args.gateway),
+        "transport": args.transport,
+        "messages": args.messages,
+        "message_bytes": args.size,
+        "offered_rate": args.rate or None,
+        "batch_ms": args.batch_ms,
+        "delivered": viewer.received,
+        "frames": viewer.frames,
+        "bytes_per_message": viewer.frame_bytes / max(viewer.received, 1),
+        "messages_per_s": viewer.received / elapsed,
+        "gateway_cpu_us_per_message": cpu / max(viewer.received, 1) * 1e6,
+        "latency_ms_p50": percentile(latencies_ms, 50),
+        "latency_ms_p99": percentile(latencies_ms, 99),
+        "source_full_retries": source.full_retries,
+    }
+
+
+# Size of a two-camera offer with audio and a data channel from webrtcbin
+OFFER_SDP = "v=0\r\n" + "a=candidate-free sdp line padding\r\n" * 90
+ICE_PER_OFFER = 4
+
+
+class StandInWebRTC:
+    """Stand-in for stream.py's WebRTCServer, with the same ws / handle_client_message surface.
+
+    Negotiate is answered with an offer and a few ICE candidates. An answer gets an
+    "answer_applied" reply, which the real server doesn't send, so the app can time it.
+    """
+
+    def __init__(self, loop):
+        self.ws = None
+        self.loop = loop
+
+    def handle_client_message(self, message):
+        msg = json.loads(message)
+        if msg.get("type") == "Negotiate":
+            messages = [json.dumps({"sdp": {"type": "offer", "sdp": OFFER_SDP}})]
+            messages += [json.dumps({"ice": {"candidate": f"candidate:{i} 1 UDP 2122252543 192.168.1.20 5{i:04d} typ host",
+                                             "sdpMLineIndex": 0}}) for i in range(ICE_PER_OFFER)]
+            # The real offer is sent from webrtcbin's thread the same way
+            asyncio.run_coroutine_threadsafe(self.send_messages(messages), self.loop)
+        elif "sdp" in msg and msg["sdp"]["type"] == "answer":
+            self.loop.create_task(self.ws.send(json.dumps({"type": "answer_applied"})))
+
+    async def send_messages(self, messages):
+        for message in messages:
+            await self.ws.send(message)
+
+    async def websocket_handler(self, ws):
+        self.ws = ws
+        try:
+            async for msg in ws:
+                self.handle_client_message(msg)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+def attach_local_video(gateway, module):
+    """Gateway-side setup for --negotiation --transport local"""
+    server = StandInWebRTC(asyncio.get_running_loop())
+    connection = module.LocalConnection(server.handle_client_message)
+    server.ws = connection.peer
+    gateway.register_service(module.BackendService("localhost", 0, "video", mode="session", queue_policy="reliable",
+                                                   transport="local", connection=connection))
+
+
+async def negotiation_bench(args):
+    gateway_port = free_port()
+    video_server = None
+    if args.transport == "local":
+        backends, setup = {}, attach_local_video
+    else:
+        server = StandInWebRTC(asyncio.get_running_loop())
+        video_port = free_port()
+        backends, setup = {"video": video_port}, None
+        video_server = await websockets.serve(server.websocket_handler, "127.0.0.1", video_port)
+    proc = multiprocessing.Process(target=run_gateway,
+                                   args=(args.gateway, gateway_port, backends, None,
+                                         {"mode": "session", "queue_policy": "reliable"}, setup),
+                                   daemon=True)
+    proc.start()
+    offer_ms, answer_ms = [], []
+    try:
+        ws, _ = await connect_client(gateway_port)
+
+        async def negotiate():
+            started = time.perf_counter()
+            await ws.send(json.dumps({"service": "video", "type": "Negotiate", "cameras": [0]}))
+            candidates = 0
+            offered = None
+            while offered is None or candidates < ICE_PER_OFFER:
+                msg = json.loads(await ws.recv())
+                if "sdp" in msg:
+                    offered = time.perf_counter()
+                elif "ice" in msg:
+                    candidates += 1
+            answered = time.perf_counter()
+            await ws.send(json.dumps({"service": "video", "sdp": {"type": "answer", "sdp": "v=0\r\n"}}))
+            while json.loads(await ws.recv()).get("type") != "answer_applied":
+                pass
+            return offered - started, time.perf_counter() - answered
+
+        # Warm-up: the first rounds wait for the backend connection
+        for _ in range(5):
+            await asyncio.wait_for(negotiate(), timeout=15)
+        cpu_start = process_cpu_seconds(proc.pid)
+        for _ in range(args.rounds):
+            offer, answer = await negotiate()
+            offer_ms.append(offer * 1000)
+            answer_ms.append(answer * 1000)
+        cpu = process_cpu_seconds(proc.pid) - cpu_start
+        await ws.close()
+    finally:
+        proc.terminate()
+        proc.join()
+        if video_server is not None:
+            video_server.close()
+            await video_server.wait_closed()
+
+    return {
+        "gateway": os.path.abspath(args.gateway),
+        "transport": args.transport,
+        "rounds": args.rounds,
+        "offer_ms_p50": percentile(offer_ms, 50),
+        "offer_ms_p99": percentile(offer_ms, 99),
+        "answer_ms_p50": percentile(answer_ms, 50),
+        "answer_ms_p99": percentile(answer_ms, 99),
+        "gateway_cpu_us_per_round": cpu / args.rounds * 1e6,
+    }
+
+
+def envelope_report(iterations=20000):
+    """Bytes on the wire and encode/decode CPU of one telemetry message per framing"""
+    body = {"type": "battery", "seq": 123456, "voltage": 24.61, "current": -1.27, "percent": 87,
+            "cells": [4.101, 4.098, 4.103, 4.1, 4.099, 4.102], "charging": False}
+    variants = {"json": (lambda: json.dumps({"service": "telemetry", **body}),
+                         lambda frame: json.loads(frame))}
+    for encoding in envelope.ENCODERS:
+        variants[f"{encoding}+json_payload"] = (
+            lambda e=encoding: envelope.pack(e, 3, 123456, json.dumps(body)),
+            lambda frame, e=encoding: envelope.unpack(e, frame))
+        encode_payload, decode_payload = envelope.ENCODERS[encoding]
+        variants[f"{encoding}+{encoding}_payload"] = (
+            lambda e=encoding, enc=encode_payload: envelope.pack(e, 3, 123456, enc(body)),
+            lambda frame, e=encoding, dec=decode_payload: dec(envelope.unpack(e, frame)[2]))
+    report = {}
+    for name, (encode, decode) in variants.items():
+        start = time.process_time()
+        for _ in range(iterations):
+            frame = encode()
+        encode_us = (time.process_time() - start) / iterations * 1e6
+        start = time.process_time()
+        for _ in range(iterations):
+            decode(frame)
+        decode_us = (time.process_time() - start) / iterations * 1e6
+        report[name] = {"bytes": len(frame), "encode_us": round(encode_us, 2), "decode_us": round(decode_us, 2)}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark message routing through gateway.py")
+    parser.add_argument("--gateway", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "gateway.py"),
+                        help="gateway module to benchmark (default: ./gateway.py)")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=0, help="messages/s to offer, 0 for as fast as possible")
+    parser.add_argument("--size", type=int, default=200, help="approximate message size in bytes")
+    parser.add_argument("--encoding", choices=sorted(envelope.ENCODERS),
+                        help="negotiate a binary envelope instead of JSON text")
+    parser.add_argument("--envelope-report", action="store_true",
+                        help="only compare message size and encode/decode CPU of each framing")
+    parser.add_argument("--viewers", type=int, default=0,
+                        help="extra clients subscribed to the backend's replies, which the sink echoes back")
+    parser.add_argument("--slow-viewer-ms", type=float, default=0,
+                        help="add a subscribed client that takes this long per message")
+    parser.add_argument("--stream", action="store_true",
+                        help="measure a local service streaming to a subscribed app instead of app -> backend")
+    parser.add_argument("--transport", choices=["tcp", "unix", "shm", "local"], default="tcp",
+                        help="backend transport for --stream (tcp, unix, shm) or --negotiation (tcp, local)")
+    parser.add_argument("--batch-ms", type=float, default=0,
+                        help="batch window of the --stream service, the app opts into batching")
+    parser.add_argument("--negotiation", action="store_true",
+                        help="time offer/answer round trips of a stand-in video service")
+    parser.add_argument("--rounds", type=int, default=500, help="negotiations for --negotiation")
+    parser.add_argument("--json", help="also write the result to this file")
+    args = parser.parse_args()
+    if args.stream and args.transport == "local" or args.negotiation and args.transport not in ("tcp", "local"):
+        parser.error(f"--transport {args.transport} is not available in this mode")
+    if args.envelope_report:
+        result = envelope_report()
+    elif args.negotiation:
+        result = asyncio.run(negotiation_bench(args))
+    elif args.stream:
+        result = asyncio.run(stream_bench(args))
+    else:
+        result = asyncio.run(bench(args))
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
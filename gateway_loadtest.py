@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""Load test for gateway.py over the direct LAN and signaling paths.
+
+Starts the gateway in a child process with a stand-in signaling server and a fake
+backend service, then steps through offered rates with any number of direct and
+relayed clients. Each step reports routed messages/s, client -> backend latency,
+gateway CPU and memory.
+
+    python gateway_loadtest.py --clients 4 --relay-clients 2 --rates 100,250,500,1000 --json load.json
+
+The JSON keeps the {"metrics": {metric: {key: stats}}} layout, so two runs can be
+compared with gstreamer/compare_results.py. Throughput, CPU and memory are also sampled
+once per --sample-interval, and the samples go in "series" for its significance tests.
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+import websockets
+
+from gateway_bench import AUTH_TOKEN, connect_client, free_port, percentile, process_cpu_seconds
+
+ROBOT_ID = "loadtest-robot"
+SAMPLED_METRICS = ("messages_per_s", "gateway_cpu_us_per_message", "gateway_rss_mb")
+
+
+def process_memory_mb(pid):
+    """(current, peak) resident memory of a process from /proc, in MB"""
+    values = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                key, value = line.split(":", 1)
+                values[key] = int(value.split()[0]) / 1024
+    return values.get("VmRSS"), values.get("VmHWM")
+
+
+def run_gateway(module_path, port, signaling_url, backends, workdir):
+    """Child process: a full gateway, including its signaling server connection"""
+    os.environ["AUTH_TOKEN"] = AUTH_TOKEN
+    os.environ["ROBOT_ID"] = ROBOT_ID
+    os.environ["GATEWAY_REGISTRY_SOCKET"] = os.path.join(workdir, "registry.sock")
+    os.environ["GATEWAY_METRICS_PORT"] = "0"
+    spec = importlib.util.spec_from_file_location("loadtest_gateway", module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    logging.getLogger().handlers = [logging.NullHandler()]
+    gateway = module.GatewayProxy(signaling_server_url=signaling_url, websocket_port=port)
+    gateway.backend_services = {}
+    for name, backend_port in backends.items():
+        gateway.backend_services[name] = module.BackendService("127.0.0.1", backend_port, name)
+    asyncio.run(gateway.start())
+
+
+class StandInSignaling:
+    """Relay in the role of signaling.py, except any number of apps share the robot.
+
+    The gateway sees every relayed app on its one signaling connection, the same as
+    with the real server. Apps don't authenticate, the stand-in does that once for all
+    of them when the robot connects.
+    """
+
+    def __init__(self):
+        self.robot_ws = None
+        self.robot_ready = asyncio.Event()
+        self.apps = set()
+
+    async def handler(self, ws):
+        hello = json.loads(await ws.recv())
+        if hello.get("role") == "robot":
+            await self.handle_robot(ws)
+        else:
+            await self.handle_app(ws)
+
+    async def handle_robot(self, ws):
+        self.robot_ws = ws
+        await ws.send(json.dumps({"token": AUTH_TOKEN}))
+        reply = json.loads(await ws.recv())
+        if reply.get("type") != "auth_success":
+            raise RuntimeError(f"gateway rejected the stand-in signaling server: {reply}")
+        self.robot_ready.set()
+        try:
+            async for message in ws:
+                websockets.broadcast(self.apps, message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.robot_ws = None
+            self.robot_ready.clear()
+
+    async def handle_app(self, ws):
+        self.apps.add(ws)
+        try:
+            async for message in ws:
+                if self.robot_ws is not None:
+                    await self.robot_ws.send(message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.apps.discard(ws)
+
+
+class LoadSink:
+    """Fake backend recording arrival latency per path"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.received = {"direct": 0, "relay": 0}
+        self.latencies = {"direct": [], "relay": []}
+
+    async def handler(self, ws):
+        try:
+            async for message in ws:
+                now = time.perf_counter()
+                data = json.loads(message)
+                path = data.get("path")
+                if path in self.received:
+                    self.received[path] += 1
+                    self.latencies[path].append(now - data["sent"])
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+async def connect_relay_client(signaling_port):
+    ws = await websockets.connect(f"ws://127.0.0.1:{signaling_port}")
+    await ws.send(json.dumps({"role": "app", "robot_id": ROBOT_ID}))
+    return ws
+
+
+async def drain(ws):
+    """Read and discard whatever the gateway sends a client so its buffers never fill"""
+    try:
+        async for _ in ws:
+            pass
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+
+async def drive_client(ws, path, client_id, rate, duration, padding):
+    """Send at `rate` messages/s on an absolute schedule, returns how many were sent"""
+    interval = 1 / rate
+    start = time.perf_counter()
+    count = int(rate * duration)
+    for i in range(count):
+        delay = start + i * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await ws.send(json.dumps({"service": "telemetry", "type": "load", "path": path, "client": client_id,
+                                  "seq": i, "sent": time.perf_counter(), "data": padding}))
+    return count
+
+
+async def sample_gateway(sink, proc, interval, samples):
+    """Append (messages/s, CPU us/message, RSS MB) for every interval until cancelled"""
+    received = sum(sink.received.values())
+    cpu = process_cpu_seconds(proc.pid)
+    start = time.perf_counter()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.perf_counter()
+        now_received = sum(sink.received.values())
+        now_cpu = process_cpu_seconds(proc.pid)
+        count = now_received - received
+        samples.append((count / (now - start), (now_cpu - cpu) / max(count, 1) * 1e6,
+                        process_memory_mb(proc.pid)[0]))
+        received, cpu, start = now_received, now_cpu, now
+
+
+def sample_stats(value, samples):
+    """Stats of a step-wide value, with the spread of its per-interval samples"""
+    stats = {"mean": value}
+    if len(samples) > 1:
+        mean = sum(samples) / len(samples)
+        stats["count"] = len(samples)
+        stats["stddev"] = (sum((s - mean) ** 2 for s in samples) / len(samples)) ** 0.5
+    return stats
+
+
+def latency_stats(latencies):
+    latencies_ms = [l * 1000 for l in latencies]
+    if not latencies_ms:
+        return None
+    mean = sum(latencies_ms) / len(latencies_ms)
+    return {
+        "count": len(latencies_ms),
+        "mean": mean,
+        "stddev": (sum((l - mean) ** 2 for l in latencies_ms) / len(latencies_ms)) ** 0.5,
+        "p50": percentile(latencies_ms, 50),
+        "p99": percentile(latencies_ms, 99),
+        "max": max(latencies_ms),
+    }
+
+
+async def run_step(rate, clients, sink, proc, args):
+    """Run every client at `rate` messages/s for one step"""
+    padding = "x" * max(args.size - 150, 0)
+    sink.reset()
+    cpu_start = process_cpu_seconds(proc.pid)
+    start = time.perf_counter()
+    samples = []
+    sampler = asyncio.create_task(sample_gateway(sink, proc, args.sample_interval, samples))
+    try:
+        sent = await asyncio.gather(*(drive_client(ws, path, i, rate, args.duration, padding)
+                                      for i, (ws, path) in enumerate(clients)))
+    finally:
+        # Only whole intervals while clients send, the drain below would skew the rates
+        sampler.cancel()
+    # Let in-flight messages land before reading the counters
+    expected = sum(sent)
+    deadline = time.perf_counter() + 5
+    while sum(sink.received.values()) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    cpu = process_cpu_seconds(proc.pid) - cpu_start
+    rss_mb, peak_rss_mb = process_memory_mb(proc.pid)
+    received = sum(sink.received.values())
+    return {
+        "rate_per_client": rate,
+        "offered_per_s": rate * len(clients),
+        "sent": expected,
+        "received": received,
+        "lost": expected - received,
+        "messages_per_s": received / elapsed,
+        "gateway_cpu_percent": 100 * cpu / elapsed,
+        "gateway_cpu_us_per_message": cpu / max(received, 1) * 1e6,
+        "gateway_rss_mb": rss_mb,
+        "gateway_peak_rss_mb": peak_rss_mb,
+        "latency_ms": {path: latency_stats(latencies) for path, latencies in sink.latencies.items() if latencies},
+        "samples": {
+            "messages_per_s": [sample[0] for sample in samples],
+            "gateway_cpu_us_per_message": [sample[1] for sample in samples],
+            "gateway_rss_mb": [sample[2] for sample in samples],
+        },
+    }
+
+
+def to_metrics(steps):
+    """{"metrics": ...} and {"series": ...} layouts of compare_results.py, keyed by path@rate"""
+    metrics = {"latency_ms": {}, "messages_per_s": {}, "gateway_cpu_us_per_message": {}, "gateway_rss_mb": {}}
+    series = {metric: {} for metric in SAMPLED_METRICS}
+    for step in steps:
+        rate = f"{step['rate_per_client']:g}"
+        for path, stats in step["latency_ms"].items():
+            metrics["latency_ms"][f"{path}@{rate}"] = stats
+        for metric in SAMPLED_METRICS:
+            samples = step["samples"][metric]
+            metrics[metric][f"all@{rate}"] = sample_stats(step[metric], samples)
+            series[metric][f"all@{rate}"] = samples
+    return metrics, series
+
+
+async def loadtest(args):
+    workdir = tempfile.mkdtemp(prefix="gateway_loadtest_")
+    sink = LoadSink()
+    signaling = StandInSignaling()
+    backend_port = free_port()
+    signaling_port = free_port()
+    gateway_port = free_port()
+    async with websockets.serve(sink.handler, "127.0.0.1", backend_port), \
+            websockets.serve(signaling.handler, "127.0.0.1", signaling_port):
+        proc = multiprocessing.Process(target=run_gateway,
+                                       args=(args.gateway, gateway_port, f"ws://127.0.0.1:{signaling_port}",
+                                             {"telemetry": backend_port}, workdir),
+                                       daemon=True)
+        proc.start()
+        readers = []
+        try:
+            clients = []
+            for _ in range(args.clients):
+                ws, _ = await connect_client(gateway_port)
+                clients.append((ws, "direct"))
+            if args.relay_clients:
+                await asyncio.wait_for(signaling.robot_ready.wait(), timeout=15)
+                for _ in range(args.relay_clients):
+                    clients.append((await connect_relay_client(signaling_port), "relay"))
+            readers = [asyncio.create_task(drain(ws)) for ws, _ in clients]
+
+            # Warm-up opens the backend connection and settles the paths
+            await run_step(min(args.rates), clients, sink, proc, argparse.Namespace(**{**vars(args), "duration": 0.5}))
+
+            steps = []
+            for rate in args.rates:
+                step = await run_step(rate, clients, sink, proc, args)
+                steps.append(step)
+                latency = ", ".join(f"{path} p50 {s['p50']:.2f} p99 {s['p99']:.2f} ms"
+                                    for path, s in step["latency_ms"].items())
+                print(f"{step['offered_per_s']:>8.0f} msg/s offered -> {step['messages_per_s']:>8.0f} routed, "
+                      f"cpu {step['gateway_cpu_percent']:5.1f}%, {latency}")
+                if args.stop_p99_ms and any(s["p99"] > args.stop_p99_ms for s in step["latency_ms"].values()):
+                    print(f"p99 above {args.stop_p99_ms} ms, stopping")
+                    break
+            for ws, _ in clients:
+                await ws.close()
+        finally:
+            for reader in readers:
+                reader.cancel()
+            proc.terminate()
+            proc.join()
+
+    metrics, series = to_metrics(steps)
+    return {
+        "gateway": os.path.abspath(args.gateway),
+        "config": {"clients": args.clients, "relay_clients": args.relay_clients, "message_bytes": args.size,
+                   "duration_s": args.duration, "sample_interval_s": args.sample_interval, "cpu_count": os.cpu_count()},
+        "steps": steps,
+        "metrics": metrics,
+        "series": series,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test gateway.py over the direct and signaling paths")
+    parser.add_argument("--gateway", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "gateway.py"),
+                        help="gateway module to test (default: ./gateway.py)")
+    parser.add_argument("--clients", type=int, default=1, help="direct LAN clients")
+    parser.add_argument("--relay-clients", type=int, default=0, help="clients relayed by the stand-in signaling server")
+    parser.add_argument("--rates", type=lambda text: [float(r) for r in text.split(",")], default=[100, 500, 1000],
+                        help="comma separated messages/s per client, one step each")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per step")
+    parser.add_argument("--sample-interval", type=float, default=1.0,
+                        help="seconds between throughput, CPU and memory samples within a step")
+    parser.add_argument("--size", type=int, default=200, help="approximate message size in bytes")
+    parser.add_argument("--stop-p99-ms", type=float, default=0,
+                        help="stop stepping once a path's p99 latency exceeds this")
+    parser.add_argument("--json", help="also write the result to this file")
+    args = parser.parse_args()
+    result = asyncio.run(loadtest(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.json}")
+    else:
+        print(json.dumps(result["metrics"], indent=2))
+
+
+if __name__ == "__main__":
+    main()
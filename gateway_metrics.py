@@ -0,0 +1,269 @@
+"""Metrics for gateway.py, served as Prometheus text and a JSON snapshot on a local HTTP port.
+
+The routing path only bumps counters and histogram buckets. Everything else (connection
+counts, queue depths, backend state, rates) is computed when someone scrapes, so a
+gateway nobody watches pays a few increments per message.
+
+    curl localhost:9108/metrics        # Prometheus text format
+    curl localhost:9108/metrics.json   # JSON snapshot, rates since the previous snapshot
+"""
+import asyncio
+import bisect
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, the last bucket is +Inf
+LATENCY_BUCKETS_S = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1]
+# Time to recover a session or the signaling connection
+RECOVER_BUCKETS_S = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+def label_value(value) -> str:
+    """Escape a label value for the Prometheus text format, service names are arbitrary strings"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS_S):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def percentile(self, q: float):
+        """Upper bound of the bucket holding the q-th percentile, None without samples"""
+        if not self.count:
+            return None
+        target = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        p50, p99 = self.percentile(50), self.percentile(99)
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else None,
+            "p50_ms_le": p50 * 1000 if p50 is not None else None,
+            "p99_ms_le": p99 * 1000 if p99 is not None else None,
+        }
+
+
+class ServiceCounters:
+    """Traffic of one service.
+
+    "to_backend" counts app -> service messages. "to_apps" counts service messages once,
+    however many apps they are fanned out to.
+    """
+    __slots__ = ("messages_to_backend", "bytes_to_backend", "messages_to_apps", "bytes_to_apps",
+                 "route_latency", "fanout_latency")
+
+    def __init__(self):
+        self.messages_to_backend = 0
+        self.bytes_to_backend = 0
+        self.messages_to_apps = 0
+        self.bytes_to_apps = 0
+        # Client message received -> written to the backend
+        self.route_latency = LatencyHistogram()
+        # Backend message received -> queued for every subscriber
+        self.fanout_latency = LatencyHistogram()
+
+
+class GatewayMetrics:
+    def __init__(self):
+        self.services = {}
+        self.auth_failures = 0
+        # App disconnect -> session resumed with its resume token
+        self.session_recover = LatencyHistogram(RECOVER_BUCKETS_S)
+        self.sessions_expired = 0
+        # Signaling server connection lost -> connected again
+        self.signaling_recover = LatencyHistogram(RECOVER_BUCKETS_S)
+        self.started = time.time()
+        # (time, {service: (messages_to_backend, messages_to_apps, bytes_to_backend, bytes_to_apps)})
+        self.previous_snapshot = None
+
+    def service(self, name: str) -> ServiceCounters:
+        counters = self.services.get(name)
+        if counters is None:
+            counters = self.services[name] = ServiceCounters()
+        return counters
+
+    def connections_by_type(self, gateway) -> dict:
+        counts = {}
+        for connection_info in gateway.active_connections.values():
+            if connection_info.get("authenticated", True):
+                kind = connection_info["type"].value
+                counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+    def queues_by_service(self, gateway) -> dict:
+        queues = {}
+        for per_service in gateway.queue_stats()["queues"].values():
+            for service_name, stats in per_service.items():
+                entry = queues.setdefault(service_name, {"queues": 0, "depth": 0, "max_depth": 0, "dropped": 0})
+                entry["queues"] += 1
+                entry["depth"] += stats["depth"]
+                entry["max_depth"] = max(entry["max_depth"], stats["depth"])
+                entry["dropped"] += stats["dropped"]
+        return queues
+
+    def snapshot(self, gateway) -> dict:
+        now = time.time()
+        totals = {name: (c.messages_to_backend, c.messages_to_apps, c.bytes_to_backend, c.bytes_to_apps)
+                  for name, c in self.services.items()}
+        previous_time, previous = self.previous_snapshot or (self.started, {})
+        elapsed = max(now - previous_time, 1e-9)
+        self.previous_snapshot = (now, totals)
+
+        services = {}
+        for name, counters in self.services.items():
+            before = previous.get(name, (0, 0, 0, 0))
+            rates = [(after - prior) / elapsed for after, prior in zip(totals[name], before)]
+            services[name] = {
+                "messages_to_backend": counters.messages_to_backend,
+                "bytes_to_backend": counters.bytes_to_backend,
+                "messages_to_apps": counters.messages_to_apps,
+                "bytes_to_apps": counters.bytes_to_apps,
+                "messages_to_backend_per_s": rates[0],
+                "messages_to_apps_per_s": rates[1],
+                "bytes_to_backend_per_s": rates[2],
+                "bytes_to_apps_per_s": rates[3],
+                "route_latency": counters.route_latency.snapshot(),
+                "fanout_latency": counters.fanout_latency.snapshot(),
+            }
+        queue_stats = gateway.queue_stats()
+        return {
+            "timestamp": now,
+            "uptime_s": now - self.started,
+            "rate_interval_s": elapsed,
+            "connections": self.connections_by_type(gateway),
+            "auth_failures": self.auth_failures,
+            "sessions": {
+                "detached": len(gateway.detached_connections),
+                "resumed": self.session_recover.count,
+                "expired": self.sessions_expired,
+                "recover": self.session_recover.snapshot(),
+            },
+            "signaling_recover": self.signaling_recover.snapshot(),
+            "services": services,
+            "backends": gateway.backend_stats(),
+            "queues": self.queues_by_service(gateway),
+            "queue_dropped_total": queue_stats["dropped_total"],
+        }
+
+    def prometheus(self, gateway) -> str:
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{label_value(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        directions = [("to_backend", "messages_to_backend", "bytes_to_backend"),
+                      ("to_apps", "messages_to_apps", "bytes_to_apps")]
+        metric("gateway_messages_total", "counter", "Messages routed per service and direction",
+               [({"service": name, "direction": d}, getattr(c, messages))
+                for name, c in self.services.items() for d, messages, _ in directions])
+        metric("gateway_bytes_total", "counter", "Bytes routed per service and direction",
+               [({"service": name, "direction": d}, getattr(c, size))
+                for name, c in self.services.items() for d, _, size in directions])
+
+        def histogram_metric(name, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in samples:
+                label_text = "".join(f'{k}="{label_value(v)}",' for k, v in labels.items())
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label_text}le="{bound}"}} {cumulative}')
+                label_text = label_text.rstrip(",")
+                lines.append(f"{name}_sum{{{label_text}}} {histogram.total}" if label_text
+                             else f"{name}_sum {histogram.total}")
+                lines.append(f"{name}_count{{{label_text}}} {histogram.count}" if label_text
+                             else f"{name}_count {histogram.count}")
+
+        histogram_metric("gateway_latency_seconds", "Time spent routing one message",
+                         [({"service": name, "stage": stage}, histogram) for name, counters in self.services.items()
+                          for stage, histogram in (("route", counters.route_latency),
+                                                   ("fanout", counters.fanout_latency))])
+
+        metric("gateway_connections", "gauge", "Authenticated app connections by type",
+               [({"type": kind}, count) for kind, count in self.connections_by_type(gateway).items()])
+        metric("gateway_auth_failures_total", "counter", "Failed authentications", [({}, self.auth_failures)])
+        metric("gateway_sessions_detached", "gauge", "Sessions of disconnected apps waiting to be resumed",
+               [({}, len(gateway.detached_connections))])
+        metric("gateway_sessions_expired_total", "counter", "Sessions released without being resumed",
+               [({}, self.sessions_expired)])
+        histogram_metric("gateway_recover_seconds", "Time to recover after a disconnect",
+                         [({"kind": "session"}, self.session_recover),
+                          ({"kind": "signaling"}, self.signaling_recover)])
+
+        backends = gateway.backend_stats()
+        metric("gateway_backend_connected", "gauge", "1 while the pooled backend connection is up",
+               [({"service": name}, int(b["connected"])) for name, b in backends.items()])
+        metric("gateway_backend_reconnects_total", "counter", "Backend reconnections",
+               [({"service": name}, b["reconnects"]) for name, b in backends.items()])
+        metric("gateway_backend_connect_failures_total", "counter", "Failed backend connection attempts",
+               [({"service": name}, b["connect_failures"]) for name, b in backends.items()])
+        metric("gateway_backend_reconnect_seconds_last", "gauge", "Time from losing a backend to reconnecting",
+               [({"service": name}, b["reconnect_ms_last"] / 1000) for name, b in backends.items()
+                if b["reconnect_ms_last"] is not None])
+        metric("gateway_backend_pending_messages", "gauge", "Messages held while a backend reconnects",
+               [({"service": name}, b["pending"]) for name, b in backends.items()])
+
+        queues = self.queues_by_service(gateway)
+        metric("gateway_queue_depth", "gauge", "Frames waiting in outbound queues, summed over apps",
+               [({"service": name}, q["depth"]) for name, q in queues.items()])
+        metric("gateway_queue_depth_max", "gauge", "Deepest outbound queue of one app",
+               [({"service": name}, q["max_depth"]) for name, q in queues.items()])
+        metric("gateway_queue_dropped_total", "counter", "Frames dropped by outbound queues, including closed ones",
+               [({}, gateway.queue_stats()["dropped_total"])])
+        return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(gateway, host: str, port: int):
+    """Minimal HTTP server for /metrics and /metrics.json"""
+
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5.0)
+            # Headers are not needed, only read past them
+            while (await asyncio.wait_for(reader.readline(), timeout=5.0)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            path = parts[1].split("?")[0] if len(parts) > 1 else "/"
+            if path == "/metrics.json":
+                status, content_type = "200 OK", "application/json"
+                body = json.dumps(gateway.metrics.snapshot(gateway), indent=2)
+            elif path == "/metrics":
+                status, content_type = "200 OK", "text/plain; version=0.0.4"
+                body = gateway.metrics.prometheus(gateway)
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+            data = body.encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
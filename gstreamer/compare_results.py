@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""Performance regression gate for fullAnalysis result directories.
+
+The first input is the baseline, every other input is compared against it. Inputs are
+results_* directories (tracer_summary.json, tracer_timeseries.*, metadata.json) or
+benchmark JSON files with the same {"metrics": {metric: {key: stats}}} layout and an
+optional {"series": {metric: {key: [samples]}}}, such as the output of gateway_loadtest.py.
+
+    python compare_results.py results_old results_new --threshold latency_ms:p99=15
+
+Exits with status 1 when a metric regresses past its threshold and the change is
+significant, so it can gate CI or a deploy script. A change past its threshold that
+can't be tested (no per-second samples and no stddev) is reported as untested and
+does not fail the run.
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import sys
+
+# Percent increase allowed per metric and statistic
+DEFAULT_THRESHOLDS = {
+    "latency_ms": {"p50": 10, "p99": 20},
+    "element_latency_ms": {"p50": 10, "p99": 20},
+    "interlatency_ms": {"p50": 10, "p99": 20},
+    "proctime_ms": {"mean": 10, "p99": 20},
+    # gateway_loadtest.py
+    "messages_per_s": {"mean": 5},
+    "gateway_cpu_us_per_message": {"mean": 15},
+    "gateway_rss_mb": {"mean": 20},
+}
+# For these a drop is the regression
+HIGHER_IS_BETTER = {"fps", "bitrate_bps", "messages_per_s"}
+DEFAULT_ALPHA = 0.05
+# GType names such as GstQueue or GstX264Enc, pad names start in lower case
+ELEMENT_TYPE = re.compile(r"^[A-Z][A-Za-z0-9_]*$")
+
+
+class RunResults:
+    def __init__(self, path):
+        self.path = path
+        self.metrics = {}
+        self.series = {}
+        self.elements = {}
+        if os.path.isdir(path):
+            self.load_directory(path)
+        else:
+            with open(path) as f:
+                result = json.load(f)
+            self.metrics = result.get("metrics", {})
+            # Optional {metric: {key: [samples]}}, e.g. gateway_loadtest.py's per-interval samples
+            self.series = {(metric, key): samples for metric, keys in result.get("series", {}).items()
+                           for key, samples in keys.items()}
+
+    def load_directory(self, path):
+        summary_path = os.path.join(path, "tracer_summary.json")
+        if not os.path.exists(summary_path):
+            raise FileNotFoundError(f"{summary_path} not found, run tracer_analysis.py on {path} first")
+        with open(summary_path) as f:
+            self.metrics = json.load(f).get("metrics", {})
+        metadata_path = os.path.join(path, "metadata.json")
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                for tree in json.load(f).values():
+                    collect_elements(tree, self.elements)
+        self.series = load_timeseries(path)
+
+
+def collect_elements(node, elements):
+    """Map element name -> element type from a parsed DOT tree.
+
+    Element labels look like "GstQueue\\nsink_queue0\\n[>]\\n...": type first, then name.
+    Pads are nodes too, labelled "sink\\n[>][bfb]", so only labels starting with a type
+    name count.
+    """
+    if not isinstance(node, dict):
+        return
+    if node.get("type") == "element" or node.get("type") == "bin":
+        parts = node.get("name", "").strip('"').split("\\n")
+        if len(parts) > 1 and ELEMENT_TYPE.match(parts[0]):
+            elements[parts[1]] = parts[0]
+    for child in node.get("children", []):
+        collect_elements(child, elements)
+
+
+def load_timeseries(path):
+    """Per-second means keyed by (metric, key), used as samples for significance tests"""
+    series = {}
+    rows = []
+    csv_path = os.path.join(path, "tracer_timeseries.csv")
+    parquet_path = os.path.join(path, "tracer_timeseries.parquet")
+    if os.path.exists(csv_path):
+        with open(csv_path, newline="") as f:
+            rows = list(csv.DictReader(f))
+    elif os.path.exists(parquet_path):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            print(f"pyarrow not installed, no significance tests for {path}")
+            return series
+        rows = pq.read_table(parquet_path).to_pylist()
+    for row in rows:
+        series.setdefault((row["metric"], row["key"]), []).append(float(row["mean"]))
+    return series
+
+
+def mann_whitney_p(a, b):
+    """Two-sided Mann-Whitney U p-value with the normal approximation, None if too few samples"""
+    n1, n2 = len(a), len(b)
+    if n1 < 3 or n2 < 3:
+        return None
+    combined = sorted([(v, 0) for v in a] + [(v, 1) for v in b])
+    ranks = [0.0] * len(combined)
+    tie_term = 0
+    i = 0
+    while i < len(combined):
+        j = i
+        while j + 1 < len(combined) and combined[j + 1][0] == combined[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        ties = j - i + 1
+        tie_term += ties ** 3 - ties
+        i = j + 1
+    rank_sum = sum(r for r, (_, group) in zip(ranks, combined) if group == 0)
+    u = rank_sum - n1 * (n1 + 1) / 2
+    n = n1 + n2
+    variance = n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - n1 * n2 / 2) / math.sqrt(variance)
+    return math.erfc(abs(z) / math.sqrt(2))
+
+
+def welch_p(base, new):
+    """Two-sided Welch t-test on summary stats (normal approximation), None without stddev"""
+    if "stddev" not in base or "stddev" not in new or base["count"] < 2 or new["count"] < 2:
+        return None
+    se = math.sqrt(base["stddev"] ** 2 / base["count"] + new["stddev"] ** 2 / new["count"])
+    if se == 0:
+        return 1.0 if base["mean"] == new["mean"] else 0.0
+    z = (new["mean"] - base["mean"]) / se
+    return math.erfc(abs(z) / math.sqrt(2))
+
+
+def compare(baseline, candidate, thresholds, alpha):
+    """Return (rows, regressions) comparing candidate against baseline"""
+    rows = []
+    regressions = []
+    for metric, keys in sorted(baseline.metrics.items()):
+        limits = thresholds.get(metric, {})
+        for key, base_stats in sorted(keys.items()):
+            new_stats = candidate.metrics.get(metric, {}).get(key)
+            if new_stats is None:
+                continue
+            samples_base = baseline.series.get((metric, key))
+            samples_new = candidate.series.get((metric, key))
+            # Per-second means are far less autocorrelated than raw per-buffer samples
+            if samples_base and samples_new:
+                p_value = mann_whitney_p(samples_base, samples_new)
+            else:
+                p_value = welch_p(base_stats, new_stats)
+            for stat in ("mean", "p50", "p99"):
+                if stat not in base_stats or stat not in new_stats:
+                    continue
+                old, new = base_stats[stat], new_stats[stat]
+                delta = 100 * (new - old) / old if old else (0.0 if new == old else math.inf)
+                worse = -delta if metric in HIGHER_IS_BETTER else delta
+                limit = limits.get(stat)
+                exceeded = limit is not None and worse > limit
+                # Without samples or stddev there is no test, such rows are reported, not failed
+                regressed = exceeded and p_value is not None and p_value < alpha
+                row = {"metric": metric, "key": key, "stat": stat, "baseline": old, "candidate": new,
+                       "delta_percent": delta, "p_value": p_value, "threshold_percent": limit,
+                       "regression": regressed, "untested": exceeded and p_value is None}
+                rows.append(row)
+                if regressed:
+                    regressions.append(row)
+    return rows, regressions
+
+
+def element_changes(baseline, candidate):
+    if not baseline.elements or not candidate.elements:
+        return {}
+    return {
+        "added": sorted(set(candidate.elements) - set(baseline.elements)),
+        "removed": sorted(set(baseline.elements) - set(candidate.elements)),
+        "type_changed": sorted(name for name in set(baseline.elements) & set(candidate.elements)
+                               if baseline.elements[name] != candidate.elements[name]),
+    }
+
+
+def parse_threshold(text):
+    """metric:stat=percent, e.g. latency_ms:p99=15"""
+    target, _, value = text.partition("=")
+    metric, _, stat = target.partition(":")
+    if not value or not stat:
+        raise argparse.ArgumentTypeError(f"expected metric:stat=percent, got {text}")
+    return metric, stat, float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fullAnalysis runs and fail on regressions")
+    parser.add_argument("runs", nargs="+", help="baseline first, then one or more candidates")
+    parser.add_argument("--threshold", action="append", type=parse_threshold, default=[],
+                        help="override a limit as metric:stat=percent (repeatable)")
+    parser.add_argument("--thresholds", help="JSON file of {metric: {stat: percent}} replacing the defaults")
+    parser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA,
+                        help="significance level for a change to count (default: 0.05)")
+    parser.add_argument("--json", help="write the full comparison to this file")
+    parser.add_argument("--all", action="store_true", help="print every row, not only threshold-checked ones")
+    args = parser.parse_args()
+    if len(args.runs) < 2:
+        parser.error("need a baseline and at least one candidate")
+
+    thresholds = {metric: dict(stats) for metric, stats in DEFAULT_THRESHOLDS.items()}
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+    for metric, stat, value in args.threshold:
+        thresholds.setdefault(metric, {})[stat] = value
+
+    baseline = RunResults(args.runs[0])
+    report = {"baseline": args.runs[0], "candidates": []}
+    failed = False
+    for path in args.runs[1:]:
+        candidate = RunResults(path)
+        rows, regressions = compare(baseline, candidate, thresholds, args.alpha)
+        changes = element_changes(baseline, candidate)
+        untested = [row for row in rows if row["untested"]]
+        report["candidates"].append({"path": path, "elements": changes, "rows": rows,
+                                     "regressions": len(regressions), "untested": len(untested)})
+        failed = failed or bool(regressions)
+
+        print(f"\n📊 {args.runs[0]} -> {path}")
+        for kind, names in changes.items():
+            if names:
+                print(f"   elements {kind}: {', '.join(names)}")
+        for row in rows:
+            if not args.all and row["threshold_percent"] is None:
+                continue
+            p_value = "   n/a" if row["p_value"] is None else f"{row['p_value']:.4f}"
+            marker = "❌" if row["regression"] else "❔" if row["untested"] else "  "
+            print(f"{marker} {row['metric']:<20} {row['key'][:50]:<50} {row['stat']:<4} "
+                  f"{row['baseline']:>10.3f} -> {row['candidate']:>10.3f} "
+                  f"({row['delta_percent']:+6.1f}%, p={p_value})")
+        print(f"   {len(regressions)} regression(s)")
+        if untested:
+            print(f"   {len(untested)} change(s) past the threshold without samples to test them (❔)")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
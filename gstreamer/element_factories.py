@@ -0,0 +1,57 @@
+"""Element factories looked up and loaded once per process.
+
+Loading a factory loads its plugin, which is what makes the first pipeline slow. Every
+element of stream.py, recorder.py, snapshot.py and frame_filters.py is created here, so
+they share one cache. It is used from the event loop, the warm start executor thread
+and GStreamer threads, so it is kept behind a lock.
+"""
+import threading
+import time
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+factory_cache = {}
+# Seconds spent finding and loading factories so far, read by the startup profiler
+factory_lookup_time = 0.0
+# Held while a factory loads, so a second thread waits for it instead of loading it again
+factory_lock = threading.Lock()
+
+
+def load_factory(factory_name):
+    """Look up and load an element factory once, later lookups hit the cache"""
+    global factory_lookup_time
+    with factory_lock:
+        factory = factory_cache.get(factory_name)
+        if factory is None:
+            start = time.perf_counter()
+            factory = Gst.ElementFactory.find(factory_name)
+            if factory is not None:
+                # Loading the plugin is the expensive part
+                factory = factory.load()
+                factory_cache[factory_name] = factory
+            factory_lookup_time += time.perf_counter() - start
+    return factory
+
+
+def make_element(factory_name, name):
+    """Gst.ElementFactory.make going through the factory cache"""
+    factory = load_factory(factory_name)
+    if factory is None:
+        print(f"Element factory {factory_name} not found")
+        return None
+    return factory.create(name)
+
+
+def lookup_time():
+    with factory_lock:
+        return factory_lookup_time
+
+
+def preload_factories(factory_names):
+    start = time.perf_counter()
+    for factory_name in factory_names:
+        load_factory(factory_name)
+    print(f"Preloaded {len(factory_cache)} element factories in {(time.perf_counter() - start) * 1000:.0f} ms")
@@ -0,0 +1,275 @@
+import abc
+import bisect
+import threading
+import time
+
+import cv2 as cv
+import gi
+import numpy as np
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from element_factories import make_element
+
+# Upper bounds of the timing histogram buckets in milliseconds
+HISTOGRAM_BUCKETS_MS = [0.25, 0.5, 1, 2, 4, 8, 16, 33, 66, 133, float("inf")]
+FILTER_STATS_INTERVAL = 10.0
+
+# Detection hooks are registered by name and referenced from the Negotiate message
+DETECTION_HOOKS = {}
+
+
+def register_detection_hook(name, hook):
+    """Register hook(frame) -> list of (x, y, w, h, label) boxes drawn on the frame"""
+    DETECTION_HOOKS[name] = hook
+
+
+class TimingHistogram:
+    """Fixed-bucket histogram of per-frame processing times"""
+
+    def __init__(self):
+        self.counts = [0] * len(HISTOGRAM_BUCKETS_MS)
+        self.total_ms = 0.0
+        self.samples = 0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS_MS, ms)] += 1
+        self.total_ms += ms
+        self.samples += 1
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile"""
+        target = q / 100 * self.samples
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return HISTOGRAM_BUCKETS_MS[-1]
+
+    def summary(self):
+        if not self.samples:
+            return {}
+        return {
+            "frames": self.samples,
+            "mean_ms": round(self.total_ms / self.samples, 2),
+            "p50_ms": self.percentile(50),
+            "p99_ms": self.percentile(99),
+        }
+
+
+class FrameFilter(abc.ABC):
+    """One step of a FilterChain.
+
+    In-place filters modify `frame` and return it. Out-of-place filters write into
+    `out`, a buffer the chain preallocated with the frame's shape, and return it.
+    `option_types` lists the options a filter accepts, checked by check_config.
+    """
+    name = "filter"
+    in_place = True
+    option_types = {}
+
+    def __init__(self, **options):
+        self.options = options
+        self.timing = TimingHistogram()
+
+    @abc.abstractmethod
+    def process(self, frame, out):
+        """Return the filtered frame"""
+
+    @classmethod
+    def check_options(cls, options):
+        for key, value in options.items():
+            expected = cls.option_types.get(key)
+            if expected is None:
+                raise ValueError(f"{cls.name} has no option {key!r}")
+            if not isinstance(value, expected) or isinstance(value, bool):
+                raise ValueError(f"{cls.name} option {key!r} has the wrong type")
+
+
+class UndistortFilter(FrameFilter):
+    name = "undistort"
+    in_place = False
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        from opencvFix import map1, map2
+        self.map1, self.map2 = map1, map2
+
+    def process(self, frame, out):
+        return cv.remap(frame, self.map1, self.map2, interpolation=cv.INTER_LINEAR,
+                        borderMode=cv.BORDER_CONSTANT, dst=out)
+
+
+class CropFilter(FrameFilter):
+    """Crop to x, y, width, height and scale back up to the stream size"""
+    name = "crop"
+    in_place = False
+    option_types = {"x": int, "y": int, "width": int, "height": int}
+
+    def process(self, frame, out):
+        x, y = self.options.get("x", 0), self.options.get("y", 0)
+        w = self.options.get("width", frame.shape[1] - x)
+        h = self.options.get("height", frame.shape[0] - y)
+        return cv.resize(frame[y:y + h, x:x + w], (out.shape[1], out.shape[0]), dst=out,
+                         interpolation=cv.INTER_LINEAR)
+
+
+class OverlayFilter(FrameFilter):
+    """Draw a text label, `{time}` is replaced by the wall clock"""
+    name = "overlay"
+    option_types = {"text": str, "x": int, "y": int, "scale": (int, float)}
+
+    def process(self, frame, out):
+        text = self.options.get("text", "{time}").replace("{time}", time.strftime("%H:%M:%S"))
+        cv.putText(frame, text, (self.options.get("x", 20), self.options.get("y", 40)),
+                   cv.FONT_HERSHEY_SIMPLEX, self.options.get("scale", 1.0), (255, 255, 255), 2)
+        return frame
+
+
+class DetectionFilter(FrameFilter):
+    """Run a registered detection hook and draw its boxes"""
+    name = "detect"
+    option_types = {"hook": str}
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.hook = DETECTION_HOOKS[options["hook"]]
+
+    @classmethod
+    def check_options(cls, options):
+        super().check_options(options)
+        if options.get("hook") not in DETECTION_HOOKS:
+            raise ValueError(f"detection hook {options.get('hook')!r} is not registered")
+
+    def process(self, frame, out):
+        for x, y, w, h, label in self.hook(frame):
+            cv.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+            cv.putText(frame, str(label), (x, max(y - 5, 0)), cv.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+        return frame
+
+
+FILTERS = {f.name: f for f in [UndistortFilter, CropFilter, OverlayFilter, DetectionFilter]}
+
+
+def check_config(config):
+    """Raise ValueError unless config is a list of known filters with valid options"""
+    if not isinstance(config, list):
+        raise ValueError("filters must be a list")
+    for entry in config:
+        if not isinstance(entry, dict) or entry.get("name") not in FILTERS:
+            raise ValueError(f"unknown filter {entry!r}")
+        FILTERS[entry["name"]].check_options({k: v for k, v in entry.items() if k != "name"})
+
+
+class FilterChain:
+    """Ordered filters over one frame shape, sharing two preallocated ping-pong buffers"""
+
+    def __init__(self, filters, shape):
+        self.filters = filters
+        self.buffers = [np.empty(shape, dtype=np.uint8), np.empty(shape, dtype=np.uint8)]
+
+    @classmethod
+    def from_config(cls, config, shape):
+        """Build from [{"name": "undistort"}, {"name": "crop", "x": 0, ...}, ...], ValueError if it is invalid"""
+        check_config(config)
+        filters = []
+        for entry in config:
+            options = {k: v for k, v in entry.items() if k != "name"}
+            filters.append(FILTERS[entry["name"]](**options))
+        return cls(filters, shape)
+
+    def run(self, frame):
+        # The mapped input is read-only, in-place filters need a writable copy first
+        current = frame
+        spare = 0
+        for f in self.filters:
+            start = time.perf_counter()
+            if f.in_place:
+                if current is frame:
+                    np.copyto(self.buffers[spare], frame)
+                    current = self.buffers[spare]
+                    spare ^= 1
+                current = f.process(current, None)
+            else:
+                current = f.process(current, self.buffers[spare])
+                spare ^= 1
+            f.timing.add((time.perf_counter() - start) * 1000)
+        return current
+
+
+class FilterStage:
+    """appsink -> FilterChain -> appsrc stage for one camera.
+
+    The chain can be swapped at any time with set_filters(), the pipeline is untouched.
+    An empty chain passes buffers through without mapping them.
+    """
+
+    def __init__(self, name, width, height):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.chain = FilterChain([], (height, width, 3))
+        self.appsrc = None
+        self.lock = threading.Lock()
+        self.last_report = time.monotonic()
+
+    def set_filters(self, config):
+        chain = FilterChain.from_config(config, (self.height, self.width, 3))
+        with self.lock:
+            self.chain = chain
+        print(f"Filters for {self.name}: {[f.name for f in chain.filters] or 'passthrough'}")
+
+    def make_elements(self):
+        """Return (appsink, appsrc) working on BGR frames of the stage size"""
+        caps = Gst.Caps.from_string(f"video/x-raw,format=BGR,width={self.width},height={self.height},framerate=30/1")
+        appsink = make_element("appsink", f"filter_sink_{self.name}")
+        appsink.set_property("emit-signals", True)
+        appsink.set_property("sync", False)
+        appsink.set_property("max-buffers", 1)
+        appsink.set_property("drop", True)
+        appsink.set_property("caps", caps)
+        appsrc = make_element("appsrc", f"filter_src_{self.name}")
+        appsrc.set_property("format", Gst.Format.TIME)
+        appsrc.set_property("is-live", True)
+        appsrc.set_property("block", True)
+        appsrc.set_property("do-timestamp", True)
+        appsrc.set_property("caps", caps)
+        appsink.connect("new-sample", self.on_new_sample)
+        self.appsrc = appsrc
+        return appsink, appsrc
+
+    def on_new_sample(self, appsink):
+        sample = appsink.emit("pull-sample")
+        if sample is None:
+            return Gst.FlowReturn.OK
+        buf = sample.get_buffer()
+        with self.lock:
+            chain = self.chain
+        if not chain.filters:
+            self.appsrc.emit("push-buffer", buf)
+            return Gst.FlowReturn.OK
+
+        result, map_info = buf.map(Gst.MapFlags.READ)
+        if not result:
+            print("Failed to map buffer")
+            return Gst.FlowReturn.OK
+        try:
+            frame = np.ndarray((self.height, self.width, 3), dtype=np.uint8, buffer=map_info.data)
+            out_buf = Gst.Buffer.new_wrapped(chain.run(frame).tobytes())
+        finally:
+            buf.unmap(map_info)
+        out_buf.pts = buf.pts
+        out_buf.dts = buf.dts
+        out_buf.duration = buf.duration
+        self.appsrc.emit("push-buffer", out_buf)
+        self.maybe_report(chain)
+        return Gst.FlowReturn.OK
+
+    def maybe_report(self, chain):
+        now = time.monotonic()
+        if now - self.last_report < FILTER_STATS_INTERVAL:
+            return
+        self.last_report = now
+        print(f"Filter timing {self.name}:", {f.name: f.timing.summary() for f in chain.filters})
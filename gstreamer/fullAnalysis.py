@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
 import os
+import resource
+import signal
 import subprocess
+import time
 from datetime import datetime
 import glob
 import sys
 import json
 import pydot
-from latency import parse_and_save_latency
+from tracer_analysis import analyze_tracer_log
 
 def parse_cluster(cluster):
     """Recursively parse a cluster into a dict structure"""
@@ -46,7 +51,82 @@ def parse_pipeline(dot_file):
 
     return tree
 
+# GST_TRACER output only, "*:7" debug logging costs more CPU than the pipeline itself
+TRACING_PROFILES = {
+    "latency": "latency(flags=pipeline+element+reported)",
+    "proctime": "proctime;queuelevel",
+    "full": "latency(flags=pipeline+element+reported);proctime;queuelevel;interlatency;framerate;bitrate",
+}
+TARGETS = {
+    "stream": "stream.py",
+    "undistort": "undistort.py",
+}
+DEFAULT_NEGOTIATE = {"type": "Negotiate", "cameras": [0], "audio": False}
+SERVER_URL = "ws://localhost:8765"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the robot pipeline under GStreamer tracers")
+    parser.add_argument("--profile", choices=sorted(TRACING_PROFILES), default="latency",
+                        help="tracers to enable (default: latency)")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="stream",
+                        help="entry point to run (default: stream)")
+    parser.add_argument("--duration", type=float,
+                        help="seconds to run, waits for 'q' + Enter when omitted")
+    parser.add_argument("--negotiate", type=json.loads, default=DEFAULT_NEGOTIATE,
+                        help="Negotiate message sent to start the pipeline (JSON)")
+    parser.add_argument("--no-baseline", action="store_true",
+                        help="skip the untraced run used to measure tracer overhead")
+    return parser.parse_args()
+
+
+def wait_for_quit():
+    while input().strip().lower() != "q":
+        pass
+
+
+async def run_session(args, env):
+    """Start the target, drive one Negotiate session and return (wall s, child CPU s)"""
+    import websockets
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), TARGETS[args.target])
+    cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(sys.executable, script, env=env,
+                                                cwd=os.path.dirname(script))
+    try:
+        # The server needs a moment to import gi and scan the registry
+        for _ in range(100):
+            try:
+                ws = await websockets.connect(SERVER_URL)
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        else:
+            raise RuntimeError(f"{TARGETS[args.target]} did not start listening on {SERVER_URL}")
+        async with ws:
+            await ws.send(json.dumps(args.negotiate))
+            if args.duration is not None:
+                await asyncio.sleep(args.duration)
+            else:
+                await asyncio.get_running_loop().run_in_executor(None, wait_for_quit)
+            print("🛑 Stopping pipeline...")
+    finally:
+        if proc.returncode is None:
+            proc.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(proc.wait(), 10)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+    wall = time.monotonic() - start
+    cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+    return wall, cpu
+
+
 def main():
+    args = parse_args()
+
     # --- Step 1: Create timestamped results directory ---
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     results_dir = os.path.abspath(f"results_{timestamp}")
@@ -58,35 +138,54 @@ def main():
     # --- Step 2: Paths ---
     tracer_log_path = os.path.join(results_dir, "tracer.log")
     metadata_path = os.path.join(results_dir, "metadata.json")
+    run_path = os.path.join(results_dir, "run.json")
 
     # --- Step 3: Environment variables ---
-    env = os.environ.copy()
-    env["GST_DEBUG"] = "*:7,GST_TRACER:7"
+    base_env = os.environ.copy()
+    for var in ("GST_DEBUG", "GST_TRACERS", "GST_DEBUG_FILE", "GST_DEBUG_DUMP_DOT_DIR"):
+        base_env.pop(var, None)
+    env = base_env.copy()
+    env["GST_DEBUG"] = "GST_TRACER:7"
     env["GST_DEBUG_DUMP_DOT_DIR"] = dot_dir
     env["GST_DEBUG_FILE"] = tracer_log_path
-    env["GST_TRACERS"] = "stats"
+    env["GST_TRACERS"] = TRACING_PROFILES[args.profile]
 
-    # --- Step 4: Run pipeline ---
-    print("▶️ Starting pipeline... (press 'q' + Enter to stop)")
-    proc = subprocess.Popen(
-        ["python", "undistortedLiveGstreamer.py"],
-        env=env,
-    )
+    run = {
+        "profile": args.profile,
+        "tracers": env["GST_TRACERS"],
+        "target": TARGETS[args.target],
+        "negotiate": args.negotiate,
+    }
 
+    # --- Step 4: Untraced baseline for the same run ---
+    if args.no_baseline or args.duration is None:
+        if not args.no_baseline:
+            print("ℹ️ Skipping baseline, it needs --duration")
+    else:
+        print(f"▶️ Baseline run without tracers ({args.duration:.0f} s)...")
+        wall, cpu = asyncio.run(run_session(args, base_env))
+        run["baseline"] = {"wall_s": wall, "cpu_s": cpu, "cpu_percent": 100 * cpu / wall}
+
+    # --- Step 5: Run pipeline ---
+    if args.duration is None:
+        print(f"▶️ Starting pipeline with '{args.profile}' tracers... (press 'q' + Enter to stop)")
+    else:
+        print(f"▶️ Starting pipeline with '{args.profile}' tracers ({args.duration:.0f} s)...")
     try:
-        while True:
-            user_input = input()
-            if user_input.strip().lower() == "q":
-                print("🛑 Stopping pipeline...")
-                proc.terminate()
-                proc.wait()
-                break
+        wall, cpu = asyncio.run(run_session(args, env))
     except KeyboardInterrupt:
-        print("⚠️ KeyboardInterrupt: stopping pipeline...")
-        proc.terminate()
-        proc.wait()
-
-    # --- Step 5: Convert DOT -> PNG ---
+        print("⚠️ KeyboardInterrupt: pipeline stopped")
+        wall, cpu = None, None
+    if wall:
+        run["traced"] = {"wall_s": wall, "cpu_s": cpu, "cpu_percent": 100 * cpu / wall}
+        if "baseline" in run and run["baseline"]["cpu_percent"]:
+            run["tracer_overhead_percent"] = 100 * (
+                run["traced"]["cpu_percent"] / run["baseline"]["cpu_percent"] - 1)
+            print(f"📈 Tracer CPU overhead: {run['tracer_overhead_percent']:.1f}%")
+    with open(run_path, "w") as f:
+        json.dump(run, f, indent=2)
+
+    # --- Step 6: Convert DOT -> PNG ---
     dot_files = glob.glob(os.path.join(dot_dir, "*.dot"))
     for dot_file in dot_files:
         png_file = os.path.join(
@@ -101,7 +200,7 @@ def main():
             print("❌ 'dot' command not found. Please install Graphviz (apt install graphviz).")
             break
 
-    # --- Step 6: Generate metadata.json from DOT ---
+    # --- Step 7: Generate metadata.json from DOT ---
     metadata = {}
     for dot_file in dot_files:
         name = os.path.splitext(os.path.basename(dot_file))[0]
@@ -113,14 +212,16 @@ def main():
     with open(metadata_path, "w") as f:
         json.dump(metadata, f, indent=2)
 
-    parse_and_save_latency(results_dir)
+    summary_path, timeseries_path = analyze_tracer_log(tracer_log_path, results_dir)
 
     print(f"\n✅ Results stored in: {results_dir}")
     print(f"   - DOT files: {dot_dir}")
     print(f"   - PNG files: {png_dir}")
     print(f"   - Tracer log: {tracer_log_path}")
     print(f"   - Metadata: {metadata_path}")
-    print(f"   - Created latency files")
+    print(f"   - Run info: {run_path}")
+    print(f"   - Tracer summary: {summary_path}")
+    print(f"   - Tracer time series: {timeseries_path}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,205 @@
+import collections
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from element_factories import make_element
+
+RECORDING_DIR = os.getenv('RECORDING_DIR', "recordings")
+# Encoded frames waiting for the muxer, the writer pipeline drops nothing below this
+WRITER_QUEUE_BYTES = 64 * 1024 * 1024
+
+EncodedFrame = collections.namedtuple("EncodedFrame", ["pts", "size", "buffer", "keyframe"])
+
+
+class RecorderTrack:
+    """Ring buffer of encoded frames for one elementary stream"""
+
+    def __init__(self, name, is_video):
+        self.name = name
+        self.is_video = is_video
+        self.caps = None
+        self.ring = collections.deque()
+        self.bytes = 0
+        self.appsrc = None
+        self.waiting_keyframe = False
+
+    def append(self, frame):
+        self.ring.append(frame)
+        self.bytes += frame.size
+
+    def popleft(self):
+        frame = self.ring.popleft()
+        self.bytes -= frame.size
+        return frame
+
+    def clear(self):
+        self.ring.clear()
+        self.bytes = 0
+
+
+class EncodedRecorder:
+    """Keeps the last seconds of encoded VP8/Opus in memory and writes them to WebM on demand.
+
+    The encoders are tee'd into appsinks, so recording costs no extra encode. Streaming
+    threads only append to the ring or hand buffers to the writer's appsrc, muxing and
+    file I/O run in a separate pipeline.
+    """
+
+    def __init__(self, seconds: float, max_bytes: int, output_dir: str = RECORDING_DIR):
+        self.window = int(seconds * Gst.SECOND)
+        self.max_bytes = max_bytes
+        self.output_dir = output_dir
+        self.tracks = []
+        self.lock = threading.Lock()
+        self.writer = None
+        self.base_pts = None
+        self.path = None
+
+    @property
+    def recording(self):
+        return self.writer is not None
+
+    def make_sink(self, name, is_video):
+        """Create an appsink collecting one encoded stream, to be linked behind a tee"""
+        track = RecorderTrack(name, is_video)
+        self.tracks.append(track)
+        appsink = make_element("appsink", f"record_sink_{name}")
+        appsink.set_property("emit-signals", True)
+        appsink.set_property("sync", False)
+        appsink.set_property("async", False)
+        appsink.connect("new-sample", self.on_new_sample, track)
+        return appsink
+
+    def on_new_sample(self, appsink, track):
+        sample = appsink.emit("pull-sample")
+        if sample is None:
+            return Gst.FlowReturn.OK
+        buf = sample.get_buffer()
+        frame = EncodedFrame(buf.pts, buf.get_size(), buf, not buf.has_flags(Gst.BufferFlags.DELTA_UNIT))
+        with self.lock:
+            if track.caps is None:
+                track.caps = sample.get_caps()
+            if self.writer is not None:
+                self._push(track, frame)
+            else:
+                track.append(frame)
+                self._trim(track)
+        return Gst.FlowReturn.OK
+
+    @property
+    def buffered_bytes(self):
+        return sum(t.bytes for t in self.tracks)
+
+    def _trim(self, track):
+        newest = track.ring[-1].pts
+        while track.ring and newest - track.ring[0].pts > self.window:
+            track.popleft()
+        self._drop_to_keyframe(track)
+        # max_bytes bounds all tracks together, the oldest frame of any track goes first
+        while self.buffered_bytes > self.max_bytes:
+            oldest = min((t for t in self.tracks if t.ring), key=lambda t: t.ring[0].pts)
+            oldest.popleft()
+            self._drop_to_keyframe(oldest)
+
+    @staticmethod
+    def _drop_to_keyframe(track):
+        # A recording has to start on a keyframe, frames before it are undecodable
+        while track.is_video and track.ring and not track.ring[0].keyframe:
+            track.popleft()
+
+    def _push(self, track, frame):
+        if track.appsrc is None or frame.pts < self.base_pts:
+            return
+        if track.waiting_keyframe:
+            if not frame.keyframe:
+                return
+            track.waiting_keyframe = False
+        out = frame.buffer.copy()
+        out.pts = frame.pts - self.base_pts
+        out.dts = Gst.CLOCK_TIME_NONE
+        track.appsrc.emit("push-buffer", out)
+
+    def start(self, path: Optional[str] = None) -> Optional[str]:
+        """Flush the ring buffer to a new file and keep appending live frames until stop()"""
+        with self.lock:
+            if self.writer is not None:
+                return self.path
+            tracks = [t for t in self.tracks if t.caps is not None]
+            buffered_video = [t for t in tracks if t.is_video and t.ring]
+            if not buffered_video:
+                print("Recorder: no keyframe buffered yet, cannot start recording")
+                return None
+            # Start where every buffered video track can be decoded
+            self.base_pts = max(t.ring[0].pts for t in buffered_video)
+            for track in tracks:
+                track.waiting_keyframe = track.is_video
+            if path is None:
+                os.makedirs(self.output_dir, exist_ok=True)
+                path = os.path.join(self.output_dir, f"recording_{datetime.now().strftime('%Y%m%d_%H%M%S')}.webm")
+            self.path = path
+            self.writer = self._build_writer(tracks, path)
+            self.writer.set_state(Gst.State.PLAYING)
+            flushed = 0
+            for track in tracks:
+                while track.ring:
+                    self._push(track, track.popleft())
+                    flushed += 1
+            for track in self.tracks:
+                track.clear()
+        print(f"Recording to {path} ({flushed} buffered frames)")
+        return path
+
+    def _build_writer(self, tracks, path):
+        writer = Gst.Pipeline.new("recorder")
+        mux = make_element("webmmux", "record_mux")
+        sink = make_element("filesink", "record_file")
+        sink.set_property("location", path)
+        sink.set_property("async", False)
+        writer.add(mux)
+        writer.add(sink)
+        mux.link(sink)
+        for track in tracks:
+            appsrc = make_element("appsrc", f"record_src_{track.name}")
+            appsrc.set_property("caps", track.caps)
+            appsrc.set_property("format", Gst.Format.TIME)
+            appsrc.set_property("block", False)
+            appsrc.set_property("max-bytes", WRITER_QUEUE_BYTES)
+            writer.add(appsrc)
+            appsrc.link(mux)
+            track.appsrc = appsrc
+        bus = writer.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self.on_writer_message)
+        return writer
+
+    def stop(self):
+        """Finish the current file, the writer is torn down once the muxer has seen EOS"""
+        with self.lock:
+            if self.writer is None:
+                return
+            for track in self.tracks:
+                if track.appsrc is not None:
+                    track.appsrc.emit("end-of-stream")
+                    track.appsrc = None
+            self.writer = None
+        print(f"Recording to {self.path} stopping")
+
+    def on_writer_message(self, bus, message):
+        if message.type in (Gst.MessageType.EOS, Gst.MessageType.ERROR):
+            if message.type == Gst.MessageType.ERROR:
+                err, _ = message.parse_error()
+                print("Recorder error:", err.message)
+            pipeline = message.src
+            while pipeline.get_parent() is not None:
+                pipeline = pipeline.get_parent()
+            bus.remove_signal_watch()
+            pipeline.set_state(Gst.State.NULL)
+            print("Recording finished at", time.strftime("%H:%M:%S"))
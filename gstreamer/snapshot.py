@@ -0,0 +1,78 @@
+import threading
+import time
+
+import gi
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst, GstVideo
+
+from element_factories import make_element
+
+JPEG_CAPS = Gst.Caps.from_string("image/jpeg")
+# Conversion of one frame on the Pi takes a few tens of ms, anything longer is stuck
+ENCODE_TIMEOUT = 2 * Gst.SECOND
+
+
+class SnapshotCache:
+    """Holds the latest raw frame of one camera and JPEG-encodes it only when asked.
+
+    The streaming thread just swaps a sample reference. The first request for a new
+    frame pays for one encode, every other request for that frame gets the cached JPEG.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.encode_lock = threading.Lock()
+        self.sample = None
+        self.sequence = 0
+        self.captured_at = None
+        self.jpeg = None
+        self.jpeg_sequence = -1
+        self.jpeg_captured_at = None
+        self.encodes = 0
+        self.requests = 0
+
+    def make_sink(self):
+        """Create the appsink for the snapshot branch, to be linked behind a leaky queue"""
+        appsink = make_element("appsink", f"snapshot_sink_{self.name}")
+        appsink.set_property("emit-signals", True)
+        appsink.set_property("sync", False)
+        appsink.set_property("async", False)
+        appsink.set_property("max-buffers", 1)
+        appsink.set_property("drop", True)
+        appsink.connect("new-sample", self.on_new_sample)
+        return appsink
+
+    def on_new_sample(self, appsink):
+        sample = appsink.emit("pull-sample")
+        if sample is not None:
+            with self.lock:
+                self.sample = sample
+                self.sequence += 1
+                self.captured_at = time.time()
+        return Gst.FlowReturn.OK
+
+    def get_jpeg(self):
+        """Return (sequence, captured_at, jpeg bytes) for the latest frame, None before the first frame.
+
+        Raises GLib.Error when the frame can't be converted to JPEG.
+        """
+        with self.lock:
+            # Requests are served from executor threads, so the counter is only changed under the lock
+            self.requests += 1
+            sample, sequence, captured_at = self.sample, self.sequence, self.captured_at
+        if sample is None:
+            return None
+        # Concurrent requests for the same frame wait for a single encode
+        with self.encode_lock:
+            if self.jpeg_sequence != sequence:
+                converted = GstVideo.video_convert_sample(sample, JPEG_CAPS, ENCODE_TIMEOUT)
+                buf = converted.get_buffer()
+                self.jpeg = buf.extract_dup(0, buf.get_size())
+                self.jpeg_sequence = sequence
+                self.jpeg_captured_at = captured_at
+                self.encodes += 1
+            # Another request may have encoded a newer frame meanwhile, it is returned with its own timestamp
+            return self.jpeg_sequence, self.jpeg_captured_at, self.jpeg
@@ -1,11 +1,17 @@
+import time
+STARTUP_T0 = time.perf_counter()
+
 import asyncio
+import base64
 import json
 import ssl
+import sys
 import websockets
 
 import gi
 import numpy as np
 import os
+import threading
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -18,14 +24,30 @@ gi.require_version('Gst', '1.0')
 gi.require_version('GstWebRTC', '1.0')
 gi.require_version('GstSdp', '1.0')
 from gi.repository import Gst, GstWebRTC, GstSdp, GLib
+IMPORTS_DONE = time.perf_counter()
 
 Gst.init(None)
+GST_INIT_DONE = time.perf_counter()
+from element_factories import lookup_time, make_element, preload_factories
+from recorder import EncodedRecorder
+from snapshot import SnapshotCache
 TURN_URL = f"turn://{os.getenv('TURN_USERNAME')}:{os.getenv('TURN_PASSWORD')}@{os.getenv('TURN_SERVER')}"
+STUN_URL = "stun://stun.l.google.com:19302"
 PIPELINE_DESC = '''
 webrtcbin name=sendrecv
     bundle-policy=max-bundle
-    stun-server=stun://stun.l.google.com:19302
 '''
+# Local candidates are coalesced for this long before being sent to the app
+ICE_BATCH_WINDOW = 0.02
+# Keyframes come from PLI/FIR requests, the periodic one is only a fallback
+KEYFRAME_MAX_DIST = int(os.getenv('KEYFRAME_MAX_DIST', 600))
+# Repeated PLIs for the same loss event are collapsed into one keyframe
+KEYFRAME_MIN_INTERVAL = 0.5
+# Error resilient mode caps keyframes at this percentage of the average frame size
+RESILIENT_MAX_INTRA_BITRATE = 300
+ENCODER_STATS_INTERVAL = 10.0
+# Pre-event recording buffer, enabled per session with the record_buffer Negotiate option
+RECORD_MAX_BYTES = int(os.getenv('RECORD_MAX_BYTES', 32 * 1024 * 1024))
 # ice-transport-policy=relay
 VIDEO_SOURCES = [
     "/base/axi/pcie@1000120000/rp1/i2c@80000/ov5647@36",
@@ -33,6 +55,18 @@ VIDEO_SOURCES = [
 ]
 
 AUDIO_SOURCE = "hw:0,0"
+# Warm start preloads element factories in the background once the server listens
+WARM_START = "--warm-start" in sys.argv or os.getenv('WARM_START') == "1"
+WARM_FACTORIES = [
+    "webrtcbin", "libcamerasrc", "capsfilter", "videoconvert", "queue", "tee", "appsink", "appsrc",
+    "vp8enc", "rtpvp8pay", "alsasrc", "audioconvert", "audioresample", "opusenc", "rtpopuspay",
+    "rtpvp8depay", "vp8dec", "videoscale", "glimagesink", "rtpopusdepay", "opusdec", "autoaudiosink",
+    "webmmux", "filesink",
+]
+# Pipeline graphs are only written when GStreamer's own dump directory is configured
+DOT_DUMPS = bool(os.getenv('GST_DEBUG_DUMP_DOT_DIR'))
+# Snapshot requests are served separately so pollers never touch the WebRTC client socket
+SNAPSHOT_PORT = 8767
 async def glib_main_loop_iteration():
     while True:
         # Process all pending GLib events without blocking
@@ -42,6 +76,144 @@ async def glib_main_loop_iteration():
         await asyncio.sleep(0.01)
 
 
+class StartupProfiler:
+    """Startup breakdown: imports, Gst.init, and factory lookups, build and PLAYING per pipeline"""
+
+    def __init__(self):
+        self.process = {
+            "imports_ms": round((IMPORTS_DONE - STARTUP_T0) * 1000, 1),
+            "gst_init_ms": round((GST_INIT_DONE - IMPORTS_DONE) * 1000, 1),
+        }
+        self.first_playing_reported = False
+        self.pipeline = {}
+        self.build_start = None
+        self.lookup_start = 0.0
+
+    def listening(self):
+        self.process["listening_ms"] = round((time.perf_counter() - STARTUP_T0) * 1000, 1)
+        print("Startup:", self.process)
+
+    def pipeline_started(self):
+        self.build_start = time.perf_counter()
+        self.lookup_start = lookup_time()
+
+    def pipeline_built(self):
+        self.pipeline = {
+            "factory_lookups_ms": round((lookup_time() - self.lookup_start) * 1000, 1),
+            "build_ms": round((time.perf_counter() - self.build_start) * 1000, 1),
+        }
+
+    def pipeline_playing(self):
+        if self.build_start is None:
+            return
+        self.pipeline["playing_ms"] = round((time.perf_counter() - self.build_start) * 1000, 1)
+        self.build_start = None
+        if not self.first_playing_reported:
+            self.first_playing_reported = True
+            self.pipeline["first_playing_since_start_ms"] = round((time.perf_counter() - STARTUP_T0) * 1000, 1)
+        print("Pipeline startup:", self.pipeline)
+
+
+class NegotiationTimer:
+    """Records milestones of a session relative to the Negotiate message"""
+    MILESTONES = ["offer_sent", "ice_connected", "first_frame"]
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.marks = {}
+        self.reported = False
+
+    def mark(self, name):
+        # Signals may fire repeatedly (ICE state flaps), keep the first one
+        if name not in self.marks:
+            self.marks[name] = time.monotonic()
+        if not self.reported and all(m in self.marks for m in self.MILESTONES):
+            self.reported = True
+            print("Connection timing:", self.summary())
+
+    def summary(self):
+        return {name: round((self.marks[name] - self.start) * 1000, 1)
+                for name in self.MILESTONES if name in self.marks}
+
+
+class KeyframeController:
+    """Rate-limits keyframe requests for one encoder and measures bitrate shape"""
+
+    def __init__(self, name):
+        self.name = name
+        self.last_forwarded = 0.0
+        self.pending_since = None
+        self.requests = 0
+        self.forwarded = 0
+        self.recovery_times = []
+        self.reset_window(time.monotonic())
+
+    def reset_window(self, now):
+        self.window_start = now
+        self.slot_start = now
+        self.slot_bytes = 0
+        self.slots = []
+        self.frames = 0
+        self.keyframes = 0
+        self.total_bytes = 0
+        self.peak_frame = 0
+
+    def on_upstream_event(self, pad, info):
+        # webrtcbin turns RTCP PLI/FIR into GstForceKeyUnit events travelling upstream
+        event = info.get_event()
+        structure = event.get_structure()
+        if event.type != Gst.EventType.CUSTOM_UPSTREAM or not structure or structure.get_name() != "GstForceKeyUnit":
+            return Gst.PadProbeReturn.OK
+        self.requests += 1
+        now = time.monotonic()
+        if now - self.last_forwarded < KEYFRAME_MIN_INTERVAL:
+            return Gst.PadProbeReturn.DROP
+        self.last_forwarded = now
+        self.forwarded += 1
+        if self.pending_since is None:
+            self.pending_since = now
+        return Gst.PadProbeReturn.OK
+
+    def on_encoded_buffer(self, pad, info):
+        buf = info.get_buffer()
+        now = time.monotonic()
+        size = buf.get_size()
+        self.frames += 1
+        self.total_bytes += size
+        self.peak_frame = max(self.peak_frame, size)
+        if not buf.has_flags(Gst.BufferFlags.DELTA_UNIT):
+            self.keyframes += 1
+            if self.pending_since is not None:
+                self.recovery_times.append(now - self.pending_since)
+                self.pending_since = None
+        # 100ms slots give the short-term bitrate that bursts on the link
+        if now - self.slot_start >= 0.1:
+            self.slots.append(self.slot_bytes)
+            self.slot_start = now
+            self.slot_bytes = 0
+        self.slot_bytes += size
+        if now - self.window_start >= ENCODER_STATS_INTERVAL:
+            print(f"Encoder {self.name}:", self.summary(now))
+            self.reset_window(now)
+        return Gst.PadProbeReturn.OK
+
+    def summary(self, now):
+        elapsed = now - self.window_start
+        avg_frame = self.total_bytes / self.frames if self.frames else 0
+        avg_slot = sum(self.slots) / len(self.slots) if self.slots else 0
+        recovery = sorted(self.recovery_times)
+        return {
+            "kbps": round(self.total_bytes * 8 / elapsed / 1000, 1),
+            "keyframes": self.keyframes,
+            "keyframe_requests": self.requests,
+            "keyframes_forced": self.forwarded,
+            "peak_to_avg_frame": round(self.peak_frame / avg_frame, 2) if avg_frame else 0,
+            "peak_to_avg_100ms": round(max(self.slots) / avg_slot, 2) if avg_slot else 0,
+            "recovery_ms_p50": round(recovery[len(recovery) // 2] * 1000, 1) if recovery else None,
+            "recovery_ms_max": round(recovery[-1] * 1000, 1) if recovery else None,
+        }
+
+
 class WebRTCServer:
     def __init__(self, loop):
         self.pipe = None
@@ -50,12 +222,48 @@ class WebRTCServer:
         self.loop = loop
         self.added_data_channel = False
         self.added_streams = 0
+        self.timer = None
+        # Local ICE candidates are produced on webrtcbin's thread and batched
+        self.ice_lock = threading.Lock()
+        self.pending_local_candidates = []
+        self.ice_flush_scheduled = False
+        self.ice_batching = False
+        self.lan_mode = False
+        # Remote ICE candidates that arrive before the answer is applied
+        self.pending_remote_candidates = []
+        self.remote_description_set = False
+        self.keyframe_controllers = []
+        self.recorder = None
+        self.snapshots: dict[int, SnapshotCache] = {}
+        self.filter_stages = {}
+        self.profiler = StartupProfiler()
+        # Sends nobody waits for, referenced here until they finish
+        self.background_sends = set()
+    def link_encoded(self, encoder, payloader, name, is_video):
+        """Link encoder to payloader, tee'ing the encoded stream into the recorder if enabled"""
+        if self.recorder is None:
+            encoder.link(payloader)
+            return
+        tee = make_element("tee", f"record_tee_{name}")
+        pay_queue = make_element("queue", f"record_pay_queue_{name}")
+        record_queue = make_element("queue", f"record_queue_{name}")
+        # Never let the recording branch hold back the live stream
+        record_queue.set_property("leaky", 2)
+        appsink = self.recorder.make_sink(name, is_video)
+        for e in [tee, pay_queue, record_queue, appsink]:
+            self.pipe.add(e)
+        encoder.link(tee)
+        tee.link(pay_queue)
+        pay_queue.link(payloader)
+        tee.link(record_queue)
+        record_queue.link(appsink)
+
     def connect_audio(self, webrtc):
-        audio_src = Gst.ElementFactory.make("alsasrc", "audio_src")
-        audio_conv = Gst.ElementFactory.make("audioconvert", "audio_conv")
-        audio_resample = Gst.ElementFactory.make("audioresample", "audio_resample")
-        opus_enc = Gst.ElementFactory.make("opusenc", "opus_enc")
-        rtp_pay = Gst.ElementFactory.make("rtpopuspay", "rtp_pay")
+        audio_src = make_element("alsasrc", "audio_src")
+        audio_conv = make_element("audioconvert", "audio_conv")
+        audio_resample = make_element("audioresample", "audio_resample")
+        opus_enc = make_element("opusenc", "opus_enc")
+        rtp_pay = make_element("rtpopuspay", "rtp_pay")
         rtp_pay.set_property("pt", 98)
 
         for e in [audio_src, audio_conv, audio_resample, opus_enc, rtp_pay]:
@@ -64,7 +272,7 @@ class WebRTCServer:
         audio_src.link(audio_conv)
         audio_conv.link(audio_resample)
         audio_resample.link(opus_enc)
-        opus_enc.link(rtp_pay)
+        self.link_encoded(opus_enc, rtp_pay, "audio", False)
 
         # --- Request audio pad from webrtcbin ---
         # Use caps for RTP/OPUS
@@ -81,11 +289,24 @@ class WebRTCServer:
         else:
             print("Audio linked to webrtcbin")
 
-    def start_pipeline(self, active_cameras: list[int] = [1], audio: bool = True, undistort: bool = False):
+    def start_pipeline(self, active_cameras: list[int] = [1], audio: bool = True, undistort: bool = False, lan: bool = False,
+                       keyframe_interval: int = KEYFRAME_MAX_DIST, resilient: bool = False, record_buffer: float = 0,
+                       filters=None):
         print("Starting pipeline")
+        self.profiler.pipeline_started()
         self.pipe = Gst.Pipeline.new("pipeline")
+        if record_buffer:
+            self.recorder = EncodedRecorder(record_buffer, RECORD_MAX_BYTES)
+            # The pre-event buffer starts on a keyframe, keep at least half of it usable
+            keyframe_interval = min(keyframe_interval, max(1, int(record_buffer * 30 / 2)))
         webrtc = Gst.parse_launch(PIPELINE_DESC)
-        webrtc.set_property("turn-server", TURN_URL)
+        self.lan_mode = lan
+        if lan:
+            # Direct LAN connection: host candidates are enough, skip STUN/TURN gathering
+            print("LAN mode: gathering host candidates only")
+        else:
+            webrtc.set_property("stun-server", STUN_URL)
+            webrtc.set_property("turn-server", TURN_URL)
         webrtc.set_property("ice-transport-policy", "all")
         self.pipe.add(webrtc)
         print(self.pipe)
@@ -98,44 +319,87 @@ class WebRTCServer:
         self.webrtc.connect("on-ice-candidate", self.send_ice_candidate_message)
         self.webrtc.connect("on-data-channel", self.on_data_channel)
         self.webrtc.connect("pad-added", self.on_incoming_stream)
+        self.webrtc.connect("notify::ice-connection-state", self.on_ice_connection_state)
         video_sources = []
         for i in range(len(active_cameras)):
             video_sources.append(VIDEO_SOURCES[active_cameras[i]])
         for i, cam_name in enumerate(video_sources):
             # Source + capsfilter: force YUY2 output
-            src = Gst.ElementFactory.make("libcamerasrc", f"libcamerasrc{i}")
+            src = make_element("libcamerasrc", f"libcamerasrc{i}")
             src.set_property("camera-name", cam_name)
 
             caps = Gst.Caps.from_string("video/x-raw,format=YUY2,width=1280,height=720,framerate=30/1")
-            capsfilter = Gst.ElementFactory.make("capsfilter", f"caps{i}")
+            capsfilter = make_element("capsfilter", f"caps{i}")
             capsfilter.set_property("caps", caps)
 
             # Convert to BGR for OpenCV
-            conv = Gst.ElementFactory.make("videoconvert", f"conv{i}")
-            sink_queue = Gst.ElementFactory.make("queue", f"sink_queue{i}")
+            conv = make_element("videoconvert", f"conv{i}")
+            sink_queue = make_element("queue", f"sink_queue{i}")
             sink_queue.set_property("leaky", 2)
             sink_queue.set_property("max-size-buffers", 2)
-            for e in [src, capsfilter, conv, sink_queue]:
+            # Snapshot branch only keeps a reference to the latest raw frame
+            snapshot = SnapshotCache(f"camera{active_cameras[i]}")
+            self.snapshots[active_cameras[i]] = snapshot
+            tee = make_element("tee", f"snapshot_tee{i}")
+            snapshot_queue = make_element("queue", f"snapshot_queue{i}")
+            snapshot_queue.set_property("leaky", 2)
+            snapshot_queue.set_property("max-size-buffers", 1)
+            snapshot_sink = snapshot.make_sink()
+            for e in [src, capsfilter, conv, tee, sink_queue, snapshot_queue, snapshot_sink]:
                 self.pipe.add(e)
-            # Link source -> conv -> queue
+            # Link source -> conv -> tee -> queue, tee -> snapshot
             src.link(capsfilter)
             capsfilter.link(conv)
-            conv.link(sink_queue)
+            conv.link(tee)
+            tee.link(sink_queue)
+            tee.link(snapshot_queue)
+            snapshot_queue.link(snapshot_sink)
 
             upstream_element = sink_queue
-           
-            vp8enc = Gst.ElementFactory.make("vp8enc", f"vp8enc{i}")
+
+            # --- Appsink -> filter chain -> appsrc for NumPy/OpenCV processing ---
+            camera_filters = self.filters_for_camera(filters, active_cameras[i], undistort)
+            if camera_filters is not None:
+                # OpenCV is only loaded once a session actually asks for processing
+                from frame_filters import FilterStage
+                stage = FilterStage(f"camera{active_cameras[i]}", 1280, 720)
+                stage.set_filters(camera_filters)
+                self.filter_stages[active_cameras[i]] = stage
+                bgr_conv = make_element("videoconvert", f"filter_conv{i}")
+                appsink, appsrc = stage.make_elements()
+                vidconvert = make_element("videoconvert", f"conv2{i}")
+                i420_caps = Gst.Caps.from_string("video/x-raw,format=I420,width=1280,height=720,framerate=30/1")
+                i420filter = make_element("capsfilter", f"i420filter{i}")
+                i420filter.set_property("caps", i420_caps)
+                for e in [bgr_conv, appsink, appsrc, vidconvert, i420filter]:
+                    self.pipe.add(e)
+                upstream_element.link(bgr_conv)
+                bgr_conv.link(appsink)
+                appsrc.link(vidconvert)
+                vidconvert.link(i420filter)
+                upstream_element = i420filter
+
+            vp8enc = make_element("vp8enc", f"vp8enc{i}")
             vp8enc.set_property("deadline", 1)
-            vp8enc.set_property("keyframe-max-dist", 30) 
-            pay = Gst.ElementFactory.make("rtpvp8pay", f"pay{i}")
+            vp8enc.set_property("keyframe-max-dist", keyframe_interval)
+            if resilient:
+                # vp8enc has no cyclic intra refresh, so make frames decodable after loss
+                # and stop keyframes from bursting above a multiple of the average frame
+                vp8enc.set_property("error-resilient", "default")
+                vp8enc.set_property("max-intra-bitrate", RESILIENT_MAX_INTRA_BITRATE)
+            pay = make_element("rtpvp8pay", f"pay{i}")
             pay.set_property("pt", 96 + i)
+            controller = KeyframeController(f"vp8enc{i}")
+            self.keyframe_controllers.append(controller)
+            pay.get_static_pad("src").add_probe(Gst.PadProbeType.EVENT_UPSTREAM, controller.on_upstream_event)
+            vp8enc.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, controller.on_encoded_buffer)
     
             # Add elements to pipeline
             for e in [vp8enc, pay]:
                 self.pipe.add(e)
             
             upstream_element.link(vp8enc)
-            vp8enc.link(pay)
+            self.link_encoded(vp8enc, pay, f"video{i}", True)
             print(f"Camera {i} encoding: AppSrc (BGR) -> VideoConvert -> Scale(1920x1080) -> I420 -> VP8 -> RTP")
 
             src_pad = src.get_static_pad("src")
@@ -146,35 +410,132 @@ class WebRTCServer:
                 src_pad = pay.get_static_pad("src")
                 ret = src_pad.link(sink_pad)
                 print("Pad link result", ret)
+                src_pad.add_probe(Gst.PadProbeType.BUFFER, self.on_first_frame_probe)
 
         if audio:
             self.connect_audio(webrtc)
         self.webrtc.connect("on-negotiation-needed", self.on_negotiation_needed)
+        self.profiler.pipeline_built()
         self.pipe.set_state(Gst.State.PLAYING)
-        Gst.debug_bin_to_dot_file(self.pipe, Gst.DebugGraphDetails.ALL, "pipeline_graph")
+        self.dump_dot("pipeline_graph")
         
         # os.environ["GST_DEBUG"] = "GST_TRACER:7"
         # os.environ["GST_TRACERS"] = "cpuusage;queuelevel;interlatency;proctime;bitrate;framerate;buffer;scheduling;graphic"
         print("Pipeline started")
 
+    def filters_for_camera(self, filters, camera, undistort=False):
+        """Filter config for one camera, from a list for all cameras or a dict keyed by camera id"""
+        if isinstance(filters, dict):
+            filters = filters.get(str(camera), filters.get(camera))
+        if filters is None and undistort:
+            filters = [{'name': 'undistort'}]
+        return filters
+
+    def check_filters(self, filters):
+        """Raise ValueError unless filters is a filter list, or a dict of them keyed by camera id"""
+        if filters is None:
+            return
+        from frame_filters import check_config
+        for config in filters.values() if isinstance(filters, dict) else [filters]:
+            if config is not None:
+                check_config(config)
+
+    def update_filters(self, filters):
+        """Swap the filter chains of running cameras, the pipeline is left as is"""
+        for camera, stage in self.filter_stages.items():
+            camera_filters = self.filters_for_camera(filters, camera)
+            if camera_filters is not None:
+                stage.set_filters(camera_filters)
+
+    def dump_dot(self, name, delay=0.0):
+        """Write a pipeline graph from a worker thread, may be called from any thread"""
+        if not DOT_DUMPS or self.pipe is None:
+            return
+        pipe = self.pipe
+        def write():
+            self.loop.run_in_executor(None, Gst.debug_bin_to_dot_file, pipe, Gst.DebugGraphDetails.ALL, name)
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, write)
+
     def on_bus_message(self, bus, message):
         """Handle messages from the GStreamer bus, specifically for latency."""
         t = message.type
         if t == Gst.MessageType.LATENCY:
             print("Received a LATENCY message. Recalculating latency.")
             self.pipe.recalculate_latency()
+        elif t == Gst.MessageType.STATE_CHANGED and message.src == self.pipe:
+            _, new_state, _ = message.parse_state_changed()
+            if new_state == Gst.State.PLAYING:
+                self.profiler.pipeline_playing()
 
         return GLib.SOURCE_CONTINUE
     
+    def on_ice_connection_state(self, webrtc, _):
+        state = webrtc.get_property("ice-connection-state")
+        print("ICE connection state:", state.value_nick)
+        if self.timer and state in (GstWebRTC.WebRTCICEConnectionState.CONNECTED,
+                                    GstWebRTC.WebRTCICEConnectionState.COMPLETED):
+            self.timer.mark("ice_connected")
+
+    def on_first_frame_probe(self, pad, info):
+        # Buffers reach webrtcbin before ICE is up; only count the first one that can leave
+        if self.timer is None:
+            return Gst.PadProbeReturn.REMOVE
+        if "ice_connected" not in self.timer.marks:
+            return Gst.PadProbeReturn.OK
+        self.timer.mark("first_frame")
+        return Gst.PadProbeReturn.REMOVE
+
     def close_pipeline(self):
+        if self.recorder:
+            self.recorder.stop()
+            self.recorder = None
         if self.pipe:
             self.pipe.set_state(Gst.State.NULL)
             self.pipe = None
             self.webrtc = None
             self.added_data_channel = False
+        self.keyframe_controllers = []
+        self.snapshots = {}
+        self.filter_stages = {}
+        with self.ice_lock:
+            self.pending_local_candidates = []
+        self.pending_remote_candidates = []
+        self.remote_description_set = False
 
     def on_message_string(self, channel, message):
         print("Received:", message)
+        try:
+            msg = json.loads(message)
+        except json.JSONDecodeError:
+            return
+        if isinstance(msg, dict) and msg.get('type') == "Record":
+            # Data channel callbacks run on webrtcbin's thread, control the recorder from the loop
+            self.loop.call_soon_threadsafe(self.handle_record_message, msg, channel)
+
+    def handle_record_message(self, msg, channel=None):
+        """Start or stop recording, replying on the data channel the request came from, if any"""
+        if self.recorder is None:
+            reply = {'type': 'recording', 'state': 'unavailable'}
+        elif msg.get('action') == "stop":
+            self.recorder.stop()
+            reply = {'type': 'recording', 'state': 'stopped', 'path': self.recorder.path}
+        else:
+            path = self.recorder.start()
+            reply = {'type': 'recording', 'state': 'started' if path else 'failed', 'path': path}
+        if channel is not None:
+            channel.emit("send-string", json.dumps(reply))
+        else:
+            self.send_reply(reply)
+
+    def send_reply(self, reply):
+        if self.ws is not None:
+            self.send_soon(self.send_messages([json.dumps(reply)]))
+
+    def send_soon(self, coro):
+        """Run a send without waiting for it, keeping the task until it is done"""
+        task = self.loop.create_task(coro)
+        self.background_sends.add(task)
+        task.add_done_callback(self.background_sends.discard)
 
     def on_data_channel(self, webrtc, channel):
         print("New data channel:", channel.props.label)
@@ -202,20 +563,20 @@ class WebRTCServer:
             stream_id = self.added_streams
             
             # Create elements
-            vp8depay = Gst.ElementFactory.make('rtpvp8depay', f'vp8depay_{stream_id}')
-            vp8dec = Gst.ElementFactory.make('vp8dec', f'vp8dec_{stream_id}')
-            queue2 = Gst.ElementFactory.make('queue', f'queue2_{stream_id}')
-            videoconvert = Gst.ElementFactory.make('videoconvert', f'videoconvert_{stream_id}')
-            videoscale = Gst.ElementFactory.make('videoscale', f'videoscale_{stream_id}')
+            vp8depay = make_element('rtpvp8depay', f'vp8depay_{stream_id}')
+            vp8dec = make_element('vp8dec', f'vp8dec_{stream_id}')
+            queue2 = make_element('queue', f'queue2_{stream_id}')
+            videoconvert = make_element('videoconvert', f'videoconvert_{stream_id}')
+            videoscale = make_element('videoscale', f'videoscale_{stream_id}')
             
             # Configure scaling to fit within 1920x1080 while preserving aspect ratio
             videoscale.set_property("method", 1)  # Bilinear scaling
             scale_caps = Gst.Caps.from_string("video/x-raw,width=1920,height=1080")
-            scale_capsfilter = Gst.ElementFactory.make('capsfilter', f'scale_caps_{stream_id}')
+            scale_capsfilter = make_element('capsfilter', f'scale_caps_{stream_id}')
             scale_capsfilter.set_property("caps", scale_caps)
             
             # Use glimagesink directly with fullscreen/borderless properties
-            autovideosink = Gst.ElementFactory.make('glimagesink', f'glimagesink_{stream_id}')
+            autovideosink = make_element('glimagesink', f'glimagesink_{stream_id}')
             autovideosink.set_property('force-aspect-ratio', True)
             
             # Configure depayloader properties
@@ -253,11 +614,11 @@ class WebRTCServer:
             # Create audio pipeline with proper synchronization
             stream_id = self.added_streams
             
-            opusdepay = Gst.ElementFactory.make('rtpopusdepay', f'opusdepay_{stream_id}')
-            opusdec = Gst.ElementFactory.make('opusdec', f'opusdec_{stream_id}')
-            audioconvert = Gst.ElementFactory.make('audioconvert', f'audioconvert_{stream_id}')
-            audioresample = Gst.ElementFactory.make('audioresample', f'audioresample_{stream_id}')
-            autoaudiosink = Gst.ElementFactory.make('autoaudiosink', f'autoaudiosink_{stream_id}')
+            opusdepay = make_element('rtpopusdepay', f'opusdepay_{stream_id}')
+            opusdec = make_element('opusdec', f'opusdec_{stream_id}')
+            audioconvert = make_element('audioconvert', f'audioconvert_{stream_id}')
+            audioresample = make_element('audioresample', f'audioresample_{stream_id}')
+            autoaudiosink = make_element('autoaudiosink', f'autoaudiosink_{stream_id}')
             
             
             # Configure audio sink
@@ -284,17 +645,8 @@ class WebRTCServer:
         else:
             print(f"Unsupported stream type: {media_type}/{encoding_name}")
 
-        Gst.debug_bin_to_dot_file(self.pipe, Gst.DebugGraphDetails.ALL, f"pipeline_graph_{self.added_streams}")
-        async def delayed_snapshot(pipe, name, delay=5.0):
-            await asyncio.sleep(delay)
-            print("Taking DELAYEDsnapshot")
-            Gst.debug_bin_to_dot_file(pipe, Gst.DebugGraphDetails.ALL, name)
-
-        # inside your GLib callback:
-        asyncio.run_coroutine_threadsafe(
-            delayed_snapshot(self.pipe, f"pipeline_graph_delayed{self.added_streams}", 10.0),
-            self.loop
-        )  
+        self.dump_dot(f"pipeline_graph_{self.added_streams}")
+        self.dump_dot(f"pipeline_graph_delayed{self.added_streams}", 10.0)
         self.added_streams += 1
         
         # Force latency recalculation after adding new stream
@@ -325,12 +677,73 @@ class WebRTCServer:
         print("offertext:", text)
         message = json.dumps({'sdp': {'type': 'offer', 'sdp': text}})
         asyncio.run_coroutine_threadsafe(self.ws.send(message), self.loop)
+        if self.timer:
+            self.timer.mark("offer_sent")
 
     def send_ice_candidate_message(self, _, mlineindex, candidate):
-        message = json.dumps({
-            'ice': {'candidate': candidate, 'sdpMLineIndex': mlineindex}
-        })
-        asyncio.run_coroutine_threadsafe(self.ws.send(message), self.loop)
+        # Called from webrtcbin's thread for every gathered candidate. Candidates are
+        # queued and flushed from the asyncio loop so a burst costs one wakeup.
+        with self.ice_lock:
+            self.pending_local_candidates.append({'candidate': candidate, 'sdpMLineIndex': mlineindex})
+            # On the LAN the host candidates are the ones that will win, don't hold them back
+            flush_now = self.lan_mode and " typ host" in candidate
+            if self.ice_flush_scheduled and not flush_now:
+                return
+            self.ice_flush_scheduled = True
+        if flush_now:
+            self.loop.call_soon_threadsafe(self.flush_local_candidates)
+        else:
+            self.loop.call_soon_threadsafe(self.loop.call_later, ICE_BATCH_WINDOW, self.flush_local_candidates)
+
+    def flush_local_candidates(self):
+        with self.ice_lock:
+            batch = self.pending_local_candidates
+            self.pending_local_candidates = []
+            self.ice_flush_scheduled = False
+        if not batch or self.ws is None:
+            return
+        if self.ice_batching:
+            messages = [json.dumps({'ice_batch': batch})]
+        else:
+            messages = [json.dumps({'ice': ice}) for ice in batch]
+        self.send_soon(self.send_messages(messages))
+
+    async def send_messages(self, messages):
+        ws = self.ws
+        try:
+            for message in messages:
+                await ws.send(message)
+        except websockets.ConnectionClosed:
+            # The client is gone, websocket_handler cleans up
+            print("Client closed before messages could be sent")
+
+    def add_remote_candidate(self, ice):
+        # webrtcbin needs the remote description before it can use remote candidates
+        if not self.remote_description_set:
+            self.pending_remote_candidates.append(ice)
+            return
+        self.webrtc.emit("add-ice-candidate", ice['sdpMLineIndex'], ice['candidate'])
+
+    def on_remote_description_set(self, promise, webrtc, _):
+        reply = promise.get_reply()
+        if promise.wait() != Gst.PromiseResult.REPLIED or (reply is not None and reply.has_field("error")):
+            # Candidates stay buffered, they can't be used without the answer
+            print(f"Setting the remote description failed: {reply.to_string() if reply else 'no reply'}")
+            return
+        # Promise callbacks run on webrtcbin's thread, apply the buffered candidates on the loop
+        self.loop.call_soon_threadsafe(self.flush_remote_candidates, webrtc)
+
+    def flush_remote_candidates(self, webrtc):
+        # A promise of a pipeline closed since must not mark the next one's answer as set
+        if self.webrtc is None or webrtc is not self.webrtc:
+            return
+        self.remote_description_set = True
+        pending = self.pending_remote_candidates
+        self.pending_remote_candidates = []
+        if pending:
+            print(f"Adding {len(pending)} buffered remote ICE candidates")
+        for ice in pending:
+            self.add_remote_candidate(ice)
 
     def handle_client_message(self, message):
         print("Handling client message")
@@ -340,20 +753,49 @@ class WebRTCServer:
         msg_cameras = msg.get('cameras', [0])
         msg_audio = msg.get('audio', True)
         msg_undistort = msg.get('undistort', False)
+        msg_lan = msg.get('lan', False)
         if 'sdp' in msg and msg['sdp']['type'] == 'answer':
             sdp = msg['sdp']['sdp']
             res, sdpmsg = GstSdp.SDPMessage.new()
             GstSdp.sdp_message_parse_buffer(sdp.encode(), sdpmsg)
             answer = GstWebRTC.WebRTCSessionDescription.new(GstWebRTC.WebRTCSDPType.ANSWER, sdpmsg)
-            self.webrtc.emit("set-remote-description", answer, Gst.Promise.new())
+            promise = Gst.Promise.new_with_change_func(self.on_remote_description_set, self.webrtc, None)
+            self.webrtc.emit("set-remote-description", answer, promise)
         elif 'ice' in msg:
-            ice = msg['ice']
-            self.webrtc.emit("add-ice-candidate", ice['sdpMLineIndex'], ice['candidate'])
+            self.add_remote_candidate(msg['ice'])
+        elif 'ice_batch' in msg:
+            for ice in msg['ice_batch']:
+                self.add_remote_candidate(ice)
+        elif(msg_type == "Filters"):
+            try:
+                self.check_filters(msg.get('filters'))
+            except ValueError as e:
+                self.send_reply({'type': 'error', 'error': f'Invalid filters: {e}'})
+                return
+            self.update_filters(msg.get('filters'))
+        elif(msg_type == "Record"):
+            self.handle_record_message(msg)
+        elif(msg_type == "Hangup"):
+            # The gateway keeps one connection open for all apps and hangs up when the owner leaves
+            if(self.pipe):
+                self.close_pipeline()
         elif(msg_type == "Negotiate"):
+            # A bad filter config would leave a half-built pipeline, turn it away first
+            try:
+                self.check_filters(msg.get('filters'))
+            except ValueError as e:
+                self.send_reply({'type': 'error', 'error': f'Invalid filters: {e}'})
+                return
             if(self.pipe):
                 self.close_pipeline()
-           
-            self.start_pipeline(msg_cameras, msg_audio, msg_undistort)
+            self.timer = NegotiationTimer()
+            # Apps that understand {"ice_batch": [...]} opt in, others get one message per candidate
+            self.ice_batching = msg.get('ice_batch', False)
+            self.start_pipeline(msg_cameras, msg_audio, msg_undistort, msg_lan,
+                                keyframe_interval=msg.get('keyframe_interval', KEYFRAME_MAX_DIST),
+                                resilient=msg.get('resilient', False),
+                                record_buffer=msg.get('record_buffer', 0),
+                                filters=msg.get('filters'))
        
             return
             
@@ -365,14 +807,65 @@ class WebRTCServer:
         print("Client disconnected")
         self.close_pipeline()
 
+    async def snapshot_handler(self, ws):
+        """Serve {"type": "snapshot", "camera": id, "after": seq} requests, any number of clients.
+
+        The gateway tags each request with gateway_request_id, replies echo it so the
+        gateway can hand them to the app that asked.
+        """
+        async for msg in ws:
+            try:
+                request = json.loads(msg)
+            except json.JSONDecodeError:
+                request = None
+            if not isinstance(request, dict):
+                await ws.send(json.dumps({'type': 'error', 'error': 'Invalid snapshot request'}))
+                continue
+            reply = await self.get_snapshot(request)
+            if 'gateway_request_id' in request:
+                reply['gateway_request_id'] = request['gateway_request_id']
+            await ws.send(json.dumps(reply))
+
+    async def get_snapshot(self, request):
+        camera = request.get('camera', next(iter(self.snapshots), None))
+        # Cameras are keyed by index, JSON clients may send "0" as well as 0
+        if isinstance(camera, str) and camera.isdigit():
+            camera = int(camera)
+        elif camera is not None and (not isinstance(camera, int) or isinstance(camera, bool)):
+            return {'type': 'error', 'error': f'Invalid camera {camera!r}, expected a camera index'}
+        snapshot = self.snapshots.get(camera)
+        if snapshot is None:
+            return {'type': 'error', 'error': f'Camera {camera} is not streaming'}
+        # Encoding blocks for a few ms, keep it off the event loop
+        try:
+            result = await self.loop.run_in_executor(None, snapshot.get_jpeg)
+        except GLib.Error as e:
+            # Failing here would close the gateway's connection, shared by every app's requests
+            return {'type': 'error', 'error': f'Could not encode a snapshot of camera {camera}: {e.message}'}
+        if result is None:
+            return {'type': 'error', 'error': f'No frame captured yet on camera {camera}'}
+        sequence, captured_at, jpeg = result
+        reply = {'type': 'snapshot', 'camera': camera, 'frame': sequence, 'timestamp': captured_at}
+        # Pollers pass the last frame they got and skip the transfer if nothing new was captured
+        if request.get('after') == sequence:
+            reply['unchanged'] = True
+        else:
+            reply['jpeg'] = base64.b64encode(jpeg).decode()
+        return reply
+
 async def main():
     loop = asyncio.get_running_loop()
     server = WebRTCServer(loop)
     async def handler(websocket):
         await server.websocket_handler(websocket)
     asyncio.create_task(glib_main_loop_iteration())
-    async with websockets.serve(handler, "0.0.0.0", 8765):
+    async with websockets.serve(handler, "0.0.0.0", 8765), \
+            websockets.serve(server.snapshot_handler, "0.0.0.0", SNAPSHOT_PORT):
         print("WebSocket server running on ws://0.0.0.0:8765")
+        print(f"Snapshot server running on ws://0.0.0.0:{SNAPSHOT_PORT}")
+        server.profiler.listening()
+        if WARM_START:
+            loop.run_in_executor(None, preload_factories, WARM_FACTORIES)
         await asyncio.Future()  # run forever
 
 if __name__ == "__main__":
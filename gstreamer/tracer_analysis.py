@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""Streaming analyzer for GStreamer tracer logs.
+
+Reads a GST_TRACER log (optionally gzipped) line by line and aggregates latency,
+element-latency, interlatency, proctime, framerate, bitrate and queuelevel records
+into per-element percentiles and per-second time series. Memory is bounded by the
+number of elements and the run length, not by the size of the log.
+
+    python tracer_analysis.py results_dir [--log tracer.log.gz]
+"""
+import argparse
+import csv
+import gzip
+import json
+import math
+import os
+import re
+
+# Log-spaced buckets, values are reported within ~1% of their true value
+HISTOGRAM_GAMMA = 1.02
+TIMESERIES_BUCKET_S = 1.0
+
+LINE_TIMESTAMP = re.compile(r"^(\d+):(\d{2}):(\d{2})\.(\d+)")
+RECORD = re.compile(r"GST_TRACER\s+:0::\s+([\w-]+),\s*(.*?);?\s*$")
+FIELD = re.compile(r'([\w-]+)=\((\w+)\)("(?:[^"\\]|\\.)*"|[^,;]+)')
+CLOCK_STRING = re.compile(r"^(\d+):(\d{2}):(\d{2})\.(\d+)$")
+
+INTEGER_TYPES = {"guint64", "gint64", "uint", "int", "guint", "gint", "ulong", "long"}
+FLOAT_TYPES = {"double", "gdouble", "float", "gfloat"}
+
+
+def parse_clock(text):
+    """Parse H:MM:SS.fraction (as printed by GStreamer) into nanoseconds"""
+    match = CLOCK_STRING.match(text) or LINE_TIMESTAMP.match(text)
+    if not match:
+        return None
+    hours, minutes, seconds, fraction = match.groups()
+    fraction_ns = int(fraction.ljust(9, "0")[:9])
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1_000_000_000 + fraction_ns
+
+
+def parse_value(type_name, raw):
+    raw = raw.strip()
+    if raw.startswith('"'):
+        raw = raw[1:-1]
+    if type_name in INTEGER_TYPES:
+        return int(raw)
+    if type_name in FLOAT_TYPES:
+        return float(raw)
+    if type_name == "string":
+        # GstShark reports durations as clock strings
+        clock = parse_clock(raw)
+        return clock if clock is not None else raw
+    return raw
+
+
+def parse_line(line):
+    """Return (timestamp ns, record name, fields) for a tracer line, None for anything else"""
+    if "GST_TRACER" not in line:
+        return None
+    record = RECORD.search(line)
+    if not record:
+        return None
+    fields = {name: parse_value(type_name, raw) for name, type_name, raw in FIELD.findall(record.group(2))}
+    return parse_clock(line), record.group(1), fields
+
+
+def extract_metrics(name, fields):
+    """Map one tracer record to (metric, key, value) samples, times in ms"""
+    if name == "latency":
+        key = f"{fields.get('src-element')}.{fields.get('src')}->{fields.get('sink-element')}.{fields.get('sink')}"
+        return [("latency_ms", key, fields["time"] / 1e6)] if "time" in fields else []
+    if name == "element-latency":
+        return [("element_latency_ms", fields.get("element"), fields["time"] / 1e6)] if "time" in fields else []
+    if name == "interlatency":
+        key = f"{fields.get('from_pad')}->{fields.get('to_pad')}"
+        return [("interlatency_ms", key, fields["time"] / 1e6)] if isinstance(fields.get("time"), int) else []
+    if name == "proctime":
+        return [("proctime_ms", fields.get("element"), fields["time"] / 1e6)] if isinstance(fields.get("time"), int) else []
+    if name == "framerate":
+        return [("fps", fields.get("pad"), fields["fps"])] if "fps" in fields else []
+    if name == "bitrate":
+        return [("bitrate_bps", fields.get("pad"), fields["bitrate"])] if "bitrate" in fields else []
+    if name == "queuelevel":
+        queue = fields.get("queue")
+        return [(f"queue_{level}", queue, fields[level])
+                for level in ("size_buffers", "size_bytes", "size_time") if level in fields]
+    return []
+
+
+class LogHistogram:
+    """Fixed relative-error quantile sketch, memory grows with the value range only"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.total_sq += value * value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value <= 0:
+            self.zeros += 1
+            return
+        index = math.ceil(math.log(value, HISTOGRAM_GAMMA))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def percentile(self, q):
+        target = q / 100 * (self.count - 1)
+        seen = self.zeros
+        if seen > target:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > target:
+                # Midpoint of the bucket keeps the relative error symmetric
+                value = 2 * HISTOGRAM_GAMMA ** index / (HISTOGRAM_GAMMA + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        mean = self.total / self.count
+        return {
+            "count": self.count,
+            "mean": mean,
+            "stddev": math.sqrt(max(self.total_sq / self.count - mean * mean, 0.0)),
+            "min": self.min,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class TracerAnalyzer:
+    def __init__(self, bucket_s=TIMESERIES_BUCKET_S):
+        self.bucket_ns = int(bucket_s * 1e9)
+        self.histograms = {}
+        # (metric, key) -> {bucket index: [sum, count]}
+        self.series = {}
+        self.lines = 0
+        self.records = 0
+        self.unhandled = {}
+
+    def feed(self, line):
+        self.lines += 1
+        parsed = parse_line(line)
+        if parsed is None:
+            return
+        timestamp, name, fields = parsed
+        samples = extract_metrics(name, fields)
+        if not samples:
+            self.unhandled[name] = self.unhandled.get(name, 0) + 1
+            return
+        self.records += 1
+        bucket = timestamp // self.bucket_ns if timestamp is not None else 0
+        for metric, key, value in samples:
+            series_key = (metric, str(key))
+            histogram = self.histograms.get(series_key)
+            if histogram is None:
+                histogram = self.histograms[series_key] = LogHistogram()
+                self.series[series_key] = {}
+            histogram.add(value)
+            point = self.series[series_key].setdefault(bucket, [0.0, 0])
+            point[0] += value
+            point[1] += 1
+
+    def summary(self):
+        metrics = {}
+        for (metric, key), histogram in sorted(self.histograms.items()):
+            metrics.setdefault(metric, {})[key] = histogram.summary()
+        return {
+            "lines": self.lines,
+            "records": self.records,
+            "unhandled_records": self.unhandled,
+            "metrics": metrics,
+        }
+
+    def timeseries_rows(self):
+        bucket_s = self.bucket_ns / 1e9
+        for (metric, key), points in sorted(self.series.items()):
+            for bucket in sorted(points):
+                total, count = points[bucket]
+                yield {"t_s": bucket * bucket_s, "metric": metric, "key": key,
+                       "mean": total / count, "samples": count}
+
+
+def open_log(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", errors="replace")
+    return open(path, "r", errors="replace")
+
+
+def write_timeseries(analyzer, results_dir):
+    """Write Parquet when pyarrow is installed, CSV otherwise"""
+    rows = analyzer.timeseries_rows()
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        path = os.path.join(results_dir, "tracer_timeseries.csv")
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["t_s", "metric", "key", "mean", "samples"])
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+    path = os.path.join(results_dir, "tracer_timeseries.parquet")
+    pq.write_table(pa.Table.from_pylist(list(rows)), path, compression="zstd")
+    return path
+
+
+def analyze_tracer_log(log_path, results_dir):
+    """Aggregate a tracer log into tracer_summary.json and a time series file in results_dir"""
+    analyzer = TracerAnalyzer()
+    with open_log(log_path) as f:
+        for line in f:
+            analyzer.feed(line)
+    summary = analyzer.summary()
+    summary["log"] = os.path.abspath(log_path)
+    summary_path = os.path.join(results_dir, "tracer_summary.json")
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    timeseries_path = write_timeseries(analyzer, results_dir)
+    print(f"Parsed {analyzer.records} tracer records from {analyzer.lines} lines")
+    return summary_path, timeseries_path
+
+
+def find_log(results_dir):
+    for name in ("tracer.log", "tracer.log.gz"):
+        path = os.path.join(results_dir, name)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No tracer.log in {results_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate a GStreamer tracer log")
+    parser.add_argument("results_dir", help="fullAnalysis results directory, outputs are written here")
+    parser.add_argument("--log", help="tracer log, defaults to tracer.log[.gz] in results_dir")
+    args = parser.parse_args()
+    summary_path, timeseries_path = analyze_tracer_log(args.log or find_log(args.results_dir), args.results_dir)
+    print(f"   - Summary: {summary_path}")
+    print(f"   - Time series: {timeseries_path}")
+
+
+if __name__ == "__main__":
+    main()
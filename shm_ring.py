@@ -0,0 +1,105 @@
+"""Shared-memory ring buffer for high-rate local streams (joint states, IMU, ...).
+
+One producer (the robot service) writes length-prefixed records, one consumer (the
+gateway) reads them. Positions are monotonic byte counts in the header, the producer
+only moves the write position and the consumer only moves the read position, so no
+lock is needed. A record never wraps: when it doesn't fit before the end of the
+buffer, a marker sends the reader back to the start. A full ring rejects the write
+and counts it, the producer never blocks.
+
+    ring = ShmRing.create("joint_states")      # producer
+    ring.write(json.dumps(state).encode())
+    ring = ShmRing.attach("joint_states")      # consumer
+    for record in ring.read():
+        ...
+"""
+import struct
+from multiprocessing import resource_tracker, shared_memory
+from typing import List, Optional
+
+HEADER_SIZE = 64
+# capacity, write position, read position
+HEADER = struct.Struct("<QQQ")
+WRITE_POS = 8
+READ_POS = 16
+RECORD = struct.Struct("<I")
+WRAP = 0xFFFFFFFF
+DEFAULT_CAPACITY = 1 << 20
+
+
+class ShmRing:
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self.shm = shm
+        self.buf = shm.buf
+        self.owner = owner
+        self.capacity = HEADER.unpack_from(self.buf, 0)[0]
+        self.dropped = 0
+
+    @classmethod
+    def create(cls, name: str, capacity: int = DEFAULT_CAPACITY) -> "ShmRing":
+        """Create the ring, replacing one left behind by a crashed producer"""
+        try:
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        shm = shared_memory.SharedMemory(name=name, create=True, size=HEADER_SIZE + capacity)
+        HEADER.pack_into(shm.buf, 0, capacity, 0, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "ShmRing":
+        shm = shared_memory.SharedMemory(name=name)
+        # Before Python 3.13 attaching registers the segment too, and the tracker would
+        # unlink it when the consumer exits
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, owner=False)
+
+    def write(self, data: bytes) -> bool:
+        """Append one record, False (and counted in dropped) if the ring is full"""
+        capacity = self.capacity
+        write_pos, read_pos = struct.unpack_from("<QQ", self.buf, WRITE_POS)
+        needed = RECORD.size + len(data)
+        offset = write_pos % capacity
+        pad = capacity - offset if capacity - offset < needed else 0
+        if needed > capacity or write_pos + pad + needed - read_pos > capacity:
+            self.dropped += 1
+            return False
+        if pad:
+            if pad >= RECORD.size:
+                RECORD.pack_into(self.buf, HEADER_SIZE + offset, WRAP)
+            write_pos += pad
+            offset = 0
+        start = HEADER_SIZE + offset
+        RECORD.pack_into(self.buf, start, len(data))
+        self.buf[start + RECORD.size:start + needed] = data
+        # Publishing the write position last makes the record visible to the reader
+        struct.pack_into("<Q", self.buf, WRITE_POS, write_pos + needed)
+        return True
+
+    def read(self, limit: Optional[int] = None) -> List[bytes]:
+        """Return the records written since the last read, oldest first"""
+        capacity = self.capacity
+        write_pos, read_pos = struct.unpack_from("<QQ", self.buf, WRITE_POS)
+        records = []
+        while read_pos < write_pos and (limit is None or len(records) < limit):
+            offset = read_pos % capacity
+            if capacity - offset < RECORD.size:
+                read_pos += capacity - offset
+                continue
+            length = RECORD.unpack_from(self.buf, HEADER_SIZE + offset)[0]
+            if length == WRAP:
+                read_pos += capacity - offset
+                continue
+            start = HEADER_SIZE + offset + RECORD.size
+            records.append(bytes(self.buf[start:start + length]))
+            read_pos += RECORD.size + length
+        struct.pack_into("<Q", self.buf, READ_POS, read_pos)
+        return records
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -1,106 +1,333 @@
 import asyncio
+import functools
+import hmac
 import json
+import multiprocessing
+import os
+import re
+import signal
+import sys
+import tempfile
+import time
 import websockets
 from typing import Dict, Optional
 import logging
+from signaling_presence import PresenceIndex
+from signaling_registry import RobotRegistry, SocketRegistry, serve_registry
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# More than one runs that many worker processes on the same port (run_cluster)
+SIGNALING_WORKERS = int(os.getenv("SIGNALING_WORKERS", "1"))
+# Relayed frames are never parsed or logged. With N > 0, every Nth frame of a connection
+# is logged as one JSON line with its size, never its payload (SDP, ICE, credentials)
+LOG_SAMPLE_EVERY = int(os.getenv("SIGNALING_LOG_SAMPLE_EVERY", "0"))
+# Read-only observers per robot, next to the one primary app
+MAX_OBSERVERS = int(os.getenv("SIGNALING_MAX_OBSERVERS", "64"))
+# An observer whose unsent backlog is above this misses messages until it catches up
+OBSERVER_BUFFER_LIMIT = int(os.getenv("SIGNALING_OBSERVER_BUFFER_LIMIT", str(1 << 20)))
+# Observers have to send this as "token". Without it the observer role is disabled
+OBSERVER_TOKEN = os.getenv("SIGNALING_OBSERVER_TOKEN", "")
+# Message types observers may send to the robot, none by default
+OBSERVER_MESSAGE_TYPES = {t for t in os.getenv("SIGNALING_OBSERVER_MESSAGE_TYPES", "").split(",") if t}
+# Replies meant for the primary app alone, never relayed to observers. auth_success
+# carries the gateway's resume token, which would let an observer take over the session
+CONTROL_MESSAGE_TYPES = {"auth_success", "error", "registered", "unregistered"}
+MESSAGE_TYPE = re.compile(r'"type"\s*:\s*"([^"\\]*)"')
+# Presence subscribers have to send this as "token". Without it the presence role is disabled
+PRESENCE_TOKEN = os.getenv("SIGNALING_PRESENCE_TOKEN", "")
+# A presence subscriber with this many bytes unsent is closed and has to subscribe again
+PRESENCE_BUFFER_LIMIT = int(os.getenv("SIGNALING_PRESENCE_BUFFER_LIMIT", str(1 << 20)))
+
 class RobotAppPair:
     def __init__(self, robot_id: str, robot_ws):
         self.robot_id = robot_id
         self.robot_ws = robot_ws
         self.app_ws: Optional[websockets.WebSocketServerProtocol] = None
+        # Observers get robot messages too, but never hold up the robot
+        self.observers = set()
+        self.observer_skips = 0
     
     async def relay_robot_message(self, message: str):
-        """Relay message from robot to app"""
+        """Relay message from robot to app and observers"""
+        if self.observers and not is_control_message(message):
+            self.broadcast_to_observers(message)
+        app_ws = self.app_ws
+        if app_ws is None:
+            return
         try:
-            await self.app_ws.send(message)
+            await app_ws.send(message)
         except:
             logger.error(f"Failed to relay message from robot to app {self.robot_id}")
-            self.app_ws = None
+            if self.app_ws is app_ws:
+                self.app_ws = None
+
+    def broadcast_to_observers(self, message):
+        """Write to every observer without awaiting, skipping those that fell behind"""
+        ready = [ws for ws in self.observers if ws.transport.get_write_buffer_size() < OBSERVER_BUFFER_LIMIT]
+        self.observer_skips += len(self.observers) - len(ready)
+        websockets.broadcast(ready, message)
 
     async def relay_app_message(self, message: str):
         """Relay message from app to robot"""
+        robot_ws = self.robot_ws
+        if robot_ws is None:
+            return
         try:
-            await self.robot_ws.send(message)
+            await robot_ws.send(message)
         except:
             logger.error(f"Failed to relay message from app to robot {self.robot_id}")
-            self.robot_ws = None
+            if self.robot_ws is robot_ws:
+                self.robot_ws = None
 
-# Global storage for robot-app pairs
+# Global storage for robot-app pairs. There is no lock: handlers only read and update
+# their entry between awaits, which the event loop never interleaves, and a slow client
+# can only hold up its own connection.
 pairs: Dict[str, RobotAppPair] = {}
-pairs_lock = asyncio.Lock()
+# Notifications nobody waits for, referenced here until they finish
+background_sends = set()
+# Set in cluster workers: where robots are, and the address other workers reach this one at
+registry: Optional[RobotRegistry] = None
+worker_address: Optional[str] = None
+# Online robots and their apps, mirrored from the registry in cluster workers
+presence = PresenceIndex(PRESENCE_BUFFER_LIMIT)
+
+def send_soon(websocket, message):
+    """Send without waiting, so connects and disconnects never wait on a slow client"""
+    task = asyncio.create_task(send_quietly(websocket, message))
+    background_sends.add(task)
+    task.add_done_callback(background_sends.discard)
+
+async def send_quietly(websocket, message):
+    try:
+        await websocket.send(message)
+    except websockets.ConnectionClosed:
+        pass
+
+def is_control_message(message) -> bool:
+    """Whether a robot frame is a control reply, found without parsing the frame"""
+    if isinstance(message, bytes):
+        return False
+    if "resume_token" in message:
+        return True
+    match = MESSAGE_TYPE.search(message)
+    return match is not None and match.group(1) in CONTROL_MESSAGE_TYPES
+
+def token_matches(token, expected: str) -> bool:
+    """Constant-time check of a client's token, never true while expected is unset"""
+    return bool(expected) and isinstance(token, str) and hmac.compare_digest(token.encode(), expected.encode())
+
+def unique_keys(pairs) -> dict:
+    """object_pairs_hook refusing duplicate keys, which parsers disagree on"""
+    obj = {}
+    for key, value in pairs:
+        if key in obj:
+            raise ValueError(f"duplicate key {key!r}")
+        obj[key] = value
+    return obj
+
+def observer_message_type(message) -> Optional[str]:
+    """Top-level "type" of an observer frame, None if it isn't an unambiguous JSON object.
+
+    Observer frames are few, so they are parsed: a regex would take a nested or earlier
+    duplicate "type" than the one the robot acts on.
+    """
+    if not isinstance(message, str):
+        return None
+    try:
+        data = json.loads(message, object_pairs_hook=unique_keys)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("type"), str):
+        return None
+    return data["type"]
+
+async def update_presence(robot_id: str, **changes):
+    """Record a change of a robot held by this worker. Cluster workers go through the
+    registry, which drops changes of robots claimed since and pushes the rest to every worker"""
+    if registry is None:
+        presence.update(robot_id, changes)
+    else:
+        await registry.report(robot_id, worker_address, changes)
 
-async def handle_robot(websocket, robot_id: str):
+def log_relay_sample(robot_id: str, direction: str, relayed: int, message):
+    logger.info(json.dumps({"event": "relay_sample", "robot_id": robot_id, "direction": direction,
+                            "relayed": relayed, "bytes": len(message), "binary": isinstance(message, bytes)}))
+
+async def handle_robot(websocket, robot_id: str, capabilities=None):
     """Handle robot connection"""
     logger.info(f"Robot {robot_id} connected")
     
     # Create or update the pair
-    async with pairs_lock:
-        pairs[robot_id] = RobotAppPair(robot_id, websocket)
-        current_pair = pairs[robot_id]
+    current_pair = RobotAppPair(robot_id, websocket)
+    pairs[robot_id] = current_pair
+    if registry is not None:
+        await registry.claim(robot_id, worker_address)
+    await update_presence(robot_id, online=True, app=False, last_seen=time.time(), capabilities=capabilities or {})
     
+    relayed = 0
     try:
+        # Frames, text or binary, are forwarded untouched
         async for message in websocket:
-            try:
-                data = json.loads(message)
-                logger.info(f"Robot message: {data}")
-                await current_pair.relay_robot_message(message)
-                    
-            except json.JSONDecodeError:
-                logger.error(f"Invalid JSON from robot {robot_id}")
+            await current_pair.relay_robot_message(message)
+            relayed += 1
+            if LOG_SAMPLE_EVERY and relayed % LOG_SAMPLE_EVERY == 0:
+                log_relay_sample(robot_id, "robot_to_app", relayed, message)
                 
     except websockets.ConnectionClosed:
         logger.info(f"Robot {robot_id} disconnected")
     finally:
-        # Clean up
-        async with pairs_lock:
-            for key, pair in pairs.items():
-                if key == robot_id:
-                    if pair.app_ws != None:
-                        await pair.app_ws.send(json.dumps({"type": "error", "error": "Robot disconnected"}))
-                    logger.info(f"Cleaning up robot connection from pair {robot_id}")
-                    del pairs[robot_id]
-
-async def handle_app(websocket, robot_id: str):
+        # Clean up, unless a reconnected robot has already replaced this pair
+        if pairs.get(robot_id) is current_pair:
+            logger.info(f"Cleaning up robot connection from pair {robot_id}")
+            del pairs[robot_id]
+            await update_presence(robot_id, online=False, app=False, last_seen=time.time())
+            if registry is not None:
+                await registry.release(robot_id, worker_address)
+        if current_pair.app_ws is not None:
+            send_soon(current_pair.app_ws, json.dumps({"type": "error", "error": "Robot disconnected"}))
+        websockets.broadcast(current_pair.observers, json.dumps({"type": "error", "error": "Robot disconnected"}))
+        if current_pair.observer_skips:
+            logger.info(f"Observers of robot {robot_id} missed {current_pair.observer_skips} messages while behind")
+
+async def find_pair(websocket, robot_id: str, role: str, forwarded: bool) -> Optional[RobotAppPair]:
+    """The robot's pair on this worker, None once the client was forwarded or turned away"""
+    pair = pairs.get(robot_id)
+    if not pair and registry is not None and not forwarded:
+        # The robot may be connected to another worker
+        try:
+            owner = await registry.lookup(robot_id)
+        except ConnectionError as e:
+            logger.error(f"Robot registry lookup of {robot_id} failed: {e}")
+            owner = None
+        if owner is not None and owner != worker_address:
+            await forward_app(websocket, robot_id, owner, role)
+            return None
+        pair = pairs.get(robot_id)
+    if not pair:
+        await websocket.send(json.dumps({"type": "error", "error": "Robot is not available"}))
+    return pair
+
+async def handle_app(websocket, robot_id: str, forwarded: bool = False):
     """Handle app connection"""
     logger.info(f"App requesting connection to robot {robot_id}")
-    async with pairs_lock:
-        pair = pairs.get(robot_id)
-        if not pair:
-            await websocket.send(json.dumps({"type": "error", "error": "Robot is not available"}))
-            return
-        if  pair.app_ws != None:
-            logger.info(f"Robot {robot_id} connected to different client")
-            await websocket.send(json.dumps({"type": "error", "error": "Robot connected to different app"}))
-            return
+    pair = await find_pair(websocket, robot_id, "app", forwarded)
+    if not pair:
+        return
+    if  pair.app_ws != None:
+        logger.info(f"Robot {robot_id} connected to different client")
+        await websocket.send(json.dumps({"type": "error", "error": "Robot connected to different app"}))
+        return
 
-        pair.app_ws = websocket
-        await websocket.send(json.dumps({"type": "robot_available"}))
+    # Claimed before the first await, so a second app finds the robot taken
+    pair.app_ws = websocket
+    await update_presence(robot_id, app=True)
     
     # Wait for password attempt from app
+    relayed = 0
     try:
+        await websocket.send(json.dumps({"type": "robot_available"}))
         async for message in websocket:
-            try:
-                data = json.loads(message)
-                logger.info(f"App message: {data}")
-                await pair.relay_app_message(message)
-                    
-            except json.JSONDecodeError:
-                logger.error(f"Invalid JSON from app connecting to robot {robot_id}")
+            await pair.relay_app_message(message)
+            relayed += 1
+            if LOG_SAMPLE_EVERY and relayed % LOG_SAMPLE_EVERY == 0:
+                log_relay_sample(robot_id, "app_to_robot", relayed, message)
                 
     except websockets.ConnectionClosed:
         logger.info(f"App disconnected from robot {robot_id}")
     finally:
         # Clean up app connection from pair
-        if pair and pair.app_ws == websocket:
-            await pair.robot_ws.send(json.dumps({"type": "connection_closed"}))
-            logger.info(f"Cleaning up app connection from pair")
+        if pair.app_ws is websocket:
             pair.app_ws = None
+            if pair.robot_ws is not None:
+                send_soon(pair.robot_ws, json.dumps({"type": "connection_closed"}))
+            if pairs.get(robot_id) is pair:
+                await update_presence(robot_id, app=False)
+            logger.info(f"Cleaning up app connection from pair")
+
+async def handle_observer(websocket, robot_id: str, token: Optional[str] = None, forwarded: bool = False):
+    """Handle a read-only app watching a robot next to its primary app"""
+    logger.info(f"Observer requesting robot {robot_id}")
+    # Forwarded observers were checked by the worker they reached first
+    if not forwarded and not token_matches(token, OBSERVER_TOKEN):
+        await websocket.send(json.dumps({"type": "error", "error": "Observer not authorized"}))
+        return
+    pair = await find_pair(websocket, robot_id, "observer", forwarded)
+    if not pair:
+        return
+    if len(pair.observers) >= MAX_OBSERVERS:
+        await websocket.send(json.dumps({"type": "error", "error": "Too many observers"}))
+        return
+
+    pair.observers.add(websocket)
+    dropped = 0
+    try:
+        await websocket.send(json.dumps({"type": "robot_available", "observer": True}))
+        async for message in websocket:
+            # Only allowed types reach the robot, the rest is dropped
+            if OBSERVER_MESSAGE_TYPES and observer_message_type(message) in OBSERVER_MESSAGE_TYPES:
+                await pair.relay_app_message(message)
+                continue
+            dropped += 1
+    except websockets.ConnectionClosed:
+        logger.info(f"Observer disconnected from robot {robot_id}")
+    finally:
+        pair.observers.discard(websocket)
+        if dropped:
+            logger.info(f"Dropped {dropped} messages from an observer of robot {robot_id}")
 
-async def handler(websocket):
+async def handle_presence(websocket, robot_ids=None, token: Optional[str] = None):
+    """Push presence changes to an app, of every robot or only of robot_ids.
+
+    Sending {"robot_ids": [...]} (or null for every robot) changes the subscription
+    and starts over with a new snapshot.
+    """
+    if not token_matches(token, PRESENCE_TOKEN):
+        await websocket.send(json.dumps({"type": "error", "error": "Presence subscriber not authorized"}))
+        return
+    try:
+        presence.subscribe(websocket, robot_ids)
+    except ValueError as e:
+        await websocket.send(json.dumps({"type": "error", "error": str(e)}))
+        return
+    try:
+        async for message in websocket:
+            try:
+                presence.subscribe(websocket, json.loads(message).get("robot_ids"))
+            except (json.JSONDecodeError, AttributeError):
+                continue
+            except ValueError as e:
+                await websocket.send(json.dumps({"type": "error", "error": str(e)}))
+    except websockets.ConnectionClosed:
+        logger.info("Presence subscriber disconnected")
+    finally:
+        presence.unsubscribe(websocket)
+
+async def forward_app(websocket, robot_id: str, owner: str, role: str = "app"):
+    """Relay an app to the worker holding its robot, which sees it as an ordinary app"""
+    logger.info(f"Forwarding app for robot {robot_id} to worker {owner}")
+
+    async def pipe(source, target):
+        try:
+            async for message in source:
+                await target.send(message)
+        except websockets.ConnectionClosed:
+            pass
+
+    try:
+        async with websockets.unix_connect(owner) as upstream:
+            await upstream.send(json.dumps({"role": role, "robot_id": robot_id}))
+            pipes = [asyncio.create_task(pipe(websocket, upstream)), asyncio.create_task(pipe(upstream, websocket))]
+            # Either side closing ends the relay, and leaving the block closes upstream
+            await asyncio.wait(pipes, return_when=asyncio.FIRST_COMPLETED)
+            for task in pipes:
+                task.cancel()
+    except OSError:
+        # The owner went away, the registry catches up when its robots reconnect
+        await websocket.send(json.dumps({"type": "error", "error": "Robot is not available"}))
+
+async def handler(websocket, forwarded: bool = False):
     """Route connections based on role"""
     try:
         # Wait for initial message to determine role
@@ -110,16 +337,21 @@ async def handler(websocket):
         role = data.get("role")
         robot_id = data.get("robot_id")
         
+        if role == "presence":
+            await handle_presence(websocket, data.get("robot_ids"), data.get("token"))
+            return
         if not robot_id:
             await websocket.send(json.dumps({"error": "robot_id required"}))
             return
             
         if role == "robot":
-            await handle_robot(websocket, robot_id)
+            await handle_robot(websocket, robot_id, data.get("capabilities"))
         elif role == "app":
-            await handle_app(websocket, robot_id)
+            await handle_app(websocket, robot_id, forwarded)
+        elif role == "observer":
+            await handle_observer(websocket, robot_id, data.get("token"), forwarded)
         else:
-            await websocket.send(json.dumps({"error": "Unknown role. Use 'robot' or 'app'"}))
+            await websocket.send(json.dumps({"error": "Unknown role. Use 'robot', 'app', 'observer' or 'presence'"}))
             
     except websockets.ConnectionClosed:
         logger.info("Connection closed during handshake")
@@ -138,5 +370,40 @@ async def main():
     except KeyboardInterrupt:
         logger.info("Server shutting down...")
 
+def run_worker(host: str, port: int, index: int, workdir: str):
+    """One cluster worker: robots and apps on the shared port, forwarded apps on a Unix socket"""
+    global registry, worker_address
+
+    async def serve():
+        global registry, worker_address
+        worker_address = os.path.join(workdir, f"worker-{index}.sock")
+        registry = SocketRegistry(os.path.join(workdir, "registry.sock"))
+        await registry.connect()
+        registry.watch(presence.update)
+        # The kernel spreads new connections over every worker bound with reuse_port
+        async with websockets.serve(handler, host, port, reuse_port=True, ping_interval=10, ping_timeout=10), \
+                websockets.unix_serve(functools.partial(handler, forwarded=True), worker_address):
+            logger.info(f"Signaling worker {index} running on ws://{host}:{port}")
+            await asyncio.Future()
+
+    asyncio.run(serve())
+
+def run_cluster(host: str, port: int, workers: int):
+    """Run `workers` signaling processes behind one address, sharing a robot registry"""
+    workdir = tempfile.mkdtemp(prefix="signaling_")
+    processes = [multiprocessing.Process(target=run_worker, args=(host, port, i, workdir), daemon=True)
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    # Exiting normally terminates the daemon workers too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        asyncio.run(serve_registry(os.path.join(workdir, "registry.sock")))
+    except KeyboardInterrupt:
+        logger.info("Server shutting down...")
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if SIGNALING_WORKERS > 1:
+        run_cluster("0.0.0.0", 8766, SIGNALING_WORKERS)
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+"""Connect/disconnect benchmark for signaling.py.
+
+Runs the signaling server in a child process, connects thousands of robots, attaches
+an app to each and disconnects them again, while one more robot floods an app that
+has stopped reading. Reports robot connects, app attaches, relayed messages and robot
+disconnects per second, and server CPU.
+
+    python signaling_bench.py --robots 2000
+    python signaling_bench.py --workers 4     # cluster on one port, see run_cluster
+    python signaling_bench.py --robots 100 --relay-messages 2000 --no-slow-client   # relay per core
+    python signaling_bench.py --observers 0,10,100,500      # memory and CPU per observer
+    python signaling_bench.py --presence 0,1000,4000        # presence deltas as the fleet grows
+    git show <old commit>:signaling.py > /tmp/signaling_old.py
+    python signaling_bench.py --server /tmp/signaling_old.py     # before/after comparison
+"""
+import argparse
+import asyncio
+import base64
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+import websockets
+
+from gateway_bench import free_port, process_cpu_seconds
+from gateway_loadtest import process_memory_mb
+
+PRESENCE_TOKEN = "bench-presence-token"
+
+
+def tree_cpu_seconds(pid):
+    """CPU of a process and all its descendants, for cluster workers"""
+    total = process_cpu_seconds(pid)
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except FileNotFoundError:
+        return total
+    for child in children:
+        try:
+            total += tree_cpu_seconds(child)
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def run_server(module_path, port, workers=1):
+    """Child process: import a signaling.py and serve its handler"""
+    # Workers inherit the module's import path
+    sys.path.insert(0, os.path.dirname(os.path.abspath(module_path)))
+    spec = importlib.util.spec_from_file_location("bench_signaling", module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # Logs go nowhere but are still formatted, like journald on the server
+    logging.getLogger().handlers = [logging.NullHandler()]
+    if workers > 1:
+        module.run_cluster("127.0.0.1", port, workers)
+        return
+
+    async def serve():
+        async with websockets.serve(module.handler, "127.0.0.1", port, ping_interval=10, ping_timeout=10):
+            await asyncio.Future()
+
+    asyncio.run(serve())
+
+
+async def connect(port, role, robot_id, **hello):
+    for _ in range(20):
+        try:
+            ws = await websockets.connect(f"ws://127.0.0.1:{port}", open_timeout=30)
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+    else:
+        raise RuntimeError("signaling server did not start")
+    await ws.send(json.dumps({"role": role, "robot_id": robot_id, **hello}))
+    return ws
+
+
+async def attach_app(port, robot_id):
+    """Connect an app, retrying while the robot's hello is still on its way"""
+    retries = 0
+    while True:
+        ws = await connect(port, "app", robot_id)
+        reply = json.loads(await ws.recv())
+        if reply.get("type") == "robot_available":
+            return ws, retries
+        await ws.close()
+        retries += 1
+        await asyncio.sleep(0.01)
+
+
+async def slow_client(port, stop):
+    """A robot flooding an app that never reads, so the server's sends to it back up"""
+    robot = await connect(port, "robot", "slow-robot")
+    app, _ = await attach_app(port, "slow-robot")
+    # Random data, permessage-deflate would shrink padding to nothing
+    payload = json.dumps({"type": "telemetry", "data": base64.b64encode(os.urandom(12288)).decode()})
+    sent = 0
+    try:
+        while not stop.is_set():
+            # Blocks for good once the server stops reading from this robot
+            await asyncio.wait_for(robot.send(payload), timeout=0.5)
+            sent += 1
+    except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed):
+        await stop.wait()
+    robot.transport.abort()
+    app.transport.abort()
+    return sent
+
+
+async def gather_limited(limit, coroutines):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(c) for c in coroutines))
+
+
+async def relay(robot, app, count, padding):
+    """Robot -> app messages through the server, returns when the app has all of them"""
+    for i in range(count):
+        await robot.send(json.dumps({"type": "telemetry", "seq": i, "data": padding}))
+    received = 0
+    while received < count:
+        if json.loads(await app.recv()).get("type") == "telemetry":
+            received += 1
+
+
+async def wait_for_error(ws):
+    """Wait until the server tells an app its robot is gone"""
+    async for message in ws:
+        if json.loads(message).get("error") == "Robot disconnected":
+            return
+
+
+async def bench_round(port, args, proc):
+    robot_ids = [f"robot-{i}" for i in range(args.robots)]
+    cpu_start = tree_cpu_seconds(proc.pid)
+
+    start = time.perf_counter()
+    robots = await gather_limited(args.concurrency, (connect(port, "robot", r) for r in robot_ids))
+    connect_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    attached = await gather_limited(args.concurrency, (attach_app(port, r) for r in robot_ids))
+    attach_s = time.perf_counter() - start
+    apps = [ws for ws, _ in attached]
+
+    padding = "x" * max(args.size - 60, 0)
+    relay_cpu_start = tree_cpu_seconds(proc.pid)
+    start = time.perf_counter()
+    await gather_limited(args.concurrency, (relay(robot, app, args.relay_messages, padding)
+                                            for robot, app in zip(robots, apps)))
+    relay_s = time.perf_counter() - start
+    relay_cpu = tree_cpu_seconds(proc.pid) - relay_cpu_start
+
+    waiters = [asyncio.create_task(wait_for_error(ws)) for ws in apps]
+    start = time.perf_counter()
+    await gather_limited(args.concurrency, (ws.close() for ws in robots))
+    await asyncio.wait_for(asyncio.gather(*waiters), timeout=120)
+    disconnect_s = time.perf_counter() - start
+
+    await gather_limited(args.concurrency, (ws.close() for ws in apps))
+    cpu = tree_cpu_seconds(proc.pid) - cpu_start
+    return {
+        "robot_connects_per_s": args.robots / connect_s,
+        "app_attaches_per_s": args.robots / attach_s,
+        "relayed_per_s": args.robots * args.relay_messages / relay_s,
+        "relay_cpu_us_per_message": relay_cpu / (args.robots * args.relay_messages) * 1e6,
+        "app_attach_retries": sum(retries for _, retries in attached),
+        "robot_disconnects_per_s": args.robots / disconnect_s,
+        "server_cpu_ms": cpu * 1000,
+    }
+
+
+async def bench(args):
+    port = free_port()
+    # A cluster supervisor starts worker processes, which daemon processes may not
+    proc = multiprocessing.Process(target=run_server, args=(args.server, port, args.workers),
+                                   daemon=args.workers == 1)
+    proc.start()
+    stop = asyncio.Event()
+    slow = None
+    try:
+        if args.slow_client:
+            slow = asyncio.create_task(slow_client(port, stop))
+            # Let the flood back up before measuring
+            await asyncio.sleep(1.0)
+        rounds = [await bench_round(port, args, proc) for _ in range(args.rounds)]
+        stop.set()
+        slow_sent = await slow if slow else None
+    finally:
+        proc.terminate()
+        proc.join()
+
+    def mean(key):
+        return sum(r[key] for r in rounds) / len(rounds)
+
+    return {
+        "server": os.path.abspath(args.server),
+        "workers": args.workers,
+        "robots": args.robots,
+        "rounds": args.rounds,
+        "slow_client": args.slow_client,
+        "slow_client_messages_accepted": slow_sent,
+        "robot_connects_per_s": mean("robot_connects_per_s"),
+        "app_attaches_per_s": mean("app_attaches_per_s"),
+        "relayed_per_s": mean("relayed_per_s"),
+        "relay_cpu_us_per_message": mean("relay_cpu_us_per_message"),
+        # Server-side relay capacity of one core, the clients share this machine's CPU
+        "relayed_per_core_s": 1e6 / max(mean("relay_cpu_us_per_message"), 1e-9),
+        "robot_disconnects_per_s": mean("robot_disconnects_per_s"),
+        "app_attach_retries": sum(r["app_attach_retries"] for r in rounds),
+        "server_cpu_us_per_robot": mean("server_cpu_ms") * 1000 / args.robots,
+        "per_round": rounds,
+    }
+
+
+class Observer:
+    def __init__(self, ws):
+        self.ws = ws
+        self.received = 0
+
+    async def listen(self):
+        try:
+            async for _ in self.ws:
+                self.received += 1
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+async def observer_bench(args):
+    """One robot streaming to its primary app and a growing number of observers"""
+    port = free_port()
+    os.environ["SIGNALING_MAX_OBSERVERS"] = str(max(args.observers))
+    os.environ["SIGNALING_OBSERVER_TOKEN"] = "bench-observer-token"
+    proc = multiprocessing.Process(target=run_server, args=(args.server, port), daemon=True)
+    proc.start()
+    padding = "x" * max(args.size - 60, 0)
+    steps = []
+    listeners = []
+    try:
+        robot = await connect(port, "robot", "observed-robot")
+        primary, _ = await attach_app(port, "observed-robot")
+        observers = [Observer(primary)]
+        listeners.append(asyncio.create_task(observers[0].listen()))
+        for count in sorted(args.observers):
+            while len(observers) - 1 < count:
+                ws = await connect(port, "observer", "observed-robot", token="bench-observer-token")
+                reply = json.loads(await ws.recv())
+                if reply.get("type") != "robot_available":
+                    raise RuntimeError(f"observer rejected: {reply}")
+                observers.append(Observer(ws))
+                listeners.append(asyncio.create_task(observers[-1].listen()))
+            await asyncio.sleep(0.5)
+            rss_mb, _ = process_memory_mb(proc.pid)
+            for observer in observers:
+                observer.received = 0
+            cpu_start = process_cpu_seconds(proc.pid)
+            start = time.perf_counter()
+            for i in range(args.relay_messages):
+                await robot.send(json.dumps({"type": "telemetry", "seq": i, "data": padding}))
+                if args.rate:
+                    await asyncio.sleep(1 / args.rate)
+            # Observers may be skipped when they fall behind, wait until deliveries stop
+            delivered = -1
+            while delivered != sum(o.received for o in observers):
+                delivered = sum(o.received for o in observers)
+                await asyncio.sleep(0.5)
+            elapsed = time.perf_counter() - start
+            cpu = process_cpu_seconds(proc.pid) - cpu_start
+            steps.append({
+                "observers": count,
+                "server_rss_mb": rss_mb,
+                "server_cpu_us_per_message": cpu / args.relay_messages * 1e6,
+                "primary_received": observers[0].received,
+                "observer_deliveries": delivered - observers[0].received,
+                "observer_missed": count * args.relay_messages - (delivered - observers[0].received),
+                "elapsed_s": elapsed,
+            })
+            print(json.dumps(steps[-1]))
+    finally:
+        for listener in listeners:
+            listener.cancel()
+        proc.terminate()
+        proc.join()
+
+    base, top = steps[0], steps[-1]
+    added = max(top["observers"] - base["observers"], 1)
+    return {
+        "server": os.path.abspath(args.server),
+        "messages": args.relay_messages,
+        "message_bytes": args.size,
+        "steps": steps,
+        "rss_kb_per_observer": (top["server_rss_mb"] - base["server_rss_mb"]) * 1024 / added,
+        "cpu_us_per_message_per_observer":
+            (top["server_cpu_us_per_message"] - base["server_cpu_us_per_message"]) / added,
+    }
+
+
+class PresenceSubscriber:
+    def __init__(self, ws, snapshot):
+        self.ws = ws
+        self.deltas = asyncio.Queue()
+        self.received = 0
+        self.snapshot_bytes = len(snapshot)
+
+    async def listen(self):
+        try:
+            async for message in self.ws:
+                self.received += 1
+                self.deltas.put_nowait((time.perf_counter(), json.loads(message)))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+async def subscribe_presence(port):
+    ws = await connect(port, "presence", None, token=PRESENCE_TOKEN)
+    snapshot = await ws.recv()
+    if json.loads(snapshot).get("type") != "presence_snapshot":
+        raise RuntimeError(f"presence subscription failed: {snapshot}")
+    return PresenceSubscriber(ws, snapshot)
+
+
+async def drain(ws):
+    try:
+        async for _ in ws:
+            pass
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+
+async def lagging_subscriber(port):
+    """A presence subscriber that stops reading, with a small receive window so it backs up soon.
+
+    It asks for the snapshot again a few times, which fills the kernel buffers once the
+    fleet is large, and the next delta finds it behind.
+    """
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(("127.0.0.1", port))
+    # Without compression, repeated snapshots would shrink to almost nothing
+    ws = await websockets.connect(f"ws://127.0.0.1:{port}", sock=sock, compression=None)
+    ws.transport.pause_reading()
+    await ws.send(json.dumps({"role": "presence", "token": PRESENCE_TOKEN}))
+    for _ in range(20):
+        await ws.send(json.dumps({"robot_ids": None}))
+    return ws
+
+
+async def presence_bench(args):
+    """Presence deltas of one robot coming and going, while the fleet around it grows"""
+    port = free_port()
+    # Low enough that the lagging subscriber is dropped while the others keep up
+    os.environ["SIGNALING_PRESENCE_BUFFER_LIMIT"] = str(args.presence_buffer_limit)
+    os.environ["SIGNALING_PRESENCE_TOKEN"] = PRESENCE_TOKEN
+    proc = multiprocessing.Process(target=run_server, args=(args.server, port, args.workers),
+                                   daemon=args.workers == 1)
+    proc.start()
+    fleet = []
+    listeners = []
+    steps = []
+    try:
+        for size in sorted(args.presence):
+            fleet += await gather_limited(args.concurrency, [connect(port, "robot", f"idle-{i}")
+                                                             for i in range(len(fleet), size)])
+            await asyncio.sleep(1.0)
+            lagging = await lagging_subscriber(port) if args.lagging_subscriber else None
+            subscribe_start = time.perf_counter()
+            subscribers = [await subscribe_presence(port) for _ in range(args.subscribers)]
+            subscribe_s = (time.perf_counter() - subscribe_start) / args.subscribers
+            listeners += [asyncio.create_task(s.listen()) for s in subscribers]
+
+            latencies = []
+            cpu_start = tree_cpu_seconds(proc.pid)
+            for i in range(args.changes // 2):
+                for online in (True, False):
+                    start = time.perf_counter()
+                    if online:
+                        robot = await connect(port, "robot", f"churn-{size}")
+                    else:
+                        await robot.close()
+                    while True:
+                        try:
+                            arrived, delta = await asyncio.wait_for(subscribers[0].deltas.get(), timeout=10)
+                        except asyncio.TimeoutError:
+                            raise RuntimeError(f"no presence delta for churn-{size} going online={online}")
+                        if delta.get("robot_id") == f"churn-{size}" and delta.get("online") is online:
+                            break
+                    latencies.append(arrived - start)
+            expected = args.changes // 2 * 2
+            while min(s.received for s in subscribers) < expected:
+                await asyncio.sleep(0.05)
+            cpu = tree_cpu_seconds(proc.pid) - cpu_start
+            lagging_closed = None
+            if lagging is not None:
+                # Every delta above arrived, so the server got past the lagging subscriber
+                lagging.transport.resume_reading()
+                try:
+                    await asyncio.wait_for(drain(lagging), timeout=2.0)
+                except asyncio.TimeoutError:
+                    await lagging.close()
+                lagging_closed = lagging.close_code if lagging.close_code == 1013 else False
+            latencies.sort()
+            steps.append({
+                "fleet": size,
+                "subscribers": args.subscribers,
+                "snapshot_bytes": subscribers[0].snapshot_bytes,
+                "subscribe_ms": subscribe_s * 1000,
+                "change_to_delta_ms_p50": latencies[len(latencies) // 2] * 1000,
+                "change_to_delta_ms_p99": latencies[int(len(latencies) * 0.99)] * 1000,
+                "server_cpu_us_per_change": cpu / expected * 1e6,
+                # 1013 once the server dropped it for falling behind, False if it never fell behind
+                "lagging_subscriber_closed": lagging_closed,
+            })
+            print(json.dumps(steps[-1]))
+            for subscriber in subscribers:
+                await subscriber.ws.close()
+    finally:
+        for listener in listeners:
+            listener.cancel()
+        proc.terminate()
+        proc.join()
+
+    return {
+        "server": os.path.abspath(args.server),
+        "workers": args.workers,
+        "changes": args.changes,
+        "steps": steps,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark connects and disconnects through signaling.py")
+    parser.add_argument("--server", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "signaling.py"),
+                        help="signaling module to benchmark (default: ./signaling.py)")
+    parser.add_argument("--robots", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=200, help="connections opened or closed at once")
+    parser.add_argument("--workers", type=int, default=1, help="run the server as a cluster of this many workers")
+    parser.add_argument("--relay-messages", type=int, default=20, help="robot -> app messages per pair")
+    parser.add_argument("--size", type=int, default=200, help="approximate relayed message size in bytes")
+    parser.add_argument("--no-slow-client", dest="slow_client", action="store_false",
+                        help="leave out the app that stops reading")
+    parser.add_argument("--observers", type=lambda text: [int(n) for n in text.split(",")],
+                        help="comma separated observer counts, measures one robot fanned out to them")
+    parser.add_argument("--rate", type=float, default=0, help="robot messages/s for --observers, 0 for unpaced")
+    parser.add_argument("--presence", type=lambda text: [int(n) for n in text.split(",")],
+                        help="comma separated fleet sizes, measures presence deltas as the fleet grows")
+    parser.add_argument("--subscribers", type=int, default=10, help="presence subscribers for --presence")
+    parser.add_argument("--changes", type=int, default=400, help="robot connects and disconnects per fleet size")
+    parser.add_argument("--no-lagging-subscriber", dest="lagging_subscriber", action="store_false",
+                        help="leave out the presence subscriber that stops reading")
+    parser.add_argument("--presence-buffer-limit", type=int, default=16384,
+                        help="SIGNALING_PRESENCE_BUFFER_LIMIT of the server under --presence")
+    parser.add_argument("--json", help="also write the result to this file")
+    args = parser.parse_args()
+    if args.observers or args.presence:
+        result = asyncio.run(observer_bench(args) if args.observers else presence_bench(args))
+        print(json.dumps({k: v for k, v in result.items() if k != "steps"}, indent=2))
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(result, f, indent=2)
+        return
+    result = asyncio.run(bench(args))
+    print(json.dumps({k: v for k, v in result.items() if k != "per_round"}, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
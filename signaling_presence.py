@@ -0,0 +1,140 @@
+"""Which robots are online, kept up to date as they come and go.
+
+Every robot that has registered has an entry: whether it is online, whether an app is
+connected to it, when it was last seen (connected or disconnected) and the capabilities
+it advertised when it registered. Entries of offline robots are kept, so a fleet view
+can show when a robot was last there.
+
+Apps subscribe with {"role": "presence"}, optionally limited to some robots with
+"robot_ids". They get one snapshot and then a delta for every change, so an update
+costs one message per interested subscriber however large the fleet is:
+
+    {"type": "presence_snapshot", "seq": 41, "robots": {"robot-1": {"online": true, ...}}}
+    {"type": "presence", "seq": 42, "robot_id": "robot-1", "app": false}
+
+seq increases by one per change, deltas with a seq at or below the snapshot's are
+already in it. A subscriber that stops reading is closed (1013) once it falls too far
+behind, and gets a fresh snapshot when it subscribes again.
+
+Robots don't authenticate, so offline entries are bounded: one is dropped after
+offline_ttl seconds offline, or sooner once there are more than max_offline, oldest
+first. Subscribers get {"type": "presence", "seq": 43, "robot_id": ..., "removed": true}.
+"""
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Set
+
+import websockets
+
+logger = logging.getLogger(__name__)
+
+# Offline robots are forgotten after this long, or oldest first past this many
+OFFLINE_TTL = float(os.getenv("SIGNALING_PRESENCE_OFFLINE_TTL", str(24 * 3600)))
+MAX_OFFLINE = int(os.getenv("SIGNALING_PRESENCE_MAX_OFFLINE", "10000"))
+
+
+class PresenceIndex:
+    def __init__(self, buffer_limit: int = 1 << 20, offline_ttl: float = OFFLINE_TTL,
+                 max_offline: int = MAX_OFFLINE):
+        self.robots: Dict[str, dict] = {}
+        # Offline robot id -> monotonic time it went offline, oldest first
+        self.offline: collections.OrderedDict = collections.OrderedDict()
+        self.offline_ttl = offline_ttl
+        self.max_offline = max_offline
+        self.seq = 0
+        # Subscribers to every robot, and subscribers to single robots by robot id
+        self.everything: Set = set()
+        self.watchers: Dict[str, Set] = {}
+        self.filters: Dict = {}
+        self.buffer_limit = buffer_limit
+        self.closing = set()
+
+    def update(self, robot_id: str, changes: dict) -> Optional[dict]:
+        """Apply changes to a robot's entry and push them to its subscribers, returns the delta"""
+        entry = self.robots.get(robot_id)
+        if entry is None:
+            entry = self.robots[robot_id] = {"online": False, "app": False, "last_seen": None, "capabilities": {}}
+        changed = {key: value for key, value in changes.items() if entry.get(key) != value}
+        if not changed:
+            return None
+        entry.update(changed)
+        if entry["online"]:
+            self.offline.pop(robot_id, None)
+        elif robot_id not in self.offline:
+            self.offline[robot_id] = time.monotonic()
+        delta = self.push(robot_id, changed)
+        self.expire()
+        return delta
+
+    def push(self, robot_id: str, changed: dict) -> dict:
+        self.seq += 1
+        delta = {"type": "presence", "seq": self.seq, "robot_id": robot_id, **changed}
+        subscribers = self.everything
+        if robot_id in self.watchers:
+            subscribers = subscribers | self.watchers[robot_id]
+        if subscribers:
+            self.publish(subscribers, json.dumps(delta))
+        return delta
+
+    def expire(self):
+        """Forget offline robots past offline_ttl, and the oldest ones past max_offline"""
+        deadline = time.monotonic() - self.offline_ttl
+        while self.offline:
+            robot_id, since = next(iter(self.offline.items()))
+            if since > deadline and len(self.offline) <= self.max_offline:
+                break
+            del self.offline[robot_id]
+            del self.robots[robot_id]
+            self.push(robot_id, {"removed": True})
+
+    def publish(self, subscribers, message: str):
+        """Write without awaiting. A subscriber that fell behind is closed instead of missing deltas"""
+        ready, lagging = [], []
+        for ws in subscribers:
+            if ws.transport.get_write_buffer_size() < self.buffer_limit:
+                ready.append(ws)
+            else:
+                lagging.append(ws)
+        websockets.broadcast(ready, message)
+        # subscribers may be self.everything, so it is only changed once the loop is done
+        for ws in lagging:
+            self.unsubscribe(ws)
+            task = asyncio.create_task(ws.close(1013, "presence subscriber fell behind"))
+            self.closing.add(task)
+            task.add_done_callback(self.closing.discard)
+
+    def subscribe(self, ws, robot_ids: Optional[List[str]] = None):
+        """Send the snapshot and start pushing deltas, replacing an earlier subscription of ws.
+
+        Raises ValueError unless robot_ids is None or a list of robot ids.
+        """
+        if robot_ids is not None and (not isinstance(robot_ids, list)
+                                      or not all(isinstance(robot_id, str) for robot_id in robot_ids)):
+            raise ValueError("robot_ids must be a list of robot ids")
+        self.expire()
+        self.unsubscribe(ws)
+        if robot_ids is None:
+            self.everything.add(ws)
+            robots = self.robots
+        else:
+            robot_ids = set(robot_ids)
+            for robot_id in robot_ids:
+                self.watchers.setdefault(robot_id, set()).add(ws)
+            robots = {robot_id: self.robots[robot_id] for robot_id in robot_ids if robot_id in self.robots}
+        self.filters[ws] = robot_ids
+        # Written without awaiting, so no delta can get in ahead of the snapshot
+        websockets.broadcast([ws], json.dumps({"type": "presence_snapshot", "seq": self.seq, "robots": robots}))
+
+    def unsubscribe(self, ws):
+        robot_ids = self.filters.pop(ws, None)
+        self.everything.discard(ws)
+        for robot_id in robot_ids or ():
+            watchers = self.watchers.get(robot_id)
+            if watchers is not None:
+                watchers.discard(ws)
+                if not watchers:
+                    del self.watchers[robot_id]
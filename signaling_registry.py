@@ -0,0 +1,269 @@
+"""Which signaling worker each robot is connected to.
+
+When signaling.py runs as several workers, a worker claims a robot when it connects
+and releases it when it leaves. A worker that gets an app for a robot it doesn't hold
+looks up the owner and forwards the app there. Any store with claim/release/lookup
+works: LocalRegistry keeps the map in memory, SocketRegistry shares one map between the
+workers on a machine through serve_registry on a Unix socket. A networked store (Redis,
+etcd) would slot in the same way for workers on several nodes.
+
+Workers are identified by the address other workers forward apps to.
+
+The registry also keeps the presence index (signaling_presence.py) for the whole
+cluster. Workers report changes of the robots they hold, and every worker watches the
+registry to mirror the index for its own presence subscribers.
+"""
+import abc
+import asyncio
+import itertools
+import json
+import logging
+import time
+from typing import Callable, Dict, List, Optional
+
+from signaling_presence import PresenceIndex
+
+logger = logging.getLogger(__name__)
+
+
+class RobotRegistry(abc.ABC):
+    @abc.abstractmethod
+    async def claim(self, robot_id: str, worker: str):
+        """Record that worker holds the robot, replacing any earlier claim"""
+
+    @abc.abstractmethod
+    async def release(self, robot_id: str, worker: str):
+        """Forget the robot, unless another worker has claimed it since"""
+
+    @abc.abstractmethod
+    async def lookup(self, robot_id: str) -> Optional[str]:
+        """The worker holding the robot, None if no worker does"""
+
+    @abc.abstractmethod
+    async def report(self, robot_id: str, worker: str, changes: dict) -> Optional[dict]:
+        """Record a presence change, unless another worker has claimed the robot since"""
+
+    @abc.abstractmethod
+    async def robots(self) -> Dict[str, dict]:
+        """Presence entry of every robot known to the registry"""
+
+
+class LocalRegistry(RobotRegistry):
+    def __init__(self):
+        self.owners: Dict[str, str] = {}
+        self.presence = PresenceIndex()
+
+    async def claim(self, robot_id: str, worker: str):
+        # The newest connection wins, like a reconnecting robot replacing its pair
+        self.owners[robot_id] = worker
+
+    async def release(self, robot_id: str, worker: str):
+        if self.owners.get(robot_id) == worker:
+            del self.owners[robot_id]
+
+    async def lookup(self, robot_id: str) -> Optional[str]:
+        return self.owners.get(robot_id)
+
+    async def report(self, robot_id: str, worker: str, changes: dict) -> Optional[dict]:
+        if self.owners.get(robot_id) == worker:
+            return self.presence.update(robot_id, changes)
+
+    async def robots(self) -> Dict[str, dict]:
+        return self.presence.robots
+
+
+class SocketRegistry(RobotRegistry):
+    """Client of serve_registry, one connection per worker.
+
+    Claims and releases are written without waiting for a reply, the connection keeps
+    them in order. Lookups are matched to replies by id. After watch(), presence
+    changes of every worker's robots arrive on the same connection.
+
+    When the registry goes away, lookups raise ConnectionError until the connection
+    is back. This worker's claims and presence are remembered and sent again on
+    reconnect, so a restarted registry learns them anew.
+    """
+
+    def __init__(self, path: str, lookup_timeout: float = 5.0):
+        self.path = path
+        self.lookup_timeout = lookup_timeout
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.waiting: Dict[int, asyncio.Future] = {}
+        self.ids = itertools.count()
+        self.on_presence: Optional[Callable[[str, dict], None]] = None
+        # robot_id -> (worker, presence reported so far), replayed on reconnect
+        self.claims: Dict[str, tuple] = {}
+        # Releases made while disconnected, in case the registry outlived the connection
+        self.releases: List[tuple] = []
+        self.reader_task: Optional[asyncio.Task] = None
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None
+
+    async def connect(self, timeout: Optional[float] = 10.0):
+        """Connect, retrying until timeout (None retries forever), and replay claims and watch"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        delay = 0.05
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                break
+            except OSError:
+                if deadline is not None and loop.time() > deadline:
+                    raise
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+        self.writer = writer
+        for robot_id, worker in self.releases:
+            self._send({"op": "release", "robot_id": robot_id, "worker": worker})
+        self.releases.clear()
+        for robot_id, (worker, presence) in self.claims.items():
+            self._send({"op": "claim", "robot_id": robot_id, "worker": worker})
+            if presence:
+                self._send({"op": "report", "robot_id": robot_id, "worker": worker, "changes": presence})
+        if self.on_presence is not None:
+            self._send({"op": "watch"})
+        self.reader_task = asyncio.create_task(self._read_replies(reader))
+
+    def _send(self, request: dict):
+        if self.writer is None:
+            raise ConnectionError("robot registry is not connected")
+        self.writer.write(json.dumps(request).encode() + b"\n")
+
+    async def claim(self, robot_id: str, worker: str):
+        self.claims[robot_id] = (worker, {})
+        if self.connected:
+            self._send({"op": "claim", "robot_id": robot_id, "worker": worker})
+
+    async def release(self, robot_id: str, worker: str):
+        if self.claims.get(robot_id, (None,))[0] == worker:
+            del self.claims[robot_id]
+        if self.connected:
+            self._send({"op": "release", "robot_id": robot_id, "worker": worker})
+        else:
+            self.releases.append((robot_id, worker))
+
+    async def report(self, robot_id: str, worker: str, changes: dict) -> Optional[dict]:
+        claim = self.claims.get(robot_id)
+        if claim is not None and claim[0] == worker:
+            claim[1].update(changes)
+        if self.connected:
+            self._send({"op": "report", "robot_id": robot_id, "worker": worker, "changes": changes})
+
+    def watch(self, on_presence: Callable[[str, dict], None]):
+        """Call on_presence(robot_id, changes) for every robot known so far, then for each change"""
+        self.on_presence = on_presence
+        if self.connected:
+            self._send({"op": "watch"})
+
+    async def lookup(self, robot_id: str) -> Optional[str]:
+        return (await self._request({"op": "lookup", "robot_id": robot_id}))["worker"]
+
+    async def robots(self) -> Dict[str, dict]:
+        return (await self._request({"op": "robots"}))["robots"]
+
+    async def _request(self, request: dict) -> dict:
+        """Send a request and wait for the reply with its id"""
+        request_id = next(self.ids)
+        self._send({**request, "id": request_id})
+        future = self.waiting[request_id] = asyncio.get_running_loop().create_future()
+        try:
+            return await asyncio.wait_for(future, self.lookup_timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"robot registry did not answer within {self.lookup_timeout:g} s")
+        finally:
+            self.waiting.pop(request_id, None)
+
+    async def _read_replies(self, reader: asyncio.StreamReader):
+        try:
+            async for line in reader:
+                reply = json.loads(line)
+                if reply.get("op") == "presence":
+                    if self.on_presence is not None:
+                        self.on_presence(reply["robot_id"], reply["changes"])
+                    continue
+                future = self.waiting.pop(reply["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (ConnectionError, json.JSONDecodeError, KeyError) as e:
+            logger.error(f"Robot registry connection failed: {e}")
+        logger.error(f"Lost the robot registry at {self.path}, reconnecting")
+        self.writer.close()
+        self.writer = None
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_exception(ConnectionError("robot registry closed"))
+        self.waiting.clear()
+        await self.connect(timeout=None)
+
+
+async def serve_registry(path: str, registry: Optional[RobotRegistry] = None):
+    """Serve a registry to the workers on this machine over a Unix socket"""
+    registry = registry or LocalRegistry()
+    # Connections of workers mirroring the presence index
+    watchers = set()
+    # Robot id -> connection of its latest claim, a reconnected worker's new connection
+    # takes its robots over from the old one
+    holders = {}
+
+    def presence_line(robot_id, changes):
+        return json.dumps({"op": "presence", "robot_id": robot_id, "changes": changes}).encode() + b"\n"
+
+    async def report(robot_id, worker, changes):
+        delta = await registry.report(robot_id, worker, changes)
+        if delta is not None:
+            changes = {k: v for k, v in delta.items() if k not in ("type", "seq", "robot_id")}
+            line = presence_line(robot_id, changes)
+            for watcher in watchers:
+                watcher.write(line)
+
+    async def handle(reader, writer):
+        # Robots claimed over this connection, released when it closes. A worker
+        # that lost the connection claims its robots again when it reconnects
+        claims: Dict[str, str] = {}
+        try:
+            async for line in reader:
+                request = json.loads(line)
+                op = request.get("op")
+                if op == "claim":
+                    await registry.claim(request["robot_id"], request["worker"])
+                    claims[request["robot_id"]] = request["worker"]
+                    holders[request["robot_id"]] = writer
+                elif op == "release":
+                    await registry.release(request["robot_id"], request["worker"])
+                    if claims.get(request["robot_id"]) == request["worker"]:
+                        del claims[request["robot_id"]]
+                        if holders.get(request["robot_id"]) is writer:
+                            del holders[request["robot_id"]]
+                elif op == "lookup":
+                    worker = await registry.lookup(request["robot_id"])
+                    writer.write(json.dumps({"id": request["id"], "worker": worker}).encode() + b"\n")
+                elif op == "robots":
+                    robots = await registry.robots()
+                    writer.write(json.dumps({"id": request["id"], "robots": robots}).encode() + b"\n")
+                elif op == "report":
+                    await report(request["robot_id"], request["worker"], request["changes"])
+                elif op == "watch":
+                    for robot_id, entry in (await registry.robots()).items():
+                        writer.write(presence_line(robot_id, entry))
+                    watchers.add(writer)
+        except (ConnectionError, json.JSONDecodeError, KeyError) as e:
+            logger.error(f"Registry connection failed: {e}")
+        finally:
+            watchers.discard(writer)
+            writer.close()
+            # A dead worker's robots are gone, unless another connection has claimed them since
+            claims = {robot_id: worker for robot_id, worker in claims.items() if holders.get(robot_id) is writer}
+            for robot_id, worker in claims.items():
+                del holders[robot_id]
+                await report(robot_id, worker, {"online": False, "app": False, "last_seen": time.time()})
+                await registry.release(robot_id, worker)
+            if claims:
+                logger.info(f"Released {len(claims)} robots of a closed worker connection")
+
+    server = await asyncio.start_unix_server(handle, path)
+    logger.info(f"Robot registry listening on {path}")
+    async with server:
+        await server.serve_forever()